@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+"""
+相关新闻推荐的近似最近邻索引
+
+推荐用的是每篇新闻 topK 个关键词的 TF-IDF 向量，彼此非负且极稀疏：
+两篇新闻的余弦相似度大于 0 当且仅当它们有共同的关键词。因此与检索一样，
+按关键词建一份倒排表（关键词 -> 含有它的新闻），查询时只和有共同关键词的新闻比较，
+再用精确的余弦相似度重排取前 k 名。近似之处在于跳过 df 超过文档总数 max_df 比例的常见关键词
+（配置 knearest_max_df，默认 MAX_DF），这类词的 idf 低、权重小，却占了大部分比较次数。
+阈值随语料规模增长：本语料 891 篇时取 0.05，recall@5 约 0.99，相似度计算次数约为精确计算的 6%；
+取 1 即不跳过任何关键词，结果与精确计算相同。
+（随机投影 LSH 在这里不适用：本语料第 5 近邻的余弦相似度中位数只有 0.1 左右，
+要达到 0.99 的召回率几乎每次都要和全部文档比较。）
+
+插入、删除都是增量的：每次只对新增或变化的文档查询，已有文档的推荐列表只在以下情况更新：
+新文档与它有共同关键词且比它当前第 k 名更相似，或它的推荐列表中有文档被删除或已变化。
+每批新抓取的新闻只需与候选集比较，不必重算全部 N × N 相似度。
+
+第二个近似来源是 idf 的漂移：关键词的权重取决于提取时的 idf，而每批新闻都会按全部语料重新生成 idf 文件，
+旧文档的向量若一直不变，它们与新文档的相似度会随抓取批次逐渐偏离精确模式的结果。
+因此每篇文档还保存提取关键词时各关键词的 idf，某个关键词的 idf 相对变化超过 idf_drift
+（配置 knearest_idf_drift，默认 IDF_DRIFT）时，该文档重新提取关键词并重新插入（见 stale）；
+阈值以内的偏离不处理，取 0 时 idf 一有变化就重新提取。
+
+索引状态（关键词向量及其 idf、推荐列表及其相似度）保存在 ir.db 的 ann_docs 表中，
+按 docid 与 doc_state 中的内容 sha1 对齐；倒排表在每次更新时由关键词向量重建。
+"""
+
+import numpy as np
+from scipy import sparse
+
+MAX_DF = 0.05
+IDF_DRIFT = 0.05
+# 余弦相似度比较前保留的小数位数：累加次序不同（稀疏与稠密乘积、A·B 与 B·A），
+# 本应相等的相似度会在最后一两位上不同，取整后按并列处理，由列序（近似模式下为 docid）决定先后
+SIMILARITY_DECIMALS = 12
+ANN_DOCS_TABLE = '''CREATE TABLE IF NOT EXISTS ann_docs
+                     (id INTEGER PRIMARY KEY, hash TEXT, terms TEXT, weights BLOB,
+                     neighbours BLOB, similarities BLOB, idf BLOB)'''
+
+
+class ANNIndex:
+
+    def __init__(self, max_df = MAX_DF):
+        self.max_df = max_df
+        self.docs = {} # docid -> (hash, 关键词元组, 单位化的权重)
+        self.idf = {} # docid -> 提取关键词时各关键词的 idf，未知为 nan
+        self.neighbours = {} # docid -> (推荐的 docid 数组, 对应的相似度数组)
+        self.dirty = set() # 需要重新查询的文档
+        self.added = set() # 本批新插入的文档，其候选可能需要把它加入推荐列表
+        self.comparisons = 0 # 最近一次 update 计算的相似度次数
+
+    def add(self, docid, h, keywords, idf = None):
+        """插入或替换一篇文档，keywords 为 {关键词: TF-IDF 权重}，idf 为提取关键词时使用的 {词: idf}"""
+        if docid in self.docs:
+            self.remove(docid)
+        terms = tuple(keywords)
+        weights = np.array([keywords[t] for t in terms], dtype=np.float64)
+        norm = np.sqrt(weights @ weights)
+        if norm > 0:
+            weights = weights / norm
+        self.docs[docid] = (h, terms, weights)
+        self.idf[docid] = np.array([(idf or {}).get(t, np.nan) for t in terms], dtype=np.float64)
+        self.dirty.add(docid)
+        self.added.add(docid)
+
+    def remove(self, docid):
+        """删除一篇文档，推荐列表中含有它的文档标记为需要重新查询"""
+        del self.docs[docid]
+        self.idf.pop(docid, None)
+        self.neighbours.pop(docid, None)
+        self.dirty.discard(docid)
+        self.added.discard(docid)
+        for other, (ids, sims) in self.neighbours.items():
+            if docid in ids:
+                self.dirty.add(other)
+
+    def stale(self, idf, drift = IDF_DRIFT):
+        """idf 为当前的 {词: idf}，返回有关键词的 idf 相对提取时变化超过 drift 的文档（需重新提取关键词）"""
+        stale = []
+        for docid, (h, terms, weights) in self.docs.items():
+            old = self.idf[docid]
+            new = np.array([idf.get(t, np.nan) for t in terms], dtype=np.float64)
+            # nan（提取时或现在不知道 idf）比较结果为 False，同样视为过期
+            if not (np.abs(new - old) <= drift * np.abs(old)).all():
+                stale.append(docid)
+        return stale
+
+    def update(self, k):
+        """为 dirty 中的文档重新查询前 k 名，并把新文档加入与之足够相似的旧文档的推荐列表，
+        返回推荐列表有变化的文档数"""
+        self.comparisons = 0
+        k = min(k, len(self.docs) - 1)
+        # 新闻不足 k + 1 篇时推荐列表不满 k 篇，新闻增加后这些列表要重新查询补足
+        self.dirty.update(docid for docid, (neighbours, sims) in self.neighbours.items() if len(neighbours) < k)
+        if not self.dirty:
+            return 0
+        ids = np.array(sorted(self.docs), dtype=np.int64)
+        row = {docid: i for i, docid in enumerate(ids.tolist())}
+        matrix = self.matrix(ids)
+        inverted = matrix.tocsc() # 每一列即一个关键词的倒排表（行号升序）
+        df = np.diff(inverted.indptr)
+        dirty = np.zeros(len(ids), dtype=bool)
+        dirty[[row[docid] for docid in self.dirty]] = True
+        # 每篇旧文档当前第 k 名的相似度，新文档不低于它才可能进入其推荐列表
+        floor = np.full(len(ids), -np.inf)
+        for docid, (neighbours, sims) in self.neighbours.items():
+            if 0 < k <= len(sims) and docid in row:
+                floor[row[docid]] = sims[k - 1]
+        query = np.zeros(matrix.shape[1])
+        updated = 0
+        for i in np.flatnonzero(dirty).tolist():
+            docid = int(ids[i])
+            cols = matrix.indices[matrix.indptr[i]:matrix.indptr[i + 1]]
+            common = cols[df[cols] <= self.max_df * len(ids)]
+            candidates = np.unique(np.concatenate([inverted.indices[inverted.indptr[t]:inverted.indptr[t + 1]] for t in common.tolist()]
+                                                  + [np.empty(0, dtype=inverted.indices.dtype)]))
+            candidates = candidates[candidates != i]
+            if len(candidates) < k: # 有共同关键词的新闻不足 k 篇，按 docid 顺序补足
+                extra = [j for j in range(k + 1) if j != i and j not in candidates][:k - len(candidates)]
+                candidates = np.union1d(candidates, extra)
+            candidates = candidates.astype(np.int64)
+            query[cols] = matrix.data[matrix.indptr[i]:matrix.indptr[i + 1]]
+            sims = np.round(row_dots(matrix, candidates, query), SIMILARITY_DECIMALS)
+            query[cols] = 0
+            self.comparisons += len(candidates)
+            self.neighbours[docid] = self.top_k(ids[candidates], sims, k)
+            updated += 1
+            if docid in self.added:
+                better = ~dirty[candidates] & (sims >= floor[candidates])
+                for j, s in zip(candidates[better].tolist(), sims[better].tolist()):
+                    other = int(ids[j])
+                    if self.offer(other, docid, s, k):
+                        if len(self.neighbours[other][1]) >= k:
+                            floor[j] = self.neighbours[other][1][-1]
+                        updated += 1
+        self.dirty.clear()
+        self.added.clear()
+        return updated
+
+    def top_k(self, ids, sims, k):
+        """按相似度降序、docid 升序取前 k 名"""
+        order = np.lexsort((ids, -sims))[:k]
+        return ids[order], sims[order]
+
+    def offer(self, docid, candidate, sim, k):
+        """candidate 比 docid 当前的第 k 名更相似时把它加入推荐列表"""
+        ids, sims = self.neighbours.get(docid, (np.empty(0, dtype=np.int64), np.empty(0)))
+        if candidate in ids:
+            return False
+        if len(ids) >= k and (sim, -candidate) <= (sims[-1], -ids[-1]):
+            return False
+        self.neighbours[docid] = self.top_k(np.append(ids, candidate), np.append(sims, sim), k)
+        return True
+
+    def matrix(self, ids):
+        """按 ids 顺序排列的单位化 TF-IDF 稀疏矩阵"""
+        vocabulary = {}
+        indptr = [0]
+        indices = []
+        data = [np.empty(0)]
+        for docid in ids.tolist():
+            h, terms, weights = self.docs[docid]
+            indices.extend(vocabulary.setdefault(t, len(vocabulary)) for t in terms)
+            data.append(weights)
+            indptr.append(len(indices))
+        return sparse.csr_matrix((np.concatenate(data), np.array(indices, dtype=np.int64),
+                                  np.array(indptr, dtype=np.int64)), shape=(len(ids), len(vocabulary)))
+
+    def k_nearest(self):
+        """[docid, [推荐的 docid, ...]] 列表，按 docid 升序"""
+        return [[docid, self.neighbours[docid][0].tolist()] for docid in sorted(self.neighbours)]
+
+    @classmethod
+    def load(cls, conn, max_df = MAX_DF):
+        index = cls(max_df)
+        conn.execute(ANN_DOCS_TABLE)
+        # 旧版的 ann_docs 没有 idf 列，全部文档视为过期，下次更新时重新提取关键词
+        idf = 'idf' if 'idf' in [r[1] for r in conn.execute('PRAGMA table_info(ann_docs)')] else 'NULL'
+        for docid, h, terms, weights, neighbours, similarities, keyed in conn.execute(
+                'SELECT id, hash, terms, weights, neighbours, similarities, %s FROM ann_docs' % idf):
+            terms = tuple(terms.split('\n')) if terms else ()
+            index.docs[docid] = (h, terms, np.frombuffer(weights, dtype=np.float64))
+            index.idf[docid] = np.frombuffer(keyed, dtype=np.float64) if keyed is not None else np.full(len(terms), np.nan)
+            index.neighbours[docid] = (np.frombuffer(neighbours, dtype=np.int64), np.frombuffer(similarities, dtype=np.float64))
+        return index
+
+    def save(self, conn):
+        conn.execute('DROP TABLE IF EXISTS ann_docs')
+        conn.execute(ANN_DOCS_TABLE)
+        empty = (np.empty(0, dtype=np.int64), np.empty(0))
+        conn.executemany('INSERT INTO ann_docs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                         ((docid, h, '\n'.join(terms), weights.tobytes(),
+                           self.neighbours.get(docid, empty)[0].tobytes(), self.neighbours.get(docid, empty)[1].tobytes(),
+                           self.idf[docid].tobytes())
+                          for docid, (h, terms, weights) in self.docs.items()))
+        conn.commit()
+
+
+def row_dots(matrix, rows, query):
+    """CSR 矩阵中 rows 各行与稠密向量 query 的内积"""
+    starts = matrix.indptr[rows]
+    lengths = matrix.indptr[rows + 1] - starts
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    return np.bincount(np.repeat(np.arange(len(rows)), lengths),
+                       weights = matrix.data[offsets] * query[matrix.indices[offsets]], minlength = len(rows))
+
+
+def recall_at_k(approximate, exact, k):
+    """approximate、exact 均为 {docid: [推荐的 docid, ...]}，返回两者共有文档上的平均 recall@k"""
+    common = [docid for docid in approximate if docid in exact]
+    total = sum(min(k, len(exact[d])) for d in common) # 新闻不足 k + 1 篇时精确结果也不满 k 篇
+    if not total:
+        return 0.0
+    hits = sum(len(set(approximate[d][:k]) & set(exact[d][:k])) for d in common)
+    return hits / total
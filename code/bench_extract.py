@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+正文抽取基准：比较 spider.chinanews.com.py 中 BeautifulSoup 版（parse_news_page）与 lxml 版
+（parse_news_page_lxml）的结果与速度
+
+样本为 data/fixtures/chinanews 下保存的新闻页（普通、图文、GB2312、实体、视频、CRLF、
+标签错乱、没有正文等），加上 bench_spider.py 模拟站点的新闻页。先逐页检查两种抽取结果完全相同，
+并列出 lxml 版在哪些页面上改用 BeautifulSoup；再在单个进程中反复抽取全部样本，输出每核每秒页数。
+有结果不同的页面时退出码为 1。
+
+用法（在 code 目录下）：
+    python bench_extract.py [轮数]
+"""
+
+import os
+import sys
+import time
+from datetime import date
+
+import bench_spider
+
+spider = bench_spider.spider
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'fixtures', 'chinanews')
+
+
+def load_samples():
+    """返回 [(名称, 页面内容)]"""
+    samples = []
+    for name in sorted(os.listdir(FIXTURE_DIR)):
+        with open(os.path.join(FIXTURE_DIR, name), 'rb') as f:
+            samples.append((name, f.read()))
+    pages, flaky = bench_spider.build_site(date(2019, 8, 1), 1, 30)
+    samples.extend((path, content) for path, (status, content) in sorted(pages.items())
+                   if status == 200 and path.startswith('/gn/'))
+    return samples
+
+
+def fallbacks(samples):
+    """lxml 版改用 BeautifulSoup 的样本名称"""
+    parse_news_page = spider.parse_news_page
+    used = []
+
+    def counting(html):
+        used.append(current)
+        return parse_news_page(html)
+    spider.parse_news_page = counting
+    try:
+        for current, html in samples:
+            spider.parse_news_page_lxml(html)
+    finally:
+        spider.parse_news_page = parse_news_page
+    return used
+
+
+def throughput(extract, samples, rounds):
+    t0 = time.perf_counter()
+    for r in range(rounds):
+        for name, html in samples:
+            extract(html)
+    return rounds * len(samples) / (time.perf_counter() - t0)
+
+
+if __name__ == '__main__':
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    samples = load_samples()
+    mismatches = 0
+    for name, html in samples:
+        expected = spider.parse_news_page(html)
+        if spider.parse_news_page_lxml(html) != expected:
+            mismatches += 1
+            print('结果不同：%s' % name)
+    print('样本 %d 页（其中 %s 下 %d 页），两种抽取结果不同 %d 页'
+          % (len(samples), os.path.relpath(FIXTURE_DIR), len(os.listdir(FIXTURE_DIR)), mismatches))
+    used = fallbacks(samples)
+    print('lxml 版改用 BeautifulSoup %d 页：%s' % (len(used), ', '.join(used) or '无'))
+
+    size = sum(len(html) for name, html in samples)
+    speeds = {}
+    for name, extract in spider.EXTRACTORS.items():
+        speeds[name] = throughput(extract, samples, rounds)
+        print('%-5s %8.1f 页/秒/核  %6.2f MB/秒' % (name, speeds[name], speeds[name] * size / len(samples) / 2 ** 20))
+    print('lxml 为 bs4 的 %.1f 倍' % (speeds['lxml'] / speeds['bs4']))
+    sys.exit(1 if mismatches else 0)
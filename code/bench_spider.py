@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+"""
+爬虫吞吐基准：在本地启动一个模拟 chinanews 的 HTTP 服务，用 spider.chinanews.com.py 抓取
+
+模拟站点有若干天的滚动新闻页和对应的新闻页，每个请求固定延迟若干毫秒；
+其中一部分新闻第一次请求返回 503（检验退避重试），一部分 404、没有正文、正文过短、
+不含“编辑”或属于图片频道（检验过滤）。依次用串行（1 个连接、主线程解析）和并发配置抓取，
+检查两次写出的 XML 完全相同，并输出每秒抓取页数、建立的 TCP 连接数与重试次数。
+最后带抓取边界（frontier.py）连续抓取两轮：第二轮站点多出一天的新闻、改动一篇旧新闻，
+应只下载新新闻，旧新闻以 ETag 条件请求得到 304，只有改动的那篇重写。
+
+用法（在 code 目录下）：
+    python bench_spider.py [天数] [每天新闻数] [请求延迟毫秒] [并发连接数]
+"""
+
+import hashlib
+import importlib.util
+import os
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from doc_store import DirectoryCorpus
+from frontier import Frontier
+
+spec = importlib.util.spec_from_file_location('spider_chinanews', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spider.chinanews.com.py'))
+spider = importlib.util.module_from_spec(spec)
+sys.modules['spider_chinanews'] = spider # 解析进程池按模块名找到 parse_news_page
+spec.loader.exec_module(spider)
+
+PARAGRAPH = '新华社记者报道，%s 相关部门负责人表示，将继续推进各项工作，保障人民群众生活，促进经济社会平稳健康发展。'
+
+
+def build_site(start, days, per_day):
+    """返回 {路径: (状态码, 内容)} 与第一次请求返回 503 的路径集合"""
+    pages = {}
+    flaky = set()
+    for d in range(days):
+        day = start + timedelta(days = d)
+        items = []
+        for k in range(per_day):
+            n = d * per_day + k
+            path = '/gn/%d/%02d-%02d/%d.shtml' % (day.year, day.month, day.day, 9000000 + n)
+            category = '图片' if n % 23 == 0 else '国内'
+            items.append('<li><div class="dd_lm">[<a href="/gn.shtml">%s</a>]</div>'
+                         '<div class="dd_bt"><a href="%s%s">第 %d 条新闻标题</a></div>'
+                         '<div class="dd_time">%d-%d %02d:%02d</div></li>'
+                         % (category, spider.ROOT, path, n, day.month, day.day, k % 24, k % 60))
+            paragraphs = ''.join('<p>%s</p>' % (PARAGRAPH % ('第 %d 段' % j)) for j in range(3 + n % 5))
+            if n % 13 != 0:
+                paragraphs += '<p>（编辑：张三）</p>'
+            if n % 17 == 0:
+                paragraphs = '<p>短讯。编辑</p>'
+            body = ('<html><head><script>var x = "<p>脚本</p>";</script></head><body>'
+                    '<div class="left_zw"><script>ad();</script>%s</div></body></html>' % paragraphs)
+            if n % 29 == 0:
+                body = '<html><body><div class="other">页面已删除</div></body></html>'
+            pages[path] = (404, b'not found') if n % 31 == 0 else (200, body.encode('utf-8'))
+            if n % 10 == 0:
+                flaky.add(path)
+        pages['/scroll-news/%s/news.shtml' % day.strftime('%Y/%m%d')] = (
+            200, ('<html><body><div class="content_list"><ul>%s<li></li></ul></div></body></html>' % ''.join(items)).encode('utf-8'))
+    return pages, flaky
+
+
+class Site(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, pages, flaky, latency):
+        super().__init__(('127.0.0.1', 0), Handler)
+        self.pages = pages
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.reset(flaky)
+
+    def reset(self, flaky):
+        self.flaky = set(flaky)
+        self.connections = 0
+        self.requests = 0
+        self.not_modified = 0
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.requests += 1
+            if self.path in self.server.flaky:
+                self.server.flaky.discard(self.path)
+                status, content = 503, b'busy'
+            else:
+                status, content = self.server.pages.get(self.path, (404, b'not found'))
+        etag = '"%s"' % hashlib.sha1(content).hexdigest()[:16]
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            with self.server.lock:
+                self.server.not_modified += 1
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        if status == 200:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(pages, flaky, latency):
+    """在后台线程中启动模拟站点，新闻页链接中的 spider.ROOT 换成本地地址，返回 (站点, 本地地址)"""
+    site = Site(pages, flaky, latency)
+    threading.Thread(target = site.serve_forever, daemon = True).start()
+    root = 'http://127.0.0.1:%d' % site.server_address[1]
+    for path, (status, content) in list(pages.items()):
+        pages[path] = (status, content.replace(spider.ROOT.encode(), root.encode()))
+    return site, root
+
+
+def crawl(site, root, start, days, out_dir, concurrency, parse_workers, flaky, frontier = None):
+    site.reset(flaky)
+    fetcher = spider.Fetcher(concurrency = concurrency, rate = 0, backoff = 0.05)
+    t0 = time.perf_counter()
+    news_pool = spider.get_news_pool(start, start + timedelta(days = days - 1), fetcher, root)
+    written = spider.crawl_news(news_pool, 140, out_dir, 'utf-8', fetcher, parse_workers, frontier)
+    elapsed = time.perf_counter() - t0
+    fetcher.close()
+    return news_pool, written, elapsed, fetcher
+
+
+if __name__ == '__main__':
+    days = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    per_day = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    latency = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.02
+    concurrency = int(sys.argv[4]) if len(sys.argv) > 4 else 8
+    start = date(2019, 8, 1)
+    pages, flaky = build_site(start, days + 1, per_day) # 最后一天只在抓取边界的第二轮出现
+    site, root = serve(pages, flaky, latency)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, conc, workers in (('串行', 1, 1), ('并发', concurrency, 0)):
+            out_dir = os.path.join(tmp, name) + os.sep
+            os.makedirs(out_dir)
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                news_pool, written, elapsed, fetcher = crawl(site, root, start, days, out_dir, conc, workers, flaky)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+            files = {f: open(out_dir + f, 'rb').read() for f in os.listdir(out_dir)}
+            results[name] = files
+            print('%s：%d 个连接并发，新闻 %d 条，写出 %d 篇，请求 %d 次（重试 %d，失败 %d），TCP 连接 %d 个，'
+                  '耗时 %.2fs，%.1f 页/秒'
+                  % (name, conc, len(news_pool), written, site.requests, fetcher.retried, fetcher.failures,
+                     site.connections, elapsed, site.requests / elapsed))
+    print('两次输出一致：%s' % (results['串行'] == results['并发']))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        out_dir = os.path.join(tmp, 'news') + os.sep
+        os.makedirs(out_dir)
+        frontier = Frontier(os.path.join(tmp, 'frontier.db'), DirectoryCorpus(out_dir))
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            rounds = []
+            for cycle in range(2):
+                if cycle == 1: # 改动第一篇新闻，并多抓一天
+                    path = next(p for p in sorted(pages) if p.startswith('/gn/') and pages[p][0] == 200 and p not in flaky)
+                    pages[path] = (200, pages[path][1].replace('第 0 段'.encode(), '第〇段'.encode()))
+                news_pool, written, elapsed, fetcher = crawl(site, root, start, days + cycle, out_dir, concurrency, 0, set(), frontier)
+                changed = frontier.changed_docids()
+                frontier.clear_changed(changed)
+                rounds.append((len(news_pool), site.requests, site.not_modified, written, changed, elapsed))
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        for cycle, (n, requests, not_modified, written, changed, elapsed) in enumerate(rounds):
+            print('抓取边界第 %d 轮：新闻 %d 条，请求 %d 次（304 共 %d 次），写出 %d 篇（交给增量索引 %d 篇），耗时 %.2fs'
+                  % (cycle + 1, n, requests, not_modified, written, len(changed), elapsed))
+        frontier.close()
+    site.shutdown()
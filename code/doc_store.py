@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+新闻语料的存放方式
+
+DirectoryCorpus  每篇新闻一个 XML 文件（doc_dir_path），爬虫的默认输出
+DocStore         批量写入的文档库（doc_store_path），一张 SQLite 表代替成千上万个小文件：
+                     docs (name TEXT PRIMARY KEY, docid INTEGER, mtime REAL, data BLOB)
+                 name 沿用 <docid>.xml，data 是与 XML 文件逐字节相同的内容，
+                 因此 doc_state 中的文件名、内容 sha1 与分词缓存的键都不变，两种方式可以互相替换。
+                 写入先攒在内存里，commit() 时一个事务写入，mtime 为写入时间。
+
+PackedCorpus     打包的语料文件（doc_store_format = pack，见 packed_corpus.py），只追加的数据文件按块压缩，
+                 另有 docid 索引文件，适合顺序流式读取与按 docid 随机读取，也可与 XML 目录互相转换。
+
+三者提供同样的只读接口 names / exists / mtime / read，DocStore 与 PackedCorpus 另有 put / commit；
+IndexModule、RecommendationModule、检索端与抓取边界通过 open_corpus 按配置取得语料：
+配置了 doc_store_path 时读文档库或打包的语料，否则读 XML 目录。
+"""
+
+import os
+import sqlite3
+import time
+
+from packed_corpus import PackedCorpus
+
+DOCS_TABLE = '''CREATE TABLE IF NOT EXISTS docs
+                     (name TEXT PRIMARY KEY, docid INTEGER, mtime REAL, data BLOB)'''
+
+
+class DirectoryCorpus:
+
+    def __init__(self, doc_dir_path):
+        self.doc_dir_path = doc_dir_path
+
+    def names(self):
+        return os.listdir(self.doc_dir_path)
+
+    def exists(self, name):
+        return os.path.exists(self.doc_dir_path + name)
+
+    def mtime(self, name):
+        return os.path.getmtime(self.doc_dir_path + name)
+
+    def read(self, name):
+        with open(self.doc_dir_path + name, 'rb') as f:
+            return f.read()
+
+
+class DocStore:
+    """连接在第一次使用时才建立，进程池 fork 出的子进程各自重新连接"""
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.pending = []
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, timeout = 60)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute(DOCS_TABLE)
+        return self.conn
+
+    def names(self):
+        return [r[0] for r in self.connect().execute('SELECT name FROM docs ORDER BY docid')]
+
+    def exists(self, name):
+        return self.connect().execute('SELECT 1 FROM docs WHERE name = ?', (name,)).fetchone() is not None
+
+    def mtime(self, name):
+        r = self.connect().execute('SELECT mtime FROM docs WHERE name = ?', (name,)).fetchone()
+        if r is None:
+            raise FileNotFoundError(name)
+        return r[0]
+
+    def read(self, name):
+        r = self.connect().execute('SELECT data FROM docs WHERE name = ?', (name,)).fetchone()
+        if r is None:
+            raise FileNotFoundError(name)
+        return r[0]
+
+    def put(self, name, docid, data):
+        self.pending.append((name, docid, time.time(), data))
+
+    def commit(self):
+        """把 put 的文档在一个事务中写入，返回写入篇数"""
+        n = len(self.pending)
+        if n:
+            self.connect().executemany('INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?)', self.pending)
+            self.conn.commit()
+            self.pending = []
+        return n
+
+    def close(self):
+        self.commit()
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def open_corpus(config):
+    """按配置段 config 返回语料：doc_store_path 非空时按 doc_store_format 为 DocStore（sqlite）或
+    PackedCorpus（pack），否则为 doc_dir_path 下的 XML 目录"""
+    if config.get('doc_store_path', ''):
+        if config.get('doc_store_format', 'sqlite') == 'pack':
+            return PackedCorpus(config['doc_store_path'], config.get('pack_compression', 'none'),
+                                config.getfloat('pack_block_kb', 64))
+        return DocStore(config['doc_store_path'])
+    return DirectoryCorpus(config['doc_dir_path'])
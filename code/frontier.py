@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+持久化的抓取边界（crawl frontier）
+
+记录抓取过的每个新闻 url：
+    frontier  (url TEXT PRIMARY KEY, docid INTEGER UNIQUE, etag TEXT, last_modified TEXT, hash TEXT, fetched REAL)
+    changed   (docid INTEGER PRIMARY KEY)
+docid 按 url 分配一次后不再变化，新闻总是写到 <docid>.xml；被过滤掉的页面 docid 为 NULL，只记校验信息。
+hash 是标题与正文的 sha1，重新抓到的内容没有变化时不重写文件。
+没有 ETag / Last-Modified 的 url 无法发条件请求，距上次抓取（fetched）超过 revisit_hours 小时后无条件重新抓取一次，
+内容未变时只更新 fetched；revisit_hours <= 0 表示这类 url 抓取一次后不再访问。
+changed 表记录自上次建索引以来写过的文件，增量索引只需处理这些文件（见 IndexModule.update_index），
+处理完后由调用方 clear_changed。
+
+url 查询前先过内存中的 Bloom 过滤器：绝大多数新 url 不必访问数据库；过滤器在打开时由库中的 url 重建，
+url 数超过容量时容量翻倍重建。
+frontier 为空而语料中已有新闻（引入 frontier 之前的抓取结果）时，先按这些文件登记 url 与 docid，
+避免新分配的 docid 覆盖已有文件。
+流水线（pipeline.py）中途崩溃时，已登记但还没写进文档库的 docid 由 reset 清除校验信息与 sha1，
+下次抓取时无条件重新下载并沿用原 docid。
+"""
+
+import hashlib
+import math
+import sqlite3
+import time
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+FRONTIER_TABLE = '''CREATE TABLE IF NOT EXISTS frontier
+                     (url TEXT PRIMARY KEY, docid INTEGER UNIQUE, etag TEXT,
+                     last_modified TEXT, hash TEXT, fetched REAL)'''
+CHANGED_TABLE = '''CREATE TABLE IF NOT EXISTS changed
+                     (docid INTEGER PRIMARY KEY)'''
+REVISIT_HOURS = 24
+
+
+def content_hash(title, body):
+    return hashlib.sha1(('%s\n%s' % (title, body)).encode('utf-8')).hexdigest()
+
+
+class BloomFilter:
+    """容量 capacity、误判率 error_rate 的 Bloom 过滤器，k 个位置由一次 blake2b 摘要的两半按双重哈希生成"""
+
+    def __init__(self, capacity, error_rate = 0.01):
+        self.capacity = max(1024, capacity)
+        self.bits = int(math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.k = max(1, round(self.bits / self.capacity * math.log(2)))
+        self.array = np.zeros((self.bits + 7) // 8, dtype = np.uint8)
+        self.count = 0
+
+    def positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size = 16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.k)]
+
+    def add(self, key):
+        for p in self.positions(key):
+            self.array[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.array[p >> 3] & (1 << (p & 7)) for p in self.positions(key))
+
+
+class Frontier:
+
+    def __init__(self, path, corpus = None, revisit_hours = REVISIT_HOURS):
+        self.revisit_hours = revisit_hours
+        self.conn = sqlite3.connect(path, timeout = 60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute(FRONTIER_TABLE)
+        self.conn.execute(CHANGED_TABLE)
+        self.conn.commit()
+        self.bloom_negatives = 0 # Bloom 过滤器直接判定为新 url、未查数据库的次数
+        self.lookups = 0
+        if corpus is not None and self.size() == 0:
+            self.seed(corpus)
+        self.rebuild_bloom()
+
+    def size(self):
+        return self.conn.execute('SELECT count(*) FROM frontier').fetchone()[0]
+
+    def rebuild_bloom(self, capacity = None):
+        n = self.size()
+        self.bloom = BloomFilter(capacity or 2 * n)
+        for (url,) in self.conn.execute('SELECT url FROM frontier'):
+            self.bloom.add(url)
+
+    def seed(self, corpus):
+        """按语料（doc_store.open_corpus）中已有的 XML 登记 url 与 docid"""
+        return self.register(corpus, corpus.names())
+
+    def register(self, corpus, names):
+        """登记语料中 names 这些新闻的 url 与 docid，已登记的 url 不变"""
+        rows = []
+        for i in names:
+            root = ET.fromstring(corpus.read(i))
+            rows.append((root.find('url').text, int(root.find('id').text), None, None,
+                         content_hash(root.find('title').text, root.find('body').text), corpus.mtime(i)))
+        self.conn.executemany('INSERT OR IGNORE INTO frontier VALUES (?, ?, ?, ?, ?, ?)', rows)
+        self.conn.commit()
+        return len(rows)
+
+    def lookup(self, url):
+        """返回 (docid, etag, last_modified, hash, fetched)，未见过的 url 返回 None"""
+        self.lookups += 1
+        if url not in self.bloom:
+            self.bloom_negatives += 1
+            return None
+        return self.conn.execute('SELECT docid, etag, last_modified, hash, fetched FROM frontier WHERE url = ?',
+                                 (url,)).fetchone()
+
+    def skip(self, entry, now = None):
+        """已抓取过、且无法用条件请求确认是否变化的 url，距上次抓取不到 revisit_hours 时不再抓取；
+        reset 过的记录（有 docid 而无 sha1）除外"""
+        if entry is None or self.conditional_headers(entry) is not None or (entry[0] is not None and entry[3] is None):
+            return False
+        if self.revisit_hours <= 0 or entry[4] is None:
+            return True
+        return (now if now is not None else time.time()) - entry[4] < self.revisit_hours * 3600
+
+    def conditional_headers(self, entry):
+        """按上次响应的 ETag / Last-Modified 生成条件请求头，没有校验信息时返回 None"""
+        headers = {}
+        if entry[1]:
+            headers['If-None-Match'] = entry[1]
+        if entry[2]:
+            headers['If-Modified-Since'] = entry[2]
+        return headers or None
+
+    def record(self, url, docid, etag, last_modified, h):
+        if url not in self.bloom:
+            if self.bloom.count >= self.bloom.capacity:
+                self.rebuild_bloom(2 * self.bloom.capacity)
+            self.bloom.add(url)
+        self.conn.execute('''INSERT INTO frontier VALUES (?, ?, ?, ?, ?, ?)
+                             ON CONFLICT(url) DO UPDATE SET docid = coalesce(excluded.docid, docid),
+                             etag = excluded.etag, last_modified = excluded.last_modified,
+                             hash = coalesce(excluded.hash, hash), fetched = excluded.fetched''',
+                          (url, docid, etag, last_modified, h, time.time()))
+
+    def reset(self, docids):
+        """清除这些 docid 的校验信息与 sha1，下次抓取时无条件重新下载"""
+        self.conn.executemany('UPDATE frontier SET etag = NULL, last_modified = NULL, hash = NULL WHERE docid = ?',
+                              [(docid,) for docid in docids])
+        self.conn.commit()
+
+    def allocate(self):
+        """分配一个新的 docid"""
+        return self.conn.execute('SELECT coalesce(max(docid), 0) + 1 FROM frontier').fetchone()[0]
+
+    def mark_changed(self, docid):
+        self.conn.execute('INSERT OR IGNORE INTO changed VALUES (?)', (docid,))
+
+    def docids(self):
+        return set(r[0] for r in self.conn.execute('SELECT docid FROM frontier WHERE docid IS NOT NULL'))
+
+    def changed_docids(self):
+        return [r[0] for r in self.conn.execute('SELECT docid FROM changed ORDER BY docid')]
+
+    def changed_files(self):
+        """自上次 clear_changed 以来写过的新闻文件名"""
+        return ['%d.xml' % docid for docid in self.changed_docids()]
+
+    def clear_changed(self, docids):
+        self.conn.executemany('DELETE FROM changed WHERE docid = ?', [(docid,) for docid in docids])
+        self.conn.commit()
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
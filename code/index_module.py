@@ -5,34 +5,103 @@ Created on Sat Dec  5 23:31:22 2015
 @author: bitjoy.net
 """
 
-from os import listdir
+from concurrent.futures import ProcessPoolExecutor
+from array import array
+import os
+import sys
+import math
+import heapq
+import struct
+import hashlib
+import tempfile
+import time
 import xml.etree.ElementTree as ET
-import jieba
 import sqlite3
 import configparser
+import threading
+import numpy as np
+from postings_codec import POSTINGS_TABLE, TERMS_TABLE, SEGMENTS_TABLE, DATETIME_FORMAT, bm25_idf, postings_row, decode_postings, datetime_to_epoch
+from mmap_index import write_mmap_index
+from token_cache import TokenCache
+from doc_store import open_corpus
+
+# 每篇已索引文档的状态：文件名、mtime、内容 sha1、文档长度、发布时间、包含的词项（'\n' 分隔）
+# 以及存活版本所在的段，增量更新时据此判断文件是否变化，并扣减旧版本词项的 df
+DOC_STATE_TABLE = '''CREATE TABLE doc_state
+                     (docid INTEGER PRIMARY KEY, file TEXT, mtime REAL, hash TEXT,
+                     ld INTEGER, ts INTEGER, terms TEXT, segment INTEGER)'''
+# 文档库：结果页与正文页直接按 docid 批量读取，不再逐篇解析 XML
+DOCUMENTS_TABLE = '''CREATE TABLE documents
+                     (id INTEGER PRIMARY KEY, url TEXT, title TEXT, datetime TEXT, snippet TEXT, body TEXT)'''
+SNIPPET_LENGTH = 120
+# 已删除或已被新版本取代的文档在旧段中的记录，检索时过滤，段合并时清除
+TOMBSTONES_TABLE = '''CREATE TABLE tombstones
+                     (segment INTEGER, docid INTEGER, PRIMARY KEY (segment, docid))'''
+# 全局统计量 N、total_l、avg_l 与索引代数 generation，每次构建或增量更新后 generation 加一
+STATS_TABLE = '''CREATE TABLE IF NOT EXISTS stats
+                     (key TEXT PRIMARY KEY, value REAL)'''
+# 流式构建时溢写到磁盘的有序段（run）中每个词项的记录头：词项的 utf-8 字节数、postings 条数，
+# 其后是词项本身和 n 组 int64 (docid, tf, ld, ts)
+RUN_RECORD = struct.Struct('<HI')
 
 class Doc:
-    docid = 0
-    date_time = ''
-    tf = 0
-    ld = 0
+    """一条 postings 记录的轻量视图，仅为兼容保留；倒排表本身存放在 PostingsList 的类型化数组中"""
+    __slots__ = ('docid', 'ts', 'tf', 'ld')
     def __init__(self, docid, date_time, tf, ld):
         self.docid = docid
-        self.date_time = date_time
+        self.ts = datetime_to_epoch(date_time) if isinstance(date_time, str) else date_time
         self.tf = tf
         self.ld = ld
+    @property
+    def date_time(self):
+        return time.strftime(DATETIME_FORMAT, time.gmtime(self.ts))
     def __repr__(self):
         return(str(self.docid) + '\t' + self.date_time + '\t' + str(self.tf) + '\t' + str(self.ld))
     def __str__(self):
         return(str(self.docid) + '\t' + self.date_time + '\t' + str(self.tf) + '\t' + str(self.ld))
 
+class PostingsList(array):
+    """一个词项的倒排记录，按 (docid, tf, ld, ts) 交错存放在一个 int64 array 中。
+
+    比每条记录一个对象省数倍内存，跨进程传递时也只需序列化一段连续内存；
+    迭代或下标访问时返回 Doc 视图。
+    """
+    __slots__ = ()
+    def __new__(cls, *args):
+        return super().__new__(cls, 'q', *args)
+    def add(self, docid, tf, ld, ts):
+        self.extend((docid, tf, ld, ts))
+    def columns(self):
+        """以 NumPy 数组视图（不复制）返回 (docid, tf, ld, ts) 四列"""
+        return tuple(np.frombuffer(self, dtype = np.int64).reshape(-1, 4).T)
+    def __len__(self):
+        return super().__len__() // 4
+    def __getitem__(self, i):
+        if i < 0:
+            i = i + len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('postings index out of range')
+        return Doc(*(super(PostingsList, self).__getitem__(4 * i + j) for j in (0, 3, 1, 2)))
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+    def __reduce__(self):
+        return PostingsList, (self.tobytes(),)
+
 class IndexModule:
     stop_words = set()
     postings_lists = {}
+    docs = []
+    documents = []
+    total_l = 0
     
     config_path = ''
     config_encoding = ''
     
+    TOMBSTONE_RATIO = 0.3 # 段内墓碑超过该段文档数的这一比例时单独重写该段
+    POSTING_BYTES = 32 # 流式构建缓冲区中每条 postings 占用内存的估计值（4 个 int64）
+    TERM_BYTES = 200 # 缓冲区中每个词项的额外开销估计值（字典项、词项字符串、array 对象）
+    
     def __init__(self, config_path, config_encoding):
         self.config_path = config_path
         self.config_encoding = config_encoding
@@ -41,6 +110,8 @@ class IndexModule:
         f = open(config['DEFAULT']['stop_words_path'], encoding = config['DEFAULT']['stop_words_encoding'])
         words = f.read()
         self.stop_words = set(words.split('\n'))
+        self.token_cache = TokenCache(config['DEFAULT'].get('token_cache_path', ''))
+        self.corpus = open_corpus(config['DEFAULT'])
 
     def is_number(self, s):
         try:
@@ -62,53 +133,475 @@ class IndexModule:
                     cleaned_dict[i] = 1
         return n, cleaned_dict
     
+    def connect(self, db_path):
+        """写端连接：WAL 模式下合并与增量写入不会阻塞检索端的只读连接"""
+        conn = sqlite3.connect(db_path, timeout = 60)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def create_tables(self, c):
+        """删除旧索引并建空表，返回旧索引的代数"""
+        generation = self.read_stats(c)[2]
+        for table in ('postings', 'terms', 'segments', 'doc_state', 'tombstones', 'documents'):
+            c.execute('DROP TABLE IF EXISTS %s' % table)
+        c.execute(POSTINGS_TABLE)
+        c.execute(TERMS_TABLE)
+        c.execute(SEGMENTS_TABLE)
+        c.execute(DOC_STATE_TABLE)
+        c.execute(TOMBSTONES_TABLE)
+        c.execute(DOCUMENTS_TABLE)
+        return generation
+
     def write_postings_to_db(self, db_path):
-        conn = sqlite3.connect(db_path)
+        """全量写出索引，所有文档构成段 1"""
+        conn = self.connect(db_path)
         c = conn.cursor()
-        
-        c.execute('''DROP TABLE IF EXISTS postings''')
-        c.execute('''CREATE TABLE postings
-                     (term TEXT PRIMARY KEY, df INTEGER, docs TEXT)''')
+        generation = self.create_tables(c)
 
-        for key, value in self.postings_lists.items():
-            doc_list = '\n'.join(map(str,value[1]))
-            t = (key, value[0], doc_list)
-            c.execute("INSERT INTO postings VALUES (?, ?, ?)", t)
+        n_postings = self.write_segment(c, 1, self.postings_lists)
+        N = len(self.docs)
+        c.executemany("INSERT INTO terms VALUES (?, ?, ?)",
+                      [(key, value[0], bm25_idf(N, value[0])) for key, value in self.postings_lists.items()])
+        c.execute("INSERT INTO segments VALUES (?, ?, ?)", (1, len(self.docs), n_postings))
+        c.executemany("INSERT INTO doc_state VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [d + (1,) for d in self.docs])
+        c.executemany("INSERT INTO documents VALUES (?, ?, ?, ?, ?, ?)", self.documents)
+        self.write_stats(c, len(self.docs), self.total_l, generation + 1)
 
         conn.commit()
         conn.close()
-    
-    def construct_postings_lists(self):
-        config = configparser.ConfigParser()
-        config.read(self.config_path, self.config_encoding)
-        files = listdir(config['DEFAULT']['doc_dir_path'])
-        AVG_L = 0
+
+    def write_segment(self, c, segment, postings_lists):
+        """把倒排表写成一个段，返回记录数"""
+        n = 0
+        for key, value in postings_lists.items():
+            t = postings_row(key, *value[1].columns())
+            c.execute("INSERT INTO postings VALUES (?, ?, ?, ?, ?, ?, ?)", t + (segment,))
+            n = n + t[1]
+        return n
+
+    def read_stats(self, c):
+        """读取 (N, total_l, generation)，没有 stats 表时返回全 0"""
+        c.execute(STATS_TABLE)
+        stats = dict(c.execute('''SELECT key, value FROM stats''').fetchall())
+        return int(stats.get('N', 0)), int(stats.get('total_l', 0)), int(stats.get('generation', 0))
+
+    def write_stats(self, c, N, total_l, generation):
+        avg_l = total_l / N if N > 0 else 0
+        c.executemany("INSERT OR REPLACE INTO stats VALUES (?, ?)",
+                      [('N', N), ('total_l', total_l), ('avg_l', avg_l), ('generation', generation)])
+
+    def index_files(self, files):
+        """对语料中的一组 XML 文件分词并建立部分倒排表。
+
+        返回 (postings_lists, 文档长度之和, 文档状态列表, 文档库记录列表)，
+        文档状态即 doc_state 表的一行，文档库记录即 documents 表的一行。
+        """
+        postings_lists = {}
+        total_l = 0
+        docs = []
+        documents = []
         for i in files:
-            root = ET.parse(config['DEFAULT']['doc_dir_path'] + i).getroot()
-            title = root.find('title').text
-            body = root.find('body').text
-            docid = int(root.find('id').text)
-            date_time = root.find('datetime').text
-            seg_list = jieba.lcut(title + '。' + body, cut_all=False)
-            
-            ld, cleaned_dict = self.clean_list(seg_list)
-            
-            AVG_L = AVG_L + ld
+            docid, date_time, ld, cleaned_dict, state, document = self.index_file(i)
+            total_l = total_l + ld
+            docs.append(state)
+            documents.append(document)
+            ts = state[5]
             
             for key, value in cleaned_dict.items():
-                d = Doc(docid, date_time, value, ld)
-                if key in self.postings_lists:
-                    self.postings_lists[key][0] = self.postings_lists[key][0] + 1 # df++
-                    self.postings_lists[key][1].append(d)
+                if key in postings_lists:
+                    postings_lists[key][0] = postings_lists[key][0] + 1 # df++
                 else:
-                    self.postings_lists[key] = [1, [d]] # [df, [Doc]]
+                    postings_lists[key] = [1, PostingsList()] # [df, PostingsList]
+                postings_lists[key][1].add(docid, value, ld, ts)
+        self.token_cache.flush()
+        return postings_lists, total_l, docs, documents
+
+    def index_file(self, i):
+        """对一个 XML 文件分词（词序列优先取自分词缓存），返回 (docid, 发布时间, 文档长度, {词项: tf}, doc_state 行, documents 行)"""
+        mtime = self.corpus.mtime(i)
+        data = self.corpus.read(i)
+        root = ET.fromstring(data)
+        title = root.find('title').text
+        body = root.find('body').text
+        docid = int(root.find('id').text)
+        date_time = root.find('datetime').text
+        h = hashlib.sha1(data).hexdigest()
+        seg_list = self.token_cache.tokens(docid, h, title, body)
+        
+        ld, cleaned_dict = self.clean_list(seg_list)
+        state = (docid, i, mtime, h, ld,
+                 datetime_to_epoch(date_time), '\n'.join(cleaned_dict))
+        snippet = (body[0:SNIPPET_LENGTH] + '……') if body else ''
+        document = (docid, root.find('url').text, title, date_time, snippet, body)
+        return docid, date_time, ld, cleaned_dict, state, document
+
+    def merge_postings_lists(self, partial):
+        """按文件顺序把部分倒排表并入 self.postings_lists，词项与记录的先后次序和串行构建相同"""
+        for key, value in partial.items():
+            if key in self.postings_lists:
+                self.postings_lists[key][0] = self.postings_lists[key][0] + value[0]
+                self.postings_lists[key][1].extend(value[1])
+            else:
+                self.postings_lists[key] = value
+
+    def construct_postings_lists(self, workers = None):
+        """建立倒排索引。
+
+        workers 为并行分词的进程数，默认读取配置 index_workers（0 表示 CPU 核数，1 为串行）。
+        并行时文件列表按原顺序切成连续的分片，各进程返回部分倒排表后按分片顺序合并，
+        因此写出的索引与串行构建逐字节相同。
+        配置了 index_memory_mb 时改用内存有界的流式构建（见 construct_postings_lists_streaming）。
+        返回建入索引的文档数。
+        """
+        config = configparser.ConfigParser()
+        config.read(self.config_path, self.config_encoding)
+        memory_mb = config['DEFAULT'].getfloat('index_memory_mb', 0)
+        if memory_mb > 0:
+            return self.construct_postings_lists_streaming(memory_mb)['docs']
+        files = self.corpus.names()
+        if workers is None:
+            workers = config['DEFAULT'].getint('index_workers', 1)
+        if workers <= 0:
+            workers = os.cpu_count() or 1
+        AVG_L = 0
+        self.postings_lists = {}
+        self.docs = []
+        self.documents = []
+        if workers == 1:
+            partial, AVG_L, self.docs, self.documents = self.index_files(files)
+            self.merge_postings_lists(partial)
+        else:
+            size = max(1, math.ceil(len(files) / (workers * 4)))
+            shards = [files[i:i + size] for i in range(0, len(files), size)]
+            with ProcessPoolExecutor(max_workers = workers) as executor:
+                jobs = [executor.submit(_index_shard, self.config_path, self.config_encoding, shard)
+                        for shard in shards]
+                for job in jobs:
+                    partial, total_l, docs, documents = job.result()
+                    self.merge_postings_lists(partial)
+                    self.docs.extend(docs)
+                    self.documents.extend(documents)
+                    AVG_L = AVG_L + total_l
+        self.total_l = AVG_L
         AVG_L = AVG_L / len(files)
         config.set('DEFAULT', 'N', str(len(files)))
         config.set('DEFAULT', 'avg_l', str(AVG_L))
         with open(self.config_path, 'w', encoding = self.config_encoding) as configfile:
             config.write(configfile)
         self.write_postings_to_db(config['DEFAULT']['db_path'])
+        self.export_index(config)
+        return len(files)
+
+    def construct_postings_lists_streaming(self, memory_mb = None):
+        """内存有界的流式全量构建，返回溢写统计。
+
+        逐篇分词产生 (term, docid, tf, ld, ts)，按词项缓存在 PostingsList 中，估计占用达到 memory_mb 时
+        按词项排序写成一个有序 run 文件并清空缓冲区；全部文档处理完后对各 run 做 k 路归并，
+        逐个词项写入 postings。内存中同时只有一个缓冲区和每个 run 的当前记录，峰值与语料规模无关。
+        doc_state 行边分词边写入数据库，整个构建仍是一个事务，写出的索引内容与内存构建相同。
+        """
+        config = configparser.ConfigParser()
+        config.read(self.config_path, self.config_encoding)
+        db_path = config['DEFAULT']['db_path']
+        if memory_mb is None:
+            memory_mb = config['DEFAULT'].getfloat('index_memory_mb', 64)
+        budget = memory_mb * 1024 * 1024
+        stats = {'docs': 0, 'postings': 0, 'terms': 0, 'runs': 0, 'spilled_bytes': 0, 'peak_buffer_bytes': 0}
+
+        conn = self.connect(db_path)
+        c = conn.cursor()
+        generation = self.create_tables(c)
+        total_l = 0
+        with tempfile.TemporaryDirectory(prefix = 'index-runs-', dir = os.path.dirname(os.path.abspath(db_path))) as tmp:
+            runs = []
+            buffer = {}
+            used = 0
+            for i in self.corpus.names():
+                docid, date_time, ld, cleaned_dict, state, document = self.index_file(i)
+                ts = state[5]
+                c.execute("INSERT INTO doc_state VALUES (?, ?, ?, ?, ?, ?, ?, ?)", state + (1,))
+                c.execute("INSERT INTO documents VALUES (?, ?, ?, ?, ?, ?)", document)
+                total_l = total_l + ld
+                stats['docs'] = stats['docs'] + 1
+                for key, value in cleaned_dict.items():
+                    postings = buffer.get(key)
+                    if postings is None:
+                        postings = buffer[key] = PostingsList()
+                        used = used + self.TERM_BYTES
+                    postings.add(docid, value, ld, ts)
+                    used = used + self.POSTING_BYTES
+                stats['peak_buffer_bytes'] = max(stats['peak_buffer_bytes'], used)
+                if used >= budget:
+                    runs.append(self.spill_run(tmp, len(runs), buffer, stats))
+                    buffer = {}
+                    used = 0
+            if len(buffer) > 0 or len(runs) == 0:
+                runs.append(self.spill_run(tmp, len(runs), buffer, stats))
+            buffer = None
+            self.token_cache.flush()
+
+            n_postings = 0
+            files = [open(run, 'rb') for run in runs]
+            try:
+                streams = [self.read_run(f) for f in files]
+                term = None
+                parts = []
+                for key, postings in heapq.merge(*streams, key = lambda r: r[0]):
+                    if key != term and term is not None:
+                        n_postings = n_postings + self.write_term(c, term, parts, stats['docs'])
+                        parts = []
+                    term = key
+                    parts.append(postings)
+                if term is not None:
+                    n_postings = n_postings + self.write_term(c, term, parts, stats['docs'])
+            finally:
+                for f in files:
+                    f.close()
+        stats['postings'] = n_postings
+        stats['terms'] = c.execute("SELECT count(*) FROM terms").fetchone()[0]
+        c.execute("INSERT INTO segments VALUES (?, ?, ?)", (1, stats['docs'], n_postings))
+        self.write_stats(c, stats['docs'], total_l, generation + 1)
+        conn.commit()
+        conn.close()
+
+        self.total_l = total_l
+        config.set('DEFAULT', 'N', str(stats['docs']))
+        config.set('DEFAULT', 'avg_l', str(total_l / stats['docs'] if stats['docs'] > 0 else 0))
+        with open(self.config_path, 'w', encoding = self.config_encoding) as configfile:
+            config.write(configfile)
+        self.export_index(config)
+        return stats
+
+    def spill_run(self, tmp, n, buffer, stats):
+        """把缓冲区按词项排序写成第 n 个 run 文件，返回文件路径"""
+        path = os.path.join(tmp, 'run-%06d' % n)
+        with open(path, 'wb') as f:
+            for key in sorted(buffer):
+                term = key.encode('utf-8')
+                postings = buffer[key]
+                f.write(RUN_RECORD.pack(len(term), len(postings)))
+                f.write(term)
+                postings.tofile(f)
+        stats['runs'] = stats['runs'] + 1
+        stats['spilled_bytes'] = stats['spilled_bytes'] + os.path.getsize(path)
+        return path
+
+    def read_run(self, f):
+        """顺序读取一个 run 文件，逐个产生 (term, int64 数组 [docid, tf, ld, ts, ...])"""
+        while True:
+            header = f.read(RUN_RECORD.size)
+            if len(header) < RUN_RECORD.size:
+                return
+            length, n = RUN_RECORD.unpack(header)
+            term = f.read(length).decode('utf-8')
+            yield term, np.fromfile(f, dtype = np.int64, count = 4 * n)
+
+    def write_term(self, c, term, parts, N):
+        """把一个词项在各 run 中的记录合并写入段 1，返回记录数；N 为文档总数，用于计算 idf"""
+        postings = np.concatenate(parts).reshape(-1, 4)
+        t = postings_row(term, postings[:, 0], postings[:, 1], postings[:, 2], postings[:, 3])
+        c.execute("INSERT INTO postings VALUES (?, ?, ?, ?, ?, ?, ?)", t + (1,))
+        c.execute("INSERT INTO terms VALUES (?, ?, ?)", (term, t[1], bm25_idf(N, t[1])))
+        return t[1]
+
+    def update_index(self, changed_files = None):
+        """增量更新索引，新增或内容有变化的 XML 文件写成一个新段。
+
+        文件先按 (文件名, mtime) 判断是否变化，mtime 变了再比较内容 sha1。
+        changed_files 为 None 时扫描整个语料；给出文件名列表（如抓取边界记录的 Frontier.changed_files()）时
+        只检查这些文件，其中已不存在的视为删除，其余文件不再逐个 stat。
+        旧段不可变：内容变化或已删除的文档只在其旧段上记墓碑，并扣减 terms 表中的 df、N 与总长度；
+        墓碑记录由检索端过滤，在段合并时清除。新段、terms、N、avg_l 在同一个事务中提交，
+        提交后索引代数加一；段的合并由 merge_segments 另行完成（可放到后台线程）。
+        索引中还没有分段状态或文档库（首次构建或旧版索引）时退化为全量构建。
+        返回 (新增或更新的文档数, 删除的文档数)。
+        """
+        config = configparser.ConfigParser()
+        config.read(self.config_path, self.config_encoding)
+        db_path = config['DEFAULT']['db_path']
+        conn = self.connect(db_path)
+        c = conn.cursor()
+        if ('segment' not in [r[1] for r in c.execute('PRAGMA table_info(doc_state)')]
+                or c.execute("SELECT name FROM sqlite_master WHERE name = 'documents'").fetchone() is None):
+            conn.close()
+            return self.construct_postings_lists(), 0
+
+        state = {}
+        by_file = {}
+        for docid, file, mtime, h, ld, terms, segment in c.execute(
+                '''SELECT docid, file, mtime, hash, ld, terms, segment FROM doc_state'''):
+            state[docid] = (file, mtime, h, ld, terms, segment)
+            by_file[file] = docid
+        seen = set()
+        changed = []
+        missing = []
+        for i in (self.corpus.names() if changed_files is None else changed_files):
+            docid = by_file.get(i)
+            if changed_files is not None and not self.corpus.exists(i):
+                if docid is not None:
+                    missing.append(docid)
+                continue
+            if docid is not None:
+                mtime = self.corpus.mtime(i)
+                if state[docid][1] == mtime:
+                    seen.add(docid)
+                    continue
+                if hashlib.sha1(self.corpus.read(i)).hexdigest() == state[docid][2]:
+                    c.execute("UPDATE doc_state SET mtime = ? WHERE docid = ?", (mtime, docid))
+                    seen.add(docid)
+                    continue
+            changed.append(i)
+        partial, added_l, docs, documents = self.index_files(changed)
+        seen.update(d[0] for d in docs)
+        if changed_files is None:
+            deleted = [docid for docid in state if docid not in seen]
+        else:
+            deleted = missing
+        if len(docs) == 0 and len(deleted) == 0:
+            conn.commit()
+            conn.close()
+            return 0, 0
+
+        N, total_l, generation = self.read_stats(c)
+        if 'idf' not in [r[1] for r in c.execute('PRAGMA table_info(terms)')]: # 旧版词典，下面统一算出 idf
+            c.execute('ALTER TABLE terms ADD COLUMN idf REAL')
+        # 旧版本（内容变化）与已删除的文档：在旧段上记墓碑，扣减 df
+        stale = [d[0] for d in docs if d[0] in state] + deleted
+        for docid in stale:
+            file, mtime, h, ld, terms, segment = state[docid]
+            N = N - 1
+            total_l = total_l - ld
+            c.execute("INSERT OR IGNORE INTO tombstones VALUES (?, ?)", (segment, docid))
+            c.executemany("UPDATE terms SET df = df - 1 WHERE term = ?", [(t,) for t in terms.split('\n')])
+        c.execute("DELETE FROM terms WHERE df <= 0")
+        c.executemany("DELETE FROM doc_state WHERE docid = ?", [(docid,) for docid in deleted])
+        c.executemany("DELETE FROM documents WHERE id = ?", [(docid,) for docid in deleted])
+        self.token_cache.delete(deleted)
+
+        segment = c.execute("SELECT coalesce(max(id), 0) + 1 FROM segments").fetchone()[0]
+        n_postings = self.write_segment(c, segment, partial)
+        c.executemany('''INSERT INTO terms VALUES (?, ?, 0)
+                         ON CONFLICT(term) DO UPDATE SET df = df + excluded.df''',
+                      [(key, value[0]) for key, value in partial.items()])
+        if len(docs) > 0:
+            c.execute("INSERT INTO segments VALUES (?, ?, ?)", (segment, len(docs), n_postings))
+        c.executemany("INSERT OR REPLACE INTO doc_state VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [d + (segment,) for d in docs])
+        c.executemany("INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?)", documents)
+        N = N + len(docs)
+        total_l = total_l + added_l
+        # N 变了，所有词项的 idf 都要按新的 N 重算
+        conn.create_function('bm25_idf', 1, lambda df: bm25_idf(N, df), deterministic = True)
+        c.execute("UPDATE terms SET idf = bm25_idf(df)")
+        self.write_stats(c, N, total_l, generation + 1)
+        conn.commit()
+        conn.close()
+
+        config.set('DEFAULT', 'N', str(N))
+        config.set('DEFAULT', 'avg_l', str(total_l / N if N > 0 else 0))
+        with open(self.config_path, 'w', encoding = self.config_encoding) as configfile:
+            config.write(configfile)
+        self.export_index(config)
+        return len(docs), len(deleted)
+
+    def export_index(self, config):
+        """index_backend = mmap 时把当前索引导出为检索端使用的内存映射索引文件"""
+        if config['DEFAULT'].get('index_backend', 'sqlite') == 'mmap':
+            write_mmap_index(config['DEFAULT']['db_path'], config['DEFAULT']['mmap_index_path'])
+
+    def merge_policy(self, c, merge_factor):
+        """分层合并策略：返回下一批要合并的段 id，没有则返回 []。
+
+        段按存活文档数分层，第 t 层为 [merge_factor^t, merge_factor^(t+1))；
+        某层攒够 merge_factor 个段就整层合并成一个更大的段，因此段数不超过
+        (merge_factor - 1) * 层数。存活文档为 0 的段、墓碑比例过高的段单独重写以回收空间。
+        """
+        segments = c.execute('''SELECT s.id, s.docs, count(t.docid) FROM segments s
+                                LEFT JOIN tombstones t ON t.segment = s.id GROUP BY s.id ORDER BY s.id''').fetchall()
+        tiers = {}
+        for sid, docs, dead in segments:
+            live = docs - dead
+            if live <= 0 or dead > docs * self.TOMBSTONE_RATIO:
+                return [sid]
+            tiers.setdefault(int(math.log(live, merge_factor)), []).append(sid)
+        for tier in sorted(tiers):
+            if len(tiers[tier]) >= merge_factor:
+                return tiers[tier]
+        return []
+
+    def merge_segments(self, db_path = None, merge_factor = None):
+        """按 merge_policy 反复合并段，直到没有需要合并的段，返回合并次数。
+
+        每次合并是一个独立的短事务：读出这批段的全部记录，去掉墓碑，按词项合并成一个新段，
+        再删除旧段。合并不改变任何文档的得分，索引代数不变，检索端只读连接全程不受阻塞。
+        """
+        config = configparser.ConfigParser()
+        config.read(self.config_path, self.config_encoding)
+        if db_path is None:
+            db_path = config['DEFAULT']['db_path']
+        if merge_factor is None:
+            merge_factor = config['DEFAULT'].getint('merge_factor', 10)
+        conn = self.connect(db_path)
+        c = conn.cursor()
+        merges = 0
+        while True:
+            ids = self.merge_policy(c, merge_factor)
+            if len(ids) == 0:
+                break
+            self.merge_batch(c, ids)
+            conn.commit()
+            merges = merges + 1
+        conn.close()
+        return merges
+
+    def merge_batch(self, c, ids):
+        """把 ids 指定的段合并成一个新段"""
+        marks = ','.join('?' * len(ids))
+        dead = {}
+        for segment, docid in c.execute("SELECT segment, docid FROM tombstones WHERE segment IN (%s)" % marks, ids):
+            dead.setdefault(segment, []).append(docid)
+        segment = c.execute("SELECT coalesce(max(id), 0) + 1 FROM segments").fetchone()[0]
+        rows = c.execute("SELECT term, docs, segment FROM postings WHERE segment IN (%s) ORDER BY term, segment" % marks,
+                         ids).fetchall()
+        n_postings = 0
+        i = 0
+        while i < len(rows):
+            term = rows[i][0]
+            columns = []
+            while i < len(rows) and rows[i][0] == term:
+                cols = decode_postings(rows[i][1])
+                if rows[i][2] in dead:
+                    keep = ~np.isin(cols[0], dead[rows[i][2]])
+                    cols = [col[keep] for col in cols]
+                columns.append(cols)
+                i = i + 1
+            columns = [np.concatenate(col) for col in zip(*columns)]
+            if len(columns[0]) > 0:
+                t = postings_row(term, *columns)
+                c.execute("INSERT INTO postings VALUES (?, ?, ?, ?, ?, ?, ?)", t + (segment,))
+                n_postings = n_postings + t[1]
+        c.execute("DELETE FROM postings WHERE segment IN (%s)" % marks, ids)
+        c.execute("DELETE FROM tombstones WHERE segment IN (%s)" % marks, ids)
+        c.execute("DELETE FROM segments WHERE id IN (%s)" % marks, ids)
+        c.execute("UPDATE doc_state SET segment = ? WHERE segment IN (%s)" % marks, [segment] + list(ids))
+        live = c.execute("SELECT count(*) FROM doc_state WHERE segment = ?", (segment,)).fetchone()[0]
+        if live > 0:
+            c.execute("INSERT INTO segments VALUES (?, ?, ?)", (segment, live, n_postings))
+
+    def merge_in_background(self):
+        """在后台线程中合并段，返回已启动的线程；调用方可以继续做别的事，结束前 join 即可"""
+        t = threading.Thread(target = self.merge_segments, name = 'segment-merge')
+        t.start()
+        return t
+
+def _index_shard(config_path, config_encoding, files):
+    """子进程入口：对一个分片分词，返回部分倒排表"""
+    return IndexModule(config_path, config_encoding).index_files(files)
 
 if __name__ == "__main__":
     im = IndexModule('../config.ini', 'utf-8')
-    im.construct_postings_lists()
+    if len(sys.argv) > 1: # python index_module.py <内存上限 MB>：流式构建并输出溢写统计
+        stats = im.construct_postings_lists_streaming(float(sys.argv[1]))
+        print('文档 %(docs)d 篇，词项 %(terms)d 个，postings %(postings)d 条；'
+              '溢写 %(runs)d 个 run 共 %(spilled_bytes)d 字节，缓冲区峰值约 %(peak_buffer_bytes)d 字节' % stats)
+    else:
+        im.construct_postings_lists()
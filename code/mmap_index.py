@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+只读的内存映射索引文件
+
+把 ir.db 中各段的 postings 合并（去掉墓碑记录）后导出为一个文件，检索端用 mmap 打开：
+    头部      <8sIIqdqqq  魔数、版本、词项数、N、avg_l、索引代数、词项字符串区偏移、postings 区偏移
+    词典      每个词项一个定长 ENTRY（含 df 与建索引时算好的 idf），按词项的 utf-8 字节序排列，查询时二分查找
+    字符串区  所有词项的 utf-8 编码依次拼接
+    postings  每个词项的 postings BLOB 与跳表 BLOB（格式同 postings_codec），按 8 字节对齐
+postings 与跳表直接以 mmap 上的 memoryview 交给 decode_postings / decode_skips，
+tf、ld 列是 mmap 上的零拷贝 NumPy 视图，不经过 SQLite，也不复制到进程内存。
+多个检索进程（如 gunicorn 的多个 worker）映射同一个文件，共享操作系统页缓存中的同一份索引。
+
+文件整体写到临时文件后再原子替换，已打开旧文件的进程不受影响，下一次 sync 时切换到新文件，
+旧文件的映射在最后一个读取它的线程结束后关闭（见 MmapIndex.close）。
+    python mmap_index.py ../data/ir.db ../data/ir.idx
+"""
+
+import mmap
+import os
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+import threading
+
+import numpy as np
+
+from postings_codec import decode_postings, postings_row
+
+MAGIC = b'NSEIDX\x00\x01'
+VERSION = 2
+HEADER = struct.Struct('<8sIIqdqqq')
+ENTRY = np.dtype([('term_off', '<u8'), ('docs_off', '<u8'), ('skips_off', '<u8'),
+                  ('term_len', '<u4'), ('docs_len', '<u4'), ('skips_len', '<u4'),
+                  ('df', '<u4'), ('max_tf', '<u4'), ('min_ld', '<u4'), ('idf', '<f8')])
+ALIGN = 8
+
+
+def _merged_rows(c):
+    """按词项字节序逐个产生 (term, df, idf, docs, max_tf, min_ld, skips)，多个段的记录合并、墓碑记录去掉"""
+    tombstones = {}
+    for segment, docid in c.execute('SELECT segment, docid FROM tombstones'):
+        tombstones.setdefault(segment, []).append(docid)
+    rows = c.execute('''SELECT p.term, t.df, t.idf, p.docs, p.max_tf, p.min_ld, p.skips, p.segment
+                        FROM postings p JOIN terms t ON t.term = p.term ORDER BY p.term, p.segment''')
+    group = []
+    for r in rows:
+        if group and r[0] != group[0][0]:
+            yield _merge_group(group, tombstones)
+            group = []
+        group.append(r)
+    if group:
+        yield _merge_group(group, tombstones)
+
+
+def _merge_group(group, tombstones):
+    term, df, idf = group[0][:3]
+    if len(group) == 1 and group[0][7] not in tombstones:
+        return group[0][:7]
+    columns = []
+    for r in group:
+        cols = decode_postings(r[3])
+        if r[7] in tombstones:
+            keep = ~np.isin(cols[0], tombstones[r[7]])
+            cols = [col[keep] for col in cols]
+        columns.append(cols)
+    columns = [np.concatenate(col) for col in zip(*columns)]
+    if len(columns[0]) == 0:
+        return None
+    return (term, df, idf) + postings_row(term, *columns)[2:]
+
+
+def write_mmap_index(db_path, path):
+    """把 db_path 中的索引导出为内存映射索引文件 path，返回词项数"""
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    stats = dict(c.execute('SELECT key, value FROM stats').fetchall())
+    directory = os.path.dirname(os.path.abspath(path))
+    entries = []
+    strings = []
+    string_off = 0
+    with tempfile.TemporaryFile(dir = directory) as postings:
+        offset = 0
+        for row in _merged_rows(c):
+            if row is None:
+                continue
+            term, df, idf, docs, max_tf, min_ld, skips = row
+            term = term.encode('utf-8')
+            docs_off = offset
+            offset = offset + _write_aligned(postings, docs)
+            skips_off = offset
+            offset = offset + _write_aligned(postings, skips)
+            entries.append((string_off, docs_off, skips_off, len(term), len(docs), len(skips), df, max_tf, min_ld, idf))
+            strings.append(term)
+            string_off = string_off + len(term)
+        conn.close()
+
+        entries = np.array(entries, dtype = ENTRY)
+        strings = b''.join(strings)
+        strings_offset = HEADER.size + entries.nbytes
+        postings_offset = strings_offset + len(strings)
+        postings_offset = postings_offset + (-postings_offset) % ALIGN
+        fd, tmp = tempfile.mkstemp(dir = directory, prefix = os.path.basename(path) + '.')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(HEADER.pack(MAGIC, VERSION, len(entries), int(stats['N']), stats['avg_l'],
+                                    int(stats['generation']), strings_offset, postings_offset))
+                f.write(entries.tobytes())
+                f.write(strings)
+                f.write(b'\0' * (postings_offset - f.tell()))
+                postings.seek(0)
+                shutil.copyfileobj(postings, f)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, path)
+        except BaseException:
+            os.remove(tmp)
+            raise
+    return len(entries)
+
+
+def _write_aligned(f, blob):
+    f.write(blob)
+    pad = (-len(blob)) % ALIGN
+    f.write(b'\0' * pad)
+    return len(blob) + pad
+
+
+class MmapIndex:
+    """以 mmap 打开的只读索引，可被多个线程同时查询"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            self.identity = (st.st_ino, st.st_mtime_ns, st.st_size)
+            self.mm = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        self.buffer = memoryview(self.mm)
+        (magic, version, n_terms, self.N, self.avg_l, self.generation,
+         self.strings_offset, self.postings_offset) = HEADER.unpack_from(self.mm)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s 不是内存映射索引文件' % path)
+        self.entries = np.frombuffer(self.mm, dtype = ENTRY, count = n_terms, offset = HEADER.size)
+        self.term_off = self.entries['term_off'] + self.strings_offset
+        self.term_end = self.term_off + self.entries['term_len']
+        self._lock = threading.Lock()
+        self.readers = 0 # 正在 acquire 与 release 之间的读取次数
+        self.retired = False # 已调用 close，等最后一个读取结束
+        self.closed = False
+
+    def acquire(self):
+        """开始一次读取（find、lookup），索引已关闭时返回 False"""
+        with self._lock:
+            if self.closed:
+                return False
+            self.readers += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            self.readers -= 1
+            if self.retired and self.readers == 0:
+                self._close()
+
+    def close(self):
+        """关闭映射与文件；仍有线程在读取时推迟到最后一次 release"""
+        with self._lock:
+            self.retired = True
+            if self.readers == 0:
+                self._close()
+
+    def _close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.entries = self.term_off = self.term_end = None
+        try:
+            self.buffer.release()
+            self.mm.close()
+        except BufferError:
+            # 解码出的零拷贝视图（docs、tf、ld 列等）仍被引用，如正在排序的一次查询；
+            # mmap 不允许此时关闭，映射在这些视图释放后随 mmap 对象一起回收
+            pass
+
+    def changed(self):
+        """磁盘上的文件是否已被替换"""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return (st.st_ino, st.st_mtime_ns, st.st_size) != self.identity
+
+    def find(self, term):
+        """二分查找词项，返回其在词典中的下标，不存在时返回 -1"""
+        key = term.encode('utf-8')
+        mm = self.mm
+        lo, hi = 0, len(self.entries)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if mm[self.term_off[mid]:self.term_end[mid]] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.entries) and mm[self.term_off[lo]:self.term_end[lo]] == key:
+            return lo
+        return -1
+
+    def lookup(self, term):
+        """返回 (df, idf, [(docs, max_tf, min_ld, skips, None)])，docs 与 skips 是 mmap 上的 memoryview"""
+        i = self.find(term)
+        if i < 0:
+            return None
+        e = self.entries[i]
+        docs = self.postings_offset + int(e['docs_off'])
+        skips = self.postings_offset + int(e['skips_off'])
+        return int(e['df']), float(e['idf']), [(self.buffer[docs:docs + int(e['docs_len'])], int(e['max_tf']), int(e['min_ld']),
+                               self.buffer[skips:skips + int(e['skips_len'])], None)]
+
+
+if __name__ == '__main__':
+    db = sys.argv[1] if len(sys.argv) > 1 else '../data/ir.db'
+    out = sys.argv[2] if len(sys.argv) > 2 else '../data/ir.idx'
+    print('exported %d terms from %s to %s' % (write_mmap_index(db, out), db, out))
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+"""
+打包的新闻语料：一个只追加的数据文件加一个 docid 索引文件，代替成千上万个小 XML 文件
+
+数据文件 <path>       文件头 PACK_MAGIC，之后是一个接一个的块：
+                          块头 (codec, 压缩后长度, 原始长度, crc32)  + 块内容
+                      块内容解压后是若干条带长度前缀的记录：
+                          (docid, mtime, 长度) + 与 XML 文件逐字节相同的内容
+                      codec 为 0 不压缩、1 zlib、2 zstd（需要安装 zstandard）；每块原始大小约 block_kb KB，
+                      随机读取一篇只需解压它所在的一块
+索引文件 <path>.idx   文件头 INDEX_MAGIC，之后每条记录一项 (docid, 块偏移, 块内偏移, 长度, mtime)
+
+两个文件都只追加：同一 docid 再次写入时追加新记录，索引中靠后的一项生效。commit() 先写数据块并落盘，
+再追加索引项；打开时按索引找到最后一块的末尾，其后完整且校验正确的块（写完数据、还没写索引时崩溃）
+先在内存中补进索引，不完整的尾部截掉，两者都在下次 commit 时写入文件。
+只允许一个进程写入；读取的进程查不到 docid 时读入索引文件新追加的部分，可以看到写入进程此后 commit 的新闻。
+
+PackedCorpus 提供与 doc_store.DirectoryCorpus、DocStore 相同的接口 names / exists / mtime / read 与
+put / commit，文件名沿用 <docid>.xml，因此 doc_state、分词缓存与抓取边界都不变；另有 scan() 按文件顺序
+流式读出全部新闻，get(docid) 按 docid 随机读取。
+
+与 XML 目录互相转换（在 code 目录下）：
+    python packed_corpus.py pack <XML 目录> <数据文件> [none|zlib|zstd]
+    python packed_corpus.py unpack <数据文件> <XML 目录>
+"""
+
+import os
+import struct
+import sys
+import time
+import zlib
+from collections import OrderedDict
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+PACK_MAGIC = b'NSEPACK1'
+INDEX_MAGIC = b'NSEPIDX1'
+BLOCK = struct.Struct('<BIII')    # codec, 压缩后长度, 原始长度, 压缩后内容的 crc32
+RECORD = struct.Struct('<QdI')    # docid, mtime, 内容长度
+ENTRY = struct.Struct('<QQIId')   # docid, 块偏移, 块内偏移, 内容长度, mtime
+CODECS = {'none': 0, 'zlib': 1, 'zstd': 2}
+
+
+def compress(codec, raw):
+    if codec == 1:
+        return zlib.compress(raw, 6)
+    if codec == 2:
+        return zstandard.ZstdCompressor(level = 3).compress(raw)
+    return raw
+
+
+def decompress(codec, data, size):
+    if codec == 1:
+        return zlib.decompress(data)
+    if codec == 2:
+        if zstandard is None:
+            raise ValueError('语料使用 zstd 压缩，需要安装 zstandard')
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size = size)
+    return data
+
+
+class PackedCorpus:
+    """文件在第一次使用时才打开；读取都用 os.pread，不依赖文件位置，进程池 fork 出的子进程可以直接使用"""
+    CACHED_BLOCKS = 8 # 缓存最近解压的块数，按 docid 顺序逐篇读取时每块只解压一次
+
+    def __init__(self, path, compression = 'none', block_kb = 64):
+        if compression not in CODECS:
+            raise ValueError('不支持的压缩方式：%s' % compression)
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError('pack_compression = zstd 需要安装 zstandard')
+        self.path = path
+        self.index_path = path + '.idx'
+        self.codec = CODECS[compression]
+        self.block_size = int(block_kb * 1024)
+        self.fd = None
+        self.entries = {} # docid -> (块偏移, 块内偏移, 长度, mtime)
+        self.unindexed = [] # 数据文件中有、索引文件中还没有的索引项
+        self.index_size = 0 # 已读入的索引文件长度
+        self.end = 0 # 已核对过的最后一块的末尾
+        self.blocks = OrderedDict()
+        self.pending = []
+
+    def open(self):
+        if self.fd is None:
+            if not os.path.exists(self.path):
+                with open(self.path, 'wb') as f:
+                    f.write(PACK_MAGIC)
+            if not os.path.exists(self.index_path):
+                with open(self.index_path, 'wb') as f:
+                    f.write(INDEX_MAGIC)
+            self.fd = os.open(self.path, os.O_RDONLY)
+            if os.pread(self.fd, len(PACK_MAGIC), 0) != PACK_MAGIC:
+                raise ValueError('%s 不是打包的语料文件' % self.path)
+            self.end = len(PACK_MAGIC)
+            self.refresh()
+        return self.fd
+
+    def refresh(self):
+        """读入索引文件新追加的项，再把数据文件中已写完、尚未编入索引的块补进来"""
+        with open(self.index_path, 'rb') as f:
+            if self.index_size == 0:
+                if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                    raise ValueError('%s 不是打包语料的索引文件' % self.index_path)
+                self.index_size = len(INDEX_MAGIC)
+            f.seek(self.index_size)
+            data = f.read()
+        n = len(data) // ENTRY.size # 不完整的最后一项（正在写入）下次再读
+        last = None
+        for docid, block, offset, length, mtime in ENTRY.iter_unpack(data[:n * ENTRY.size]):
+            self.entries[docid] = (block, offset, length, mtime)
+            last = block
+        self.index_size += n * ENTRY.size
+        if last is not None:
+            self.unindexed = [e for e in self.unindexed if e[1] >= last]
+            # 崩溃时最后一块的索引项可能只写了一部分，从这一块起重新核对
+            self.end = max(self.end, last)
+        for block, records in self.read_blocks(self.end):
+            for docid, offset, length, mtime in records:
+                if self.entries.get(docid) != (block, offset, length, mtime):
+                    self.entries[docid] = (block, offset, length, mtime)
+                    self.unindexed.append((docid, block, offset, length, mtime))
+
+    def read_blocks(self, start):
+        """从 start 开始逐块读出数据文件，产生 (块偏移, [(docid, 块内偏移, 长度, mtime)])；
+        遇到不完整或校验失败的块时停止，self.end 为最后一个完整块的末尾"""
+        size = os.fstat(self.fd).st_size
+        while start + BLOCK.size <= size:
+            codec, stored, raw_size, crc = BLOCK.unpack(os.pread(self.fd, BLOCK.size, start))
+            data = os.pread(self.fd, stored, start + BLOCK.size)
+            if len(data) < stored or zlib.crc32(data) != crc:
+                break
+            raw = decompress(codec, data, raw_size)
+            self.cache(start, raw)
+            yield start, list(self.records(raw))
+            start = start + BLOCK.size + stored
+            self.end = start
+
+    def records(self, raw):
+        offset = 0
+        while offset < len(raw):
+            docid, mtime, length = RECORD.unpack_from(raw, offset)
+            offset += RECORD.size
+            yield docid, offset, length, mtime
+            offset += length
+
+    def cache(self, block, raw):
+        self.blocks[block] = raw
+        self.blocks.move_to_end(block)
+        if len(self.blocks) > self.CACHED_BLOCKS:
+            self.blocks.popitem(last = False)
+
+    def block(self, offset):
+        raw = self.blocks.get(offset)
+        if raw is None:
+            codec, stored, raw_size, crc = BLOCK.unpack(os.pread(self.fd, BLOCK.size, offset))
+            raw = decompress(codec, os.pread(self.fd, stored, offset + BLOCK.size), raw_size)
+            self.cache(offset, raw)
+        else:
+            self.blocks.move_to_end(offset)
+        return raw
+
+    def entry(self, docid):
+        self.open()
+        e = self.entries.get(docid)
+        if e is None:
+            self.refresh()
+            e = self.entries.get(docid)
+        return e
+
+    def get(self, docid):
+        """按 docid 读取一篇新闻的 XML 内容，没有时返回 None"""
+        e = self.entry(docid)
+        if e is None:
+            return None
+        block, offset, length, mtime = e
+        return self.block(block)[offset:offset + length]
+
+    def scan(self):
+        """按数据文件中的顺序流式产生 (docid, mtime, XML 内容)，被后写入的记录覆盖的旧版本跳过"""
+        self.open()
+        self.refresh()
+        current = dict(self.entries)
+        start = len(PACK_MAGIC)
+        while start < self.end:
+            raw = self.block(start)
+            for docid, offset, length, mtime in self.records(raw):
+                if current.get(docid) == (start, offset, length, mtime):
+                    yield docid, mtime, raw[offset:offset + length]
+            start = start + BLOCK.size + BLOCK.unpack(os.pread(self.fd, BLOCK.size, start))[1]
+
+    def __len__(self):
+        self.open()
+        return len(self.entries)
+
+    @staticmethod
+    def docid(name):
+        try:
+            return int(name.split('.')[0])
+        except ValueError:
+            return None
+
+    def names(self):
+        self.open()
+        self.refresh()
+        return ['%d.xml' % docid for docid in sorted(self.entries)]
+
+    def exists(self, name):
+        docid = self.docid(name)
+        return docid is not None and self.entry(docid) is not None
+
+    def mtime(self, name):
+        docid = self.docid(name)
+        e = self.entry(docid) if docid is not None else None
+        if e is None:
+            raise FileNotFoundError(name)
+        return e[3]
+
+    def read(self, name):
+        docid = self.docid(name)
+        data = self.get(docid) if docid is not None else None
+        if data is None:
+            raise FileNotFoundError(name)
+        return data
+
+    def put(self, name, docid, data, mtime = None):
+        self.pending.append((docid, time.time() if mtime is None else mtime, data))
+
+    def commit(self):
+        """把 put 的新闻按块压缩后追加到数据文件并落盘，再追加索引项，返回写入篇数"""
+        n = len(self.pending)
+        if n == 0:
+            return 0
+        self.open()
+        self.refresh()
+        entries = self.unindexed
+        with open(self.path, 'r+b') as f:
+            f.truncate(self.end) # 截掉上次崩溃留下的不完整块
+            f.seek(self.end)
+            i = 0
+            while i < n:
+                raw = bytearray()
+                records = []
+                while i < n and len(raw) < self.block_size:
+                    docid, mtime, data = self.pending[i]
+                    raw += RECORD.pack(docid, mtime, len(data))
+                    records.append((docid, len(raw), len(data), mtime))
+                    raw += data
+                    i += 1
+                stored = compress(self.codec, bytes(raw))
+                codec = self.codec
+                if len(stored) >= len(raw): # 压缩不划算时原样存放
+                    stored, codec = bytes(raw), 0
+                block = f.tell()
+                f.write(BLOCK.pack(codec, len(stored), len(raw), zlib.crc32(stored)))
+                f.write(stored)
+                entries.extend((docid, block, offset, length, mtime) for docid, offset, length, mtime in records)
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.index_path, 'ab') as f:
+            f.truncate(self.index_size) # 截掉不完整的索引项
+            f.write(b''.join(ENTRY.pack(*e) for e in entries))
+            f.flush()
+            os.fsync(f.fileno())
+        self.pending = []
+        self.unindexed = []
+        self.refresh()
+        return n
+
+    def close(self):
+        self.commit()
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = None
+
+
+def pack_corpus(source, corpus, batch = 1000):
+    """把语料 source（如 doc_store.DirectoryCorpus）中的全部新闻按 docid 顺序写入 PackedCorpus，
+    保留各自的 mtime，返回篇数"""
+    docs = []
+    for name in source.names():
+        docid = PackedCorpus.docid(name)
+        if docid is None or name != '%d.xml' % docid:
+            print('跳过 %s：文件名不是 <docid>.xml' % name)
+            continue
+        docs.append((docid, name))
+    n = 0
+    for docid, name in sorted(docs):
+        corpus.put(name, docid, source.read(name), source.mtime(name))
+        n += 1
+        if n % batch == 0:
+            corpus.commit()
+    corpus.commit()
+    return n
+
+
+def unpack_corpus(corpus, doc_dir_path):
+    """把 PackedCorpus 中的新闻写回 doc_dir_path 下的 <docid>.xml，并恢复 mtime，返回篇数"""
+    os.makedirs(doc_dir_path, exist_ok = True)
+    n = 0
+    for docid, mtime, data in corpus.scan():
+        path = os.path.join(doc_dir_path, '%d.xml' % docid)
+        with open(path, 'wb') as f:
+            f.write(data)
+        os.utime(path, (mtime, mtime))
+        n += 1
+    return n
+
+
+if __name__ == '__main__':
+    from doc_store import DirectoryCorpus
+    if len(sys.argv) >= 4 and sys.argv[1] == 'pack':
+        corpus = PackedCorpus(sys.argv[3], sys.argv[4] if len(sys.argv) > 4 else 'none')
+        t = time.time()
+        n = pack_corpus(DirectoryCorpus(os.path.join(sys.argv[2], '')), corpus)
+        corpus.close()
+        print('写入 %d 篇，数据文件 %d 字节，耗时 %.2fs' % (n, os.path.getsize(sys.argv[3]), time.time() - t))
+    elif len(sys.argv) == 4 and sys.argv[1] == 'unpack':
+        t = time.time()
+        n = unpack_corpus(PackedCorpus(sys.argv[2]), sys.argv[3])
+        print('写出 %d 篇，耗时 %.2fs' % (n, time.time() - t))
+    else:
+        print(__doc__)
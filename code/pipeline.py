@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""
+抓取到索引的流式流水线（setup.py pipeline）
+
+爬虫不再写 XML 文件，抓到的新闻经有界队列直接流向分词与建索引：
+
+    爬虫线程 --sink--> 有界队列 --> 分词进程池 --> 按批写入文档库（检查点） --> update_index 写成一个新段
+
+  背压    队列满时 sink 阻塞爬虫线程，抓取速度不会超过分词与建索引的速度，在途新闻数不超过
+          queue_size + batch_size；分词在进程池中与抓取重叠进行，结果写入分词缓存，
+          建索引时直接命中，不再分词
+  检查点  每攒够 batch_size 篇，先一次写入文档库（DocStore 或 PackedCorpus），再调用
+          update_index 把这一批写成一个新段；抓取边界（frontier.py）由爬虫线程照常记录 url、docid
+          与 changed 表，流水线结束后才清理 changed 表，运行期间不与爬虫争抢写锁
+  恢复    启动时先对齐三者：文档库中有、抓取边界中没有的新闻补登记 url；changed 表中
+          还没写进文档库的 docid 清除校验信息（reset），重新抓取并沿用原 docid；已写进文档库的
+          交给 update_index，已建过索引的按 sha1 判定未变化，不会重复入段。因此崩溃后重新运行
+          即从上次的检查点继续。
+
+文档库需要在配置中设置 doc_store_path（SQLite 文档库或打包的语料，见 doc_store_format）；
+索引、推荐与检索端此后都从文档库读取新闻。
+"""
+
+import configparser
+import hashlib
+import os
+import queue
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+from doc_store import DirectoryCorpus
+from frontier import REVISIT_HOURS, Frontier
+from index_module import IndexModule
+from token_cache import tokenize
+
+
+class CrawlPipeline:
+
+    def __init__(self, config_path, config_encoding, queue_size = None, batch_size = None, workers = None):
+        config = configparser.ConfigParser()
+        config.read(config_path, config_encoding)
+        config = config['DEFAULT']
+        self.im = IndexModule(config_path, config_encoding)
+        self.store = self.im.corpus
+        if isinstance(self.store, DirectoryCorpus):
+            raise ValueError('流水线模式需要在配置中设置 doc_store_path')
+        self.frontier_path = config['frontier_path']
+        self.revisit_hours = config.getfloat('crawl_revisit_hours', REVISIT_HOURS)
+        self.queue_size = queue_size or config.getint('pipeline_queue_size', 256)
+        self.batch_size = batch_size or config.getint('pipeline_batch_size', 200)
+        self.workers = workers if workers is not None else config.getint('index_workers', 1)
+        if self.workers <= 0:
+            self.workers = os.cpu_count() or 1
+        self.queue = queue.Queue(maxsize = self.queue_size)
+        self.stopped = False
+        self.stats = {'docs': 0, 'batches': 0, 'added': 0, 'blocked': 0, 'recovered': 0, 'reset': 0}
+
+    def sink(self, docid, name, data):
+        """爬虫线程中调用：把一篇新闻放入队列，队列满时阻塞（背压）；主线程出错后抛出异常使爬虫停止"""
+        if self.stopped:
+            raise RuntimeError('pipeline stopped')
+        if self.queue.full():
+            self.stats['blocked'] = self.stats['blocked'] + 1
+        self.queue.put((docid, name, data))
+
+    def recover(self, frontier):
+        """对齐抓取边界、文档库与索引，返回重新建索引的篇数"""
+        known = frontier.docids()
+        stored = self.store.names()
+        frontier.register(self.store, [i for i in stored if int(i.split('.')[0]) not in known])
+        stored = set(stored)
+        changed = frontier.changed_docids()
+        lost = [docid for docid in changed if '%d.xml' % docid not in stored]
+        frontier.reset(lost)
+        frontier.clear_changed(lost)
+        self.stats['reset'] = len(lost)
+        pending = [docid for docid in changed if '%d.xml' % docid in stored]
+        if pending:
+            self.im.update_index(['%d.xml' % docid for docid in pending])
+            frontier.clear_changed(pending)
+        self.stats['recovered'] = len(pending)
+        return len(pending)
+
+    def run(self, crawl):
+        """在生产者线程中执行 crawl(frontier, sink)，主线程分批分词、写文档库、建索引，返回统计信息"""
+        frontier = Frontier(self.frontier_path, self.store, self.revisit_hours)
+        self.recover(frontier)
+        errors = []
+
+        def produce():
+            f = Frontier(self.frontier_path, revisit_hours = self.revisit_hours) # sqlite 连接不能跨线程使用，爬虫线程单独打开
+            try:
+                crawl(f, self.sink)
+            except BaseException as e:
+                errors.append(e)
+            finally:
+                f.close()
+                self.queue.put(None)
+
+        segmenter = None
+        if self.workers > 1:
+            # fork 方式下进程池在第一次 submit 时一次 fork 出全部进程，必须在爬虫线程启动之前，
+            # 否则子进程可能继承其他线程持有的锁而卡死
+            segmenter = ProcessPoolExecutor(max_workers = self.workers)
+            segmenter.submit(int).result()
+        producer = threading.Thread(target = produce, name = 'crawl')
+        producer.start()
+        indexed = []
+        try:
+            batch = {}
+            while True:
+                item = self.queue.get()
+                if item is not None:
+                    docid, name, data = item
+                    root = ET.fromstring(data)
+                    title, body = root.find('title').text, root.find('body').text
+                    tokens = segmenter.submit(tokenize, title, body) if segmenter is not None else tokenize(title, body)
+                    batch[docid] = (name, data, tokens) # 同一 docid 在一批中出现两次时只保留最新的
+                if len(batch) >= self.batch_size or (item is None and batch):
+                    self.checkpoint(batch)
+                    indexed.extend(batch)
+                    batch = {}
+                if item is None:
+                    break
+        finally:
+            self.stopped = True
+            while producer.is_alive(): # 出错退出时排空队列，让阻塞在 sink 中的爬虫线程结束
+                try:
+                    self.queue.get(timeout = 0.1)
+                except queue.Empty:
+                    pass
+            producer.join()
+            if segmenter is not None:
+                segmenter.shutdown(cancel_futures = True)
+        frontier.clear_changed(indexed)
+        frontier.close()
+        if errors:
+            raise errors[0]
+        return self.stats
+
+    def checkpoint(self, batch):
+        """分词结果写入分词缓存，一批新闻在一个事务中写入文档库，再写成索引的一个新段"""
+        for docid, (name, data, tokens) in batch.items():
+            if not isinstance(tokens, list):
+                tokens = tokens.result()
+            self.im.token_cache.put(docid, hashlib.sha1(data).hexdigest(), tokens)
+            self.store.put(name, docid, data)
+        self.im.token_cache.flush()
+        self.store.commit()
+        added, deleted = self.im.update_index([name for name, data, tokens in batch.values()])
+        self.stats['docs'] = self.stats['docs'] + len(batch)
+        self.stats['added'] = self.stats['added'] + added
+        self.stats['batches'] = self.stats['batches'] + 1
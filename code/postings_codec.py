@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""
+倒排记录表（postings）的二进制编码
+
+每个词项的 postings 存成一个 BLOB，按 docid 升序，列式存放：
+    头部   <IBBBBq  记录数 n、docid 差值列宽、tf 列宽、ld 列宽、时间偏移列宽、时间基准
+    docid  差值编码（第一个值即 docid 本身）
+    tf     词频
+    ld     文档长度
+    ts     发布时间相对时间基准的偏移（秒）
+每列宽度取 1/2/4/8 字节中能放下该列最大值的最小者，小端存储，
+解码时直接 np.frombuffer 成 NumPy 数组，不再逐条 split / int / strptime。
+
+发布时间统一用 epoch 秒表示：把 XML 中的本地时间当作 UTC 墙上时间换算，
+与 datetime.now() 相减得到的小时数和原先 datetime 相减的结果一致。
+
+为支持 MaxScore 动态剪枝，每个词项还记录 BM25 上界所需的统计量：
+    max_tf / min_ld  整个 postings 的最大词频与最短文档长度
+    skips            每 BLOCK_SIZE 条记录一个跳表项 <III：块内最后一个 docid、最大 tf、最小 ld
+BM25 单项得分随 tf 单调增、随 ld 单调减，所以用 (max_tf, min_ld) 代入公式即得上界；
+上界在查询时结合当时的 N、avg_l 计算，增量更新统计量后依然有效。
+
+旧版 ir.db 中的 TEXT postings 仍可被 decode_postings 解析，
+也可以用 migrate_db 一次性转换成当前格式（单个段）：
+    python postings_codec.py ../data/ir.db
+"""
+
+import calendar
+import functools
+import math
+import sqlite3
+import struct
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+HEADER = struct.Struct('<IBBBBq')
+SKIP = np.dtype([('last', '<u4'), ('max_tf', '<u4'), ('min_ld', '<u4')])
+BLOCK_SIZE = 64
+
+# 索引由若干不可变的段组成，每段对每个词项至多一行；df 为该段内的记录数，全局 df 见 terms 表
+POSTINGS_TABLE = '''CREATE TABLE postings
+                     (term TEXT, df INTEGER, docs BLOB,
+                     max_tf INTEGER, min_ld INTEGER, skips BLOB, segment INTEGER,
+                     PRIMARY KEY (term, segment))'''
+# 全局词典：跨所有段、扣除已删除文档后的 df，以及按当前 N 算好的 BM25 idf 权重（见 bm25_idf）
+TERMS_TABLE = '''CREATE TABLE terms
+                     (term TEXT PRIMARY KEY, df INTEGER, idf REAL)'''
+# 存活的段：段内存活文档数与记录数，合并策略据此分层
+SEGMENTS_TABLE = '''CREATE TABLE segments
+                     (id INTEGER PRIMARY KEY, docs INTEGER, postings INTEGER)'''
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+EPOCH = datetime(1970, 1, 1)
+
+
+@functools.lru_cache(maxsize=65536)
+def datetime_to_epoch(date_time):
+    """'2025-11-23 23:52:00' -> epoch 秒（墙上时间按 UTC 换算）"""
+    return calendar.timegm(time.strptime(date_time, DATETIME_FORMAT))
+
+
+def now_epoch():
+    """当前本地时间对应的 epoch 秒，与 datetime_to_epoch 的换算方式一致"""
+    return (datetime.now() - EPOCH).total_seconds()
+
+
+def bm25_idf(N, df):
+    """BM25 的 idf 权重，N 为文档总数"""
+    return math.log2((N - df + 0.5) / (df + 0.5))
+
+
+def _width(max_value):
+    for w in (1, 2, 4):
+        if max_value < (1 << (8 * w)):
+            return w
+    return 8
+
+
+def encode_postings(docids, tf, ld, ts):
+    """把一个词项的 postings 各列编码为 bytes，输入顺序任意。
+
+    返回 (bytes, (docid, tf, ld, ts))，后者是按 docid 排好序的 int64 列，
+    与解码结果相同，供调用方直接计算上界统计量与跳表，不必再解码一遍。
+    """
+    docids = np.asarray(docids, dtype=np.int64)
+    order = np.argsort(docids, kind='stable')
+    docids = docids[order]
+    tf = np.asarray(tf, dtype=np.int64)[order]
+    ld = np.asarray(ld, dtype=np.int64)[order]
+    ts = np.asarray(ts, dtype=np.int64)[order]
+
+    n = len(docids)
+    deltas = np.diff(docids, prepend=0)
+    base = int(ts.min()) if n else 0
+    offsets = ts - base
+    columns = [deltas, tf, ld, offsets]
+    widths = [_width(int(c.max()) if n else 0) for c in columns]
+
+    parts = [HEADER.pack(n, widths[0], widths[1], widths[2], widths[3], base)]
+    for c, w in zip(columns, widths):
+        parts.append(c.astype('<u%d' % w).tobytes())
+    return b''.join(parts), (docids, tf, ld, ts)
+
+
+def decode_postings(blob):
+    """解码为 (docid, tf, ld, ts) 四个等长 NumPy 数组，docid 升序"""
+    if isinstance(blob, str):
+        return _decode_text(blob)
+    n, wd, wt, wl, ws, base = HEADER.unpack_from(blob)
+    offset = HEADER.size
+    columns = []
+    for w in (wd, wt, wl, ws):
+        columns.append(np.frombuffer(blob, dtype='<u%d' % w, count=n, offset=offset))
+        offset += n * w
+    docids = np.cumsum(columns[0], dtype=np.int64)
+    ts = columns[3].astype(np.int64) + base
+    return docids, columns[1], columns[2], ts
+
+
+def _decode_text(text):
+    """解析旧版 'docid\\tdatetime\\ttf\\tld' 按行拼接的文本 postings"""
+    docids, tf, ld, ts = [], [], [], []
+    for line in text.split('\n'):
+        docid, date_time, t, l = line.split('\t')
+        docids.append(int(docid))
+        tf.append(int(t))
+        ld.append(int(l))
+        ts.append(datetime_to_epoch(date_time))
+    order = np.argsort(np.array(docids, dtype=np.int64), kind='stable')
+    return (np.array(docids, dtype=np.int64)[order], np.array(tf, dtype=np.int64)[order],
+            np.array(ld, dtype=np.int64)[order], np.array(ts, dtype=np.int64)[order])
+
+
+def encode_skips(docids, tf, ld):
+    """按 docid 升序的列生成跳表，每 BLOCK_SIZE 条一项"""
+    starts = np.arange(0, len(docids), BLOCK_SIZE)
+    skips = np.empty(len(starts), dtype=SKIP)
+    skips['last'] = docids[np.minimum(starts + BLOCK_SIZE, len(docids)) - 1]
+    skips['max_tf'] = np.maximum.reduceat(tf, starts)
+    skips['min_ld'] = np.minimum.reduceat(ld, starts)
+    return skips.tobytes()
+
+
+def decode_skips(blob):
+    return np.frombuffer(blob, dtype=SKIP)
+
+
+def postings_row(term, docids, tf, ld, ts):
+    """生成 postings 表的一行 (term, df, docs, max_tf, min_ld, skips)"""
+    docs, (docids, tf, ld, ts) = encode_postings(docids, tf, ld, ts)
+    return (term, len(docids), docs, int(tf.max()), int(ld.min()), encode_skips(docids, tf, ld))
+
+
+def migrate_db(db_path):
+    """把旧版 postings 表（TEXT 格式、缺少上界统计量或未分段）就地转换为当前格式的单个段，返回转换的词项数"""
+    conn = sqlite3.connect(db_path)
+    c = conn.cursor()
+    columns = [r[1] for r in c.execute('PRAGMA table_info(postings)')]
+    legacy = c.execute("SELECT count(*) FROM postings WHERE typeof(docs) = 'text'").fetchone()[0]
+    if 'segment' in columns and legacy == 0:
+        if 'idf' not in [r[1] for r in c.execute('PRAGMA table_info(terms)')]: # 词典中还没有 idf 列
+            N = dict(c.execute('SELECT key, value FROM stats').fetchall())['N']
+            conn.create_function('bm25_idf', 1, lambda df: bm25_idf(N, df), deterministic = True)
+            c.execute('ALTER TABLE terms ADD COLUMN idf REAL')
+            c.execute('UPDATE terms SET idf = bm25_idf(df)')
+            conn.commit()
+        conn.close()
+        return 0
+    rows = c.execute("SELECT term, docs FROM postings").fetchall()
+    # 未分段的增量索引中已删除文档的残留记录在转换时一并清除；doc_state 没有段信息，
+    # 删掉后下次增量更新会退化为一次全量构建
+    dead = np.empty(0, dtype=np.int64)
+    if 'docid' in [r[1] for r in c.execute('PRAGMA table_info(tombstones)')]:
+        dead = np.array([r[0] for r in c.execute("SELECT docid FROM tombstones")], dtype=np.int64)
+    c.execute(POSTINGS_TABLE.replace('TABLE postings', 'TABLE postings_new'))
+    docs_seen = set()
+    n_postings = 0
+    for term, docs in rows:
+        columns = decode_postings(docs)
+        keep = ~np.isin(columns[0], dead)
+        if not keep.any():
+            continue
+        row = postings_row(term, *[col[keep] for col in columns])
+        docs_seen.update(columns[0][keep].tolist())
+        n_postings += row[1]
+        c.execute("INSERT INTO postings_new VALUES (?, ?, ?, ?, ?, ?, ?)", row + (1,))
+    c.execute('''DROP TABLE postings''')
+    c.execute('''ALTER TABLE postings_new RENAME TO postings''')
+    c.execute('''DROP TABLE IF EXISTS terms''')
+    c.execute(TERMS_TABLE)
+    N = len(docs_seen)
+    c.executemany("INSERT INTO terms VALUES (?, ?, ?)",
+                  [(term, df, bm25_idf(N, df)) for term, df in c.execute("SELECT term, df FROM postings").fetchall()])
+    c.execute('''DROP TABLE IF EXISTS segments''')
+    c.execute(SEGMENTS_TABLE)
+    c.execute("INSERT INTO segments VALUES (1, ?, ?)", (len(docs_seen), n_postings))
+    c.execute('''DROP TABLE IF EXISTS tombstones''')
+    c.execute('''DROP TABLE IF EXISTS doc_state''')
+    conn.commit()
+    conn.execute('VACUUM')
+    conn.close()
+    return len(rows)
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else '../data/ir.db'
+    print('migrated %d terms in %s' % (migrate_db(path), path))
@@ -5,7 +5,10 @@ Created on Wed Dec 23 14:06:10 2015
 @author: bitjoy.net
 """
 
-from os import listdir
+from concurrent.futures import ProcessPoolExecutor
+import os
+import sys
+import hashlib
 import xml.etree.ElementTree as ET
 import jieba
 import jieba.analyse
@@ -14,10 +17,14 @@ import configparser
 from datetime import *
 import math
 
-import pandas as pd
 import numpy as np
+from scipy import sparse
 
-from sklearn.metrics import pairwise_distances
+from sklearn.preprocessing import normalize
+
+from ann_index import IDF_DRIFT, MAX_DF, SIMILARITY_DECIMALS, ANNIndex, recall_at_k
+from token_cache import TokenCache, TokensTFIDF
+from doc_store import open_corpus
 
 class RecommendationModule:
     stop_words = set()
@@ -32,10 +39,18 @@ class RecommendationModule:
     stop_words_encoding = ''
     idf_path = ''
     db_path = ''
+    memory_mb = 64
+    mode = 'exact'
+    workers = 1
+    token_cache = None
+    tfidf = None
+    corpus = None
+    comparisons = 0
     
     def __init__(self, config_path, config_encoding):
         self.config_path = config_path
         self.config_encoding = config_encoding
+        self.k_nearest = []
         config = configparser.ConfigParser()
         config.read(config_path, config_encoding)
         
@@ -45,6 +60,15 @@ class RecommendationModule:
         self.stop_words_encoding = config['DEFAULT']['stop_words_encoding']
         self.idf_path = config['DEFAULT']['idf_path']
         self.db_path = config['DEFAULT']['db_path']
+        self.memory_mb = config['DEFAULT'].getfloat('knearest_memory_mb', 64)
+        self.mode = config['DEFAULT'].get('knearest_mode', 'exact')
+        self.max_df = config['DEFAULT'].getfloat('knearest_max_df', MAX_DF)
+        self.idf_drift = config['DEFAULT'].getfloat('knearest_idf_drift', IDF_DRIFT)
+        self.workers = config['DEFAULT'].getint('index_workers', 1)
+        self.token_cache = TokenCache(config['DEFAULT'].get('token_cache_path', ''))
+        self.corpus = open_corpus(config['DEFAULT'])
+        if self.workers <= 0:
+            self.workers = os.cpu_count() or 1
 
         f = open(self.stop_words_path, encoding = self.stop_words_encoding)
         words = f.read()
@@ -59,8 +83,9 @@ class RecommendationModule:
                      (id INTEGER PRIMARY KEY, first INTEGER, second INTEGER,
                      third INTEGER, fourth INTEGER, fifth INTEGER)''')
 
-        for docid, doclist in self.k_nearest:
-            c.execute("INSERT INTO knearest VALUES (?, ?, ?, ?, ?, ?)", tuple([docid] + doclist))
+        # 新闻不足 6 篇时推荐列表不足 5 篇，空位写 NULL
+        c.executemany("INSERT INTO knearest VALUES (?, ?, ?, ?, ?, ?)",
+                      (tuple(([docid] + doclist + [None] * 5)[:6]) for docid, doclist in self.k_nearest))
 
         conn.commit()
         conn.close()
@@ -73,80 +98,163 @@ class RecommendationModule:
             return False
             
     
+    def known_docs(self):
+        """索引中 doc_state 记录的 {文件名: (docid, mtime, 内容 sha1)}，没有索引时为空"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            known = {file: (docid, mtime, h) for docid, file, mtime, h in
+                     conn.execute('SELECT docid, file, mtime, hash FROM doc_state')}
+            conn.close()
+            return known
+        except sqlite3.Error:
+            return {}
+
+    def doc_tokens(self, file, known):
+        """返回 (docid, 词序列)。
+
+        文件的 mtime 与索引记录一致时直接按 (docid, sha1) 读分词缓存，不打开文件；
+        否则解析 XML、计算 sha1 后查缓存，仍未命中才分词并写回缓存。
+        """
+        entry = known.get(file)
+        if entry is not None and entry[1] == self.corpus.mtime(file):
+            tokens = self.token_cache.get(entry[0], entry[2])
+            if tokens is not None:
+                return entry[0], tokens
+        data = self.corpus.read(file)
+        root = ET.fromstring(data)
+        docid = int(root.find('id').text)
+        return docid, self.token_cache.tokens(docid, hashlib.sha1(data).hexdigest(),
+                                              root.find('title').text, root.find('body').text)
+
+    def doc_keywords(self, file, topK, known):
+        """返回 (docid, {关键词: TF-IDF 权重})，调用前需已由 files_keywords 加载 self.tfidf"""
+        docid, tokens = self.doc_tokens(file, known)
+        tags = self.tfidf.extract_tags(tokens, topK = topK, withWeight = True)
+        cleaned_dict = {}
+        for word, tfidf in tags:
+            word = word.strip().lower()
+            if word == '' or self.is_number(word):
+                continue
+            cleaned_dict[word] = tfidf
+        return docid, cleaned_dict
+
+    def files_keywords(self, files, topK):
+        """按 files 的顺序返回每篇新闻的 (docid, {关键词: TF-IDF 权重})。
+
+        关键词在分词缓存的词序列上提取，结果与 jieba.analyse.extract_tags 相同。
+        workers 大于 1 时文件列表按原顺序切成连续的分片交给进程池，
+        结果按分片顺序拼接，与串行提取完全相同。
+        """
+        if self.workers == 1 or len(files) <= 1:
+            self.tfidf = TokensTFIDF(self.idf_path, self.stop_words_path) # 每次重新加载刚生成的 idf 文件
+            known = self.known_docs()
+            keywords = [self.doc_keywords(i, topK, known) for i in files]
+            self.token_cache.flush()
+            return keywords
+        return [r for part in self.map_shards(_keywords_shard, files, topK) for r in part]
+
+    def map_shards(self, fn, files, *args):
+        """把 files 切成连续分片，在进程池中执行 fn(config_path, config_encoding, 分片, *args)，按分片顺序返回结果"""
+        size = max(1, math.ceil(len(files) / (self.workers * 4)))
+        shards = [files[i:i + size] for i in range(0, len(files), size)]
+        with ProcessPoolExecutor(max_workers = self.workers) as executor:
+            jobs = [executor.submit(fn, self.config_path, self.config_encoding, shard, *args) for shard in shards]
+            return [job.result() for job in jobs]
+
     def construct_dt_matrix(self, files, topK = 200):
-        jieba.analyse.set_stop_words(self.stop_words_path)
-        jieba.analyse.set_idf_path(self.idf_path)
-        M = len(files)
-        N = 1
+        """每篇新闻取 topK 个关键词的 TF-IDF 权重，构成 文档 × 词项 的 CSR 稀疏矩阵。
+
+        行按 files 的顺序排列，返回 (各行的 docid 列表, 矩阵)；只存非零项，
+        内存与关键词总数成正比，不随 文档数 × 词表大小 增长。
+        """
         terms = {}
-        dt = []
-        for i in files:
-            root = ET.parse(self.doc_dir_path + i).getroot()
-            title = root.find('title').text
-            body = root.find('body').text
-            docid = int(root.find('id').text)
-            tags = jieba.analyse.extract_tags(title + '。' + body, topK=topK, withWeight=True)
-            #tags = jieba.analyse.extract_tags(title, topK=topK, withWeight=True)
-            cleaned_dict = {}
-            for word, tfidf in tags:
-                word = word.strip().lower()
-                if word == '' or self.is_number(word):
-                    continue
-                cleaned_dict[word] = tfidf
+        docids = []
+        indptr = [0]
+        indices = []
+        data = []
+        for docid, cleaned_dict in self.files_keywords(files, topK):
+            for word in cleaned_dict:
                 if word not in terms:
-                    terms[word] = N
-                    N += 1
-            dt.append([docid, cleaned_dict])
-        dt_matrix = [[0 for i in range(N)] for j in range(M)]
-        i =0
-        for docid, t_tfidf in dt:
-            dt_matrix[i][0] = docid
-            for term, tfidf in t_tfidf.items():
-                dt_matrix[i][terms[term]] = tfidf
-            i += 1
-
-        dt_matrix = pd.DataFrame(dt_matrix)
-        dt_matrix.index = dt_matrix[0]
-        print('dt_matrix shape:(%d %d)'%(dt_matrix.shape))
-        return dt_matrix
-        
-    def construct_k_nearest_matrix(self, dt_matrix, k):
-            # 计算余弦相似度
-            # 注意：pairwise_distances 计算的是距离，相似度 = 1 - 距离
-            tmp = np.array(1 - pairwise_distances(dt_matrix[dt_matrix.columns[1:]], metric="cosine"))
-            
-            # 构建相似度矩阵 DataFrame
-            similarity_matrix = pd.DataFrame(tmp, index=dt_matrix.index.tolist(), columns=dt_matrix.index.tolist())
-            
-            # 遍历每个文档寻找最近邻
-            for i in similarity_matrix.index:
-                tmp_res = [int(i), []]
-                j = 0
-                while j < k:
-                    # 【修复1】去掉 axis=1。
-                    # loc[i] 返回的是 Series，直接调用 idxmax() 即可找到最大值的索引
-                    max_col = similarity_matrix.loc[i].idxmax()
-                    
-                    # 【修复2】使用标准的 loc[row, col] = val 赋值
-                    # 原代码 similarity_matrix.loc[i][max_col] = -1 在新版 Pandas 会报错或无效
-                    similarity_matrix.loc[i, max_col] = -1
-                    
-                    if max_col != i: # 排除自己
-                        tmp_res[1].append(int(max_col))
-                        j += 1
-                        
-                self.k_nearest.append(tmp_res)
+                    terms[word] = len(terms)
+            docids.append(docid)
+            indices.extend(terms[word] for word in cleaned_dict)
+            data.extend(cleaned_dict.values())
+            indptr.append(len(indices))
+
+        dt_matrix = sparse.csr_matrix((np.array(data, dtype=np.float64), np.array(indices, dtype=np.int64),
+                                       np.array(indptr, dtype=np.int64)), shape=(len(docids), len(terms)))
+        print('dt_matrix shape:(%d %d), nnz: %d'%(dt_matrix.shape + (dt_matrix.nnz,)))
+        return docids, dt_matrix
+
+    def construct_k_nearest_matrix(self, docids, dt_matrix, k, block_mb = 64):
+        """按余弦相似度为每篇新闻找出最相似的 k 篇（不含自身），结果追加到 self.k_nearest。
+
+        相似度按行分块计算：每块是若干行与全部文档的稀疏矩阵乘积，块的稠密结果不超过 block_mb，
+        不再生成完整的 N × N 矩阵。相似度取整到 SIMILARITY_DECIMALS 位后相同的按并列处理，
+        取列序（即 files 顺序）靠前的文档，与原先逐次 idxmax 的规则一致。
+        新闻不足 k + 1 篇时每篇的推荐列表只有 n - 1 篇。
+        """
+        n = len(docids)
+        k = min(k, n - 1)
+        if k <= 0:
+            self.k_nearest.extend([int(docid), []] for docid in docids)
+            return
+        unit = normalize(dt_matrix, norm='l2', copy=True)
+        unit_t = unit.T.tocsr()
+        # 每个相似度连同取整、argpartition、比较与累加计数的临时数组约占 64 字节
+        block = max(1, int(block_mb * 1024 * 1024) // (n * 64))
+        docids = np.asarray(docids, dtype=np.int64)
+        for start in range(0, n, block):
+            stop = min(start + block, n)
+            # 与 pairwise_distances 一样把余弦距离截断到 [0, 2]，再取整消除累加次序带来的误差
+            sim = np.round(1 - np.clip(1 - (unit[start:stop] @ unit_t).toarray(), 0, 2), SIMILARITY_DECIMALS)
+            rows = np.arange(stop - start)
+            sim[rows, rows + start] = -np.inf # 排除自己
+            # 第 k 大的相似度；严格更大的全部入选，等于它的按列序取够 k 个
+            part = np.argpartition(-sim, k - 1, axis=1)[:, :k]
+            kth = sim[rows[:, None], part].min(axis=1)[:, None]
+            greater = sim > kth
+            ties = sim == kth
+            need = k - greater.sum(axis=1, keepdims=True)
+            chosen = greater | (ties & (np.cumsum(ties, axis=1, dtype=np.int32) <= need))
+            cols = np.nonzero(chosen)[1].reshape(-1, k)
+            order = np.argsort(-sim[rows[:, None], cols], axis=1, kind='stable')
+            nearest = docids[np.take_along_axis(cols, order, axis=1)]
+            for docid, doclist in zip(docids[start:stop].tolist(), nearest.tolist()):
+                self.k_nearest.append([docid, doclist])
     
     def gen_idf_file(self):
-        files = listdir(self.doc_dir_path)
+        """统计全部新闻的 df，生成 jieba.analyse 使用的 idf 文件，idf = ln(N / df)。
+
+        词序列取自分词缓存，不再逐篇解析 XML、分词。workers 大于 1 时各分片在进程池中统计后按分片顺序相加，
+        词的先后次序（在语料中首次出现的顺序）与串行统计相同。
+        不直接用索引的 terms 表：索引先转小写再去停用词，这里沿用原先先去停用词再转小写的做法
+        （停用词表只收了“A”“Ⅲ”，terms 表里因此多出“a”“ⅲ”），词表不同会改变 jieba 的 idf 中位数与关键词。
+        返回写入文件的 {词: idf}。
+        """
+        files = self.corpus.names()
         n = float(len(files))
+        if self.workers == 1:
+            idf = self.count_df(files)
+        else:
+            idf = {}
+            for part in self.map_shards(_df_shard, files):
+                for word, df in part.items():
+                    idf[word] = idf.get(word, 0) + df
+        idf = {word: math.log(n / df) for word, df in idf.items()}
+        idf_file = open(self.idf_path, 'w', encoding = 'utf-8')
+        for word, value in idf.items():
+            idf_file.write('%s %.9f\n'%(word, value))
+        idf_file.close()
+        return idf
+
+    def count_df(self, files):
+        """统计一组新闻中每个词出现的文档数，词按首次出现的顺序排列"""
         idf = {}
+        known = self.known_docs()
         for i in files:
-            root = ET.parse(self.doc_dir_path + i).getroot()
-            title = root.find('title').text
-            body = root.find('body').text
-            seg_list = jieba.lcut(title + '。' + body, cut_all=False)
-            seg_list = set(seg_list) - self.stop_words
+            docid, seg_list = self.doc_tokens(i, known)
+            seg_list = [word for word in dict.fromkeys(seg_list) if word not in self.stop_words]
             for word in seg_list:
                 word = word.strip().lower()
                 if word == '' or self.is_number(word):
@@ -155,21 +263,81 @@ class RecommendationModule:
                     idf[word] = 1
                 else:
                     idf[word] = idf[word] + 1
-        idf_file = open(self.idf_path, 'w', encoding = 'utf-8')
-        for word, df in idf.items():
-            idf_file.write('%s %.9f\n'%(word, math.log(n / df)))
-        idf_file.close()
-        
+        self.token_cache.flush()
+        return idf
+
+    def update_ann_k_nearest(self, k, topK, write = True):
+        """近似最近邻模式：只对新增或内容变化的新闻，以及关键词 idf 漂移超过 knearest_idf_drift 的旧新闻
+        提取关键词并插入近似最近邻索引（见 ann_index），更新受影响新闻的推荐列表。文档集合与内容 sha1 取自索引的 doc_state 表，
+        write 为 True 时把全部推荐结果写入 knearest 表。返回推荐列表有变化的文档数。
+        """
+        conn = sqlite3.connect(self.db_path, timeout = 60)
+        try:
+            current = {docid: (file, h) for docid, file, h in conn.execute('SELECT docid, file, hash FROM doc_state')}
+        except sqlite3.Error: # 还没有增量索引的文档状态，只能全量精确计算
+            conn.close()
+            self.find_k_nearest_exact(k, topK)
+            return len(self.k_nearest)
+        idf = self.gen_idf_file()
+        index = ANNIndex.load(conn, self.max_df)
+        for docid in [docid for docid in index.docs if docid not in current]:
+            index.remove(docid)
+        stale = set(index.stale(idf, self.idf_drift))
+        changed = [docid for docid, (file, h) in current.items()
+                   if docid not in index.docs or index.docs[docid][0] != h or docid in stale]
+        keywords = self.files_keywords([current[docid][0] for docid in changed], topK)
+        for docid, (_, cleaned_dict) in zip(changed, keywords):
+            index.add(docid, current[docid][1], cleaned_dict, idf)
+        updated = index.update(k)
+        self.comparisons = index.comparisons
+        index.save(conn)
+        conn.close()
+        if write:
+            self.k_nearest = index.k_nearest()
+            self.write_k_nearest_matrix_to_db()
+        return updated
+
+    def ann_recall(self, k = 5):
+        """近似最近邻索引的推荐列表相对 knearest 表（精确模式的结果）的 recall@k"""
+        conn = sqlite3.connect(self.db_path)
+        exact = {r[0]: [i for i in r[1:] if i is not None] for r in conn.execute('SELECT * FROM knearest')}
+        approximate = {docid: ids.tolist() for docid, (ids, sims) in ANNIndex.load(conn).neighbours.items()}
+        conn.close()
+        return recall_at_k(approximate, exact, k)
+
     def find_k_nearest(self, k, topK):
+        """knearest_mode = ann 时增量更新近似最近邻，否则全量精确计算"""
+        if self.mode == 'ann':
+            self.update_ann_k_nearest(k, topK)
+        else:
+            self.find_k_nearest_exact(k, topK)
+
+    def find_k_nearest_exact(self, k, topK):
         self.gen_idf_file()
-        files = listdir(self.doc_dir_path)
-        dt_matrix = self.construct_dt_matrix(files, topK)
-        self.construct_k_nearest_matrix(dt_matrix, k)
+        files = self.corpus.names()
+        docids, dt_matrix = self.construct_dt_matrix(files, topK)
+        self.construct_k_nearest_matrix(docids, dt_matrix, k, self.memory_mb)
         self.write_k_nearest_matrix_to_db()
         
+def _keywords_shard(config_path, config_encoding, files, topK):
+    """子进程入口：提取一个分片中每篇新闻的关键词"""
+    rm = RecommendationModule(config_path, config_encoding)
+    rm.workers = 1
+    return rm.files_keywords(files, topK)
+
+def _df_shard(config_path, config_encoding, files):
+    """子进程入口：统计一个分片的 df"""
+    return RecommendationModule(config_path, config_encoding).count_df(files)
+
 if __name__ == "__main__":
     print('-----start time: %s-----'%(datetime.today()))
     rm = RecommendationModule('../config.ini', 'utf-8')
-    rm.find_k_nearest(5, 25)
+    if len(sys.argv) > 1 and sys.argv[1] == 'ann':
+        # 只更新近似最近邻索引，不改写 knearest 表，用来评估它相对精确结果的召回率
+        updated = rm.update_ann_k_nearest(5, 25, write = False)
+        print('updated %d docs with %d similarity computations' % (updated, rm.comparisons))
+        print('recall@5: %.4f' % rm.ann_recall(5))
+    else:
+        rm.find_k_nearest(5, 25)
     print('-----finish time: %s-----'%(datetime.today()))
     
\ No newline at end of file
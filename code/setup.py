@@ -4,6 +4,9 @@
 from spider import get_news_pool
 from spider import crawl_news
 from index_module import IndexModule
+from frontier import REVISIT_HOURS, Frontier
+from doc_store import DirectoryCorpus, open_corpus
+from pipeline import CrawlPipeline
 from recommendation_module import RecommendationModule
 from datetime import datetime
 import urllib.request
@@ -32,7 +35,7 @@ def get_max_page(url, try_auto=True):
 
 
 # ------------------ 爬取新闻 ------------------
-def crawling(config):
+def crawling(config, frontier, sink=None):
     print(f"\n===============================================\n启动时间: {datetime.today()}\n===============================================\n")
 
     # ================== 修改这里 ==================
@@ -50,7 +53,9 @@ def crawling(config):
         news_pool,
         140,   # 爬取新闻条数
         config['doc_dir_path'],
-        config['doc_encoding']
+        config['doc_encoding'],
+        frontier,
+        sink
     )
     print("🟩 新闻爬取完成\n")
 
@@ -75,17 +80,37 @@ if __name__ == "__main__":
     print("🟢 正在加载配置文件:", config_path)
     print("默认字段:", dict(config))
 
-    # 爬新闻
-    crawling(config)
-
-    # 建立索引
-    print("🔍 开始建立索引...")
     im = IndexModule(config_path, "utf-8")
-    im.construct_postings_lists()
+    if len(sys.argv) > 1 and sys.argv[1] == "pipeline":
+        # 流水线模式：边抓取边分词、建索引，新闻写入文档库（需配置 doc_store_path），中断后重新运行即可继续
+        print("🔍 开始抓取并建立索引（流水线）...")
+        stats = CrawlPipeline(config_path, "utf-8").run(lambda frontier, sink: crawling(config, frontier, sink))
+        print("新闻 {docs} 篇分 {batches} 批写入索引，队列满时爬虫等待 {blocked} 次；"
+              "恢复上次未完成的 {recovered} 篇，重新抓取 {reset} 篇".format(**stats))
+    else:
+        # 爬新闻（抓取边界记录已抓取的 url，只下载新的或有变化的新闻）
+        corpus = open_corpus(config)
+        frontier = Frontier(config['frontier_path'], corpus, config.getfloat('crawl_revisit_hours', REVISIT_HOURS))
+        if not isinstance(corpus, DirectoryCorpus): # 配置了文档库时新闻写入文档库，不再写 XML 文件
+            crawling(config, frontier, lambda docid, name, data: corpus.put(name, docid, data))
+            corpus.commit()
+        else:
+            crawling(config, frontier)
+
+        # 建立索引（已有索引时只增量处理本轮及以前未索引的抓取结果）
+        print("🔍 开始建立索引...")
+        changed = frontier.changed_docids()
+        added, deleted = im.update_index(frontier.changed_files())
+        frontier.clear_changed(changed)
+        frontier.close()
+        print(f"新增或更新 {added} 篇，删除 {deleted} 篇")
+    # 段合并放到后台线程，与推荐计算同时进行
+    merger = im.merge_in_background()
 
     # 推荐阅读
     print("🔍 开始推荐新闻...")
     rm = RecommendationModule(config_path, "utf-8")
     rm.find_k_nearest(5, 25)
+    merger.join()
 
     print(f"===============================================\n完成时间: {datetime.today()}\n===============================================\n")
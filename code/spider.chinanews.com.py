@@ -3,17 +3,41 @@
 Created on Sun Mar 29 17:32:40 2020
 
 @author: Zhenlin
+
+并发抓取：
+    Fetcher       所有请求共用一个 urllib3 连接池，每个主机至多 concurrency 个 keep-alive 连接，
+                  请求前从该主机的令牌桶取令牌（rate 次/秒，允许 burst 次突发）；
+                  超时、连接错误、429 与 5xx 按指数退避（带抖动）重试，不再一律 sleep(10)
+    get_news_pool 各天的滚动新闻页并发抓取，按日期顺序拼接
+    crawl_news    抓取线程拿到页面后立即交给解析进程池，主线程按 news_pool 的顺序收取解析结果、
+                  编号并写 XML，输出与逐篇串行抓取完全相同；同时在途的新闻数有上限，内存不随 news_pool 增长
+    frontier      抓取边界（见 frontier.py）：每个 url 的 docid 固定，已抓取的新闻用条件请求确认是否变化，
+                  重复抓取时只下载新新闻，写过的 docid 交给增量索引
+    正文抽取      parse_news_page_lxml 用 lxml 与预编译的 XPath 抽取正文，结果与 BeautifulSoup 的
+                  parse_news_page 逐字相同；两种解析器处理结果不同的少数写法（见 _needs_bs）改用后者
+本地基准见 bench_spider.py 与 bench_extract.py。
 """
 
 from bs4 import BeautifulSoup
-import urllib.request
+from bs4.dammit import UnicodeDammit
+from html.entities import name2codepoint
+from lxml import etree
 import xml.etree.ElementTree as ET
 import configparser
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import deque
 from datetime import timedelta, date
+from urllib.parse import urlsplit
+import os
+import random
+import re
+import threading
 import time
-import urllib.parse
-import socket
-from socket import timeout
+
+import urllib3
+
+from frontier import REVISIT_HOURS, Frontier, content_hash
+from doc_store import DirectoryCorpus
 
 user_agent = 'Mozilla/5.0 (Windows NT 6.1; Win64; x64)'
 headers = {'User-Agent': user_agent}
@@ -24,137 +48,386 @@ headers = {'User-Agent': user_agent}
 #data = data.encode('ascii')
 
 keyword='编辑'
+ROOT = 'http://www.chinanews.com'
 
 
-def get_one_page_news(page_url):
-#    page_url='http://www.chinanews.com/scroll-news/2019/0801/news.shtml'
-    root='http://www.chinanews.com'
-    req = urllib.request.Request(page_url, headers = headers)
-    
-    try:
-        response = urllib.request.urlopen(req, timeout=10)
-        html = response.read()
-    except socket.timeout as err:
-        print('socket.timeout')
-        print(err)
-        return []
-    except Exception as e:
-        print("-----%s:%s %s-----"%(type(e),e.reason, page_url))
-        return []
-    
+class TokenBucket:
+    """令牌桶：平均每秒 rate 个令牌，最多积攒 burst 个；rate <= 0 表示不限速"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class Fetcher:
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, concurrency = 8, rate = 10, burst = 10, retries = 4, timeout = 10, backoff = 0.5, max_backoff = 30):
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        # block=True：某主机的连接全部在用时等待归还，而不是另开连接
+        self.pool = urllib3.PoolManager(num_pools = 16, maxsize = concurrency, block = True, headers = headers,
+                                        timeout = urllib3.Timeout(total = timeout), retries = False)
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.retried = 0
+        self.failures = 0
+
+    def bucket(self, host):
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate, self.burst)
+            return self.buckets[host]
+
+    def get(self, url):
+        """返回页面内容，重试用尽或遇到不可重试的错误（如 404）时返回 None"""
+        response = self.fetch(url)
+        return response.data if response is not None else None
+
+    def fetch(self, url, conditional = None):
+        """返回 urllib3 的响应（状态码为 200，或带条件请求头 conditional 时的 304），失败时返回 None"""
+        bucket = self.bucket(urlsplit(url).netloc)
+        for attempt in range(self.retries + 1):
+            bucket.acquire()
+            error = None
+            try:
+                response = self.pool.request('GET', url, headers = dict(headers, **conditional) if conditional else None)
+                with self.lock:
+                    self.requests += 1
+                if response.status == 200 or (response.status == 304 and conditional):
+                    return response
+                error = 'HTTP %d' % response.status
+                if response.status not in self.RETRY_STATUS:
+                    break
+            except (urllib3.exceptions.HTTPError, OSError) as e:
+                with self.lock:
+                    self.requests += 1
+                error = '%s: %s' % (type(e).__name__, e)
+            if attempt < self.retries:
+                with self.lock:
+                    self.retried += 1
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+                time.sleep(delay * (0.5 + random.random() / 2))
+        with self.lock:
+            self.failures += 1
+        print("-----%s %s-----"%(error, url))
+        return None
+
+    def close(self):
+        self.pool.clear()
+
+
+def parse_list_page(html, root = ROOT):
+    """解析一天的滚动新闻页，返回 [[发布时间, url, 标题], ...]"""
     soup = BeautifulSoup(html,"html.parser") # http://www.crummy.com/software/BeautifulSoup/bs4/doc.zh/
-    
+
     news_pool = []
     news_list = soup.find('div', class_ = "content_list")
+    if news_list is None:
+        return news_pool
     items = news_list.find_all('li')
     for i,item in enumerate(items):
 #        print('%d/%d'%(i,len(items)))
         if len(item) == 0:
             continue
-        
+
         a = item.find('div', class_ = "dd_bt").find('a')
         title = a.string
         url = a.get('href')
         if root in url:
             url=url[len(root):]
-        
+
         category = ''
         try:
             category = item.find('div', class_ = "dd_lm").find('a').string
         except Exception as e:
             continue
-        
+
         if category == '图片':
             continue
-        
+
         year = url.split('/')[-3]
         date_time = item.find('div', class_ = "dd_time").string
         date_time = '%s-%s:00'%(year, date_time)
-        
-        news_info = [date_time, "http://www.chinanews.com"+url, title]
+
+        news_info = [date_time, root+url, title]
         news_pool.append(news_info)
     return news_pool
 
-def get_news_pool(start_date, end_date):
-    news_pool=[]
+
+def parse_news_page(html):
+    """抽取新闻正文，页面中没有正文区域时返回 None"""
+    soup = BeautifulSoup(html, "html.parser") # http://www.crummy.com/software/BeautifulSoup/bs4/doc.zh/
+    [s.extract() for s in soup('script')]
+
+    try:
+        ps = soup.find('div', class_ = "left_zw").find_all('p')
+    except Exception as e:
+        return None
+
+    body = ''
+    for p in ps:
+        cur = p.get_text().strip()
+        if cur == '':
+            continue
+        body += '\t' + cur + '\n'
+    return body.replace(" ", "")
+
+
+# 与 soup.find('div', class_ = "left_zw") 相同：class 属性中含有 left_zw 这一项的第一个 div
+LEFT_ZW = etree.XPath("(//div[contains(concat(' ', normalize-space(@class), ' '), ' left_zw ')])[1]")
+PARAGRAPHS = etree.XPath('.//p')
+# html.parser 把 script、style 与 template 的内容当作脚本或样式，get_text() 不含它们的文字
+PARAGRAPH_TEXT = etree.XPath('.//text()[not(ancestor::script or ancestor::style or ancestor::template)]')
+
+# 两种解析器结果不同的写法：NUL、CDATA、内容按原文处理的元素
+RAW_MARKUP = re.compile(rb'\x00|<!\[CDATA\[|<(?:textarea|xmp|plaintext|noembed|noframes)[\s>/]'
+                        rb'|<iframe[^>]*>[^<]*<(?!/iframe)', re.I)
+COMMENTS_AND_SCRIPTS = re.compile(rb'<!--.*?-->|<script\b.*?</script\s*>', re.I | re.S)
+P_OPEN = re.compile(rb'<p[\s>/]', re.I)
+P_CLOSE = re.compile(rb'</p\s*>', re.I)
+# html.parser 遇到 </body>、</html> 时关闭其中所有元素，libxml2 则把后面的内容仍放进 body：之后只允许空白、注释与脚本
+DOCUMENT_END = re.compile(rb'</(?:body|html)', re.I)
+DOCUMENT_TAIL = re.compile(rb'(?:\s+|</(?:body|html)\s*>|<!--.*?-->|<script\b.*?</script\s*>)*', re.I | re.S)
+CHAR_REF = re.compile(rb'&(?:#(?:[xX]([0-9a-fA-F]+)|([0-9]+))|([a-zA-Z][a-zA-Z0-9]*));')
+# lxml 认识的实体：HTML 4 的实体加上 &apos;，BeautifulSoup 对其他名字的处理与 libxml2 不同
+HTML4_ENTITIES = set(name2codepoint) | {'apos'}
+
+
+def _needs_bs(data):
+    """UTF-8 页面 data 中含有 lxml 与 html.parser 处理结果不同的写法时返回 True"""
+    if RAW_MARKUP.search(data):
+        return True
+    end = DOCUMENT_END.search(data)
+    if end is not None and DOCUMENT_TAIL.fullmatch(data, end.start()) is None:
+        return True
+    # <p> 未闭合时 html.parser 把后面的段落嵌套在里面，libxml2 则自动闭合
+    markup = COMMENTS_AND_SCRIPTS.sub(b'', data)
+    if len(P_OPEN.findall(markup)) != len(P_CLOSE.findall(markup)):
+        return True
+    for m in CHAR_REF.finditer(data):
+        if m.group(3) is not None:
+            if m.group(3).decode('ascii') not in HTML4_ENTITIES:
+                return True
+        else:
+            code = int(m.group(1), 16) if m.group(1) is not None else int(m.group(2))
+            if code == 0 or 0x80 <= code <= 0x9f or code > 0x10ffff: # html.parser 按 windows-1252 等规则替换
+                return True
+    return False
+
+
+def parse_news_page_lxml(html):
+    """与 parse_news_page 结果相同的快速版本：lxml 解析，预编译的 XPath 取正文段落"""
+    # 编码判断与 BeautifulSoup 相同（UnicodeDammit），lxml 一律按 UTF-8 解析，不再看页面中的 meta
+    dammit = UnicodeDammit(html, is_html = True)
+    if dammit.unicode_markup is None:
+        return parse_news_page(html)
+    if dammit.original_encoding in ('utf-8', 'ascii') and not html.startswith(b'\xef\xbb\xbf'):
+        data = html
+    else:
+        data = dammit.unicode_markup.encode('utf-8')
+    if _needs_bs(data):
+        return parse_news_page(html)
+
+    parser = etree.HTMLParser(encoding = 'utf-8')
+    root = etree.fromstring(data, parser)
+    # 多余的结束标签（段落中的 </p>、正文中的 </div> 等）html.parser 会据此关闭外层元素，libxml2 则忽略；</br> 不影响文字
+    if root is None or any(e.type_name == 'ERR_TAG_NAME_MISMATCH' and e.message.startswith('Unexpected end tag')
+                           and e.message != 'Unexpected end tag : br' for e in parser.error_log):
+        return parse_news_page(html)
+    div = LEFT_ZW(root)
+    if not div:
+        return None
+
+    crlf = b'\r' in data
+    body = ''
+    for p in PARAGRAPHS(div[0]):
+        cur = ''.join(PARAGRAPH_TEXT(p)).strip()
+        if cur == '':
+            continue
+        if crlf and '\n' in cur: # libxml2 把回车规范化为换行，html.parser 保留原样；只有段落内换行时才有区别
+            return parse_news_page(html)
+        body += '\t' + cur + '\n'
+    return body.replace(" ", "")
+
+
+EXTRACTORS = {'lxml': parse_news_page_lxml, 'bs4': parse_news_page}
+
+
+def get_one_page_news(page_url, fetcher = None, root = ROOT):
+#    page_url='http://www.chinanews.com/scroll-news/2019/0801/news.shtml'
+    fetcher = fetcher or Fetcher()
+    html = fetcher.get(page_url)
+    if html is None:
+        return []
+    return parse_list_page(html, root)
+
+def get_news_pool(start_date, end_date, fetcher = None, root = ROOT):
+    fetcher = fetcher or Fetcher()
+    page_urls = []
     delta = timedelta(days=1)
     while start_date <= end_date:
         date_str=start_date.strftime("%Y/%m%d")
-        page_url='http://www.chinanews.com/scroll-news/%s/news.shtml'%(date_str)
-        print('Extracting news urls at %s'%date_str)
-        news_pool += get_one_page_news(page_url)
-#        print('done')
+        page_urls.append('%s/scroll-news/%s/news.shtml'%(root, date_str))
         start_date += delta
+    print('Extracting news urls of %d days'%len(page_urls))
+    news_pool=[]
+    with ThreadPoolExecutor(max_workers = fetcher.concurrency) as executor:
+        for pool in executor.map(lambda url: get_one_page_news(url, fetcher, root), page_urls):
+            news_pool += pool
     return news_pool
 
-def crawl_news(news_pool, min_body_len, doc_dir_path, doc_encoding):
+def crawl_news(news_pool, min_body_len, doc_dir_path, doc_encoding, fetcher = None, parse_workers = 0, frontier = None, sink = None,
+               extract = parse_news_page_lxml):
+    """抓取 news_pool 中的新闻并写成 XML，返回写出的篇数。
+
+    parse_workers 为解析进程数，0 表示 CPU 核数，1 表示在主线程中解析。
+    frontier 为 Frontier 时按 url 分配固定的 docid：见过且没有校验信息的 url 在 revisit_hours 内不再抓取，
+    有 ETag / Last-Modified 的用条件请求，304 或内容 sha1 未变时不重写文件；
+    写出的 docid 记入 frontier 的 changed 表，供增量索引使用。
+    frontier 为 None 时与以前一样从 1 开始编号。
+    给出 sink 时不写 XML 文件，而是调用 sink(docid, 文件名, XML 内容)，由调用方决定存放方式（见 pipeline.py）。
+    extract 为正文抽取函数（EXTRACTORS 中的一个），两者结果相同，默认用较快的 lxml 版。
+    """
+    fetcher = fetcher or Fetcher()
+    if parse_workers <= 0:
+        parse_workers = os.cpu_count() or 1
+    parser = ProcessPoolExecutor(max_workers = parse_workers) if parse_workers > 1 else None
+    fetchers = ThreadPoolExecutor(max_workers = fetcher.concurrency)
+    window = fetcher.concurrency * 4 + parse_workers * 2 # 同时在途（抓取中或待解析）的新闻数上限
+
+    todo = [] # [(新闻, frontier 中的记录)]
+    urls = set()
+    for news in news_pool:
+        entry = None
+        if frontier is not None:
+            if news[1] in urls: # 同一 url 在列表页中出现多次时只抓一次，以免分到两个 docid
+                continue
+            urls.add(news[1])
+            entry = frontier.lookup(news[1])
+            if frontier.skip(entry):
+                continue # 已抓取过、无法用条件请求确认是否变化，且还没到重新抓取的时间
+        todo.append((news, entry))
+    if frontier is not None:
+        print('%d/%d news are new or need revalidation'%(len(todo), len(news_pool)))
+
+    def fetch(url, conditional):
+        response = fetcher.fetch(url, conditional)
+        if response is None or response.status == 304:
+            return response, None
+        if parser is None:
+            return response, response.data
+        return response, parser.submit(extract, response.data) # 抓取线程不等解析，立即去取下一篇
+
     i = 1
-    for n, news in enumerate(news_pool):
-        print('%d/%d'%(n,len(news_pool)))
-        
-        req = urllib.request.Request(news[1], headers = headers)
-        try:
-            response = urllib.request.urlopen(req, timeout=10)
-            html = response.read()
-#            response = urllib.request.urlopen(news[1])
-        except socket.timeout as err:
-            print('socket.timeout')
-            print(err)
-            print("Sleeping for 10 second")
-            time.sleep(10)
-            continue
-        except Exception as e:
-            print("--1---%s:%s %s-----"%(type(e),e.reason, news[1]))
-            print("Sleeping for 10 second")
-            time.sleep(10)
-            continue
-        
-        soup = BeautifulSoup(html, "html.parser") # http://www.crummy.com/software/BeautifulSoup/bs4/doc.zh/
-        [s.extract() for s in soup('script')]
-        
-        try:
-            ps = soup.find('div', class_ = "left_zw").find_all('p')
-        except Exception as e:
-            print("--2---%s: %s-----"%(type(e), news[1]))
-            print("Sleeping for 10 second")
-            time.sleep(10)
-            continue
-        
-        body = ''
-        for p in ps:
-            cur = p.get_text().strip()
-            if cur == '':
+    written = 0
+    pending = deque()
+    try:
+        for n in range(len(todo)):
+            while len(pending) < window and n + len(pending) < len(todo):
+                news, entry = todo[n + len(pending)]
+                pending.append(fetchers.submit(fetch, news[1], frontier.conditional_headers(entry) if entry else None))
+            news, entry = todo[n]
+            print('%d/%d'%(n,len(todo)))
+            response, result = pending.popleft().result()
+            if response is None:
                 continue
-            body += '\t' + cur + '\n'
-        body = body.replace(" ", "")
-        
-        if keyword not in body: # 过滤掉乱码新闻
-            continue
-        
-        if len(body) <= min_body_len:
-            continue
-        
-        doc = ET.Element("doc")
-        ET.SubElement(doc, "id").text = "%d"%(i)
-        ET.SubElement(doc, "url").text = news[1]
-        ET.SubElement(doc, "title").text = news[2]
-        ET.SubElement(doc, "datetime").text = news[0]
-        ET.SubElement(doc, "body").text = body
-        tree = ET.ElementTree(doc)
-        tree.write(doc_dir_path + "%d.xml"%(i), encoding = doc_encoding, xml_declaration = True)
-        i += 1
-        if i%500 == 0:
-            print("Sleeping for 10 second")
-            time.sleep(10)
-    
+            if frontier is not None:
+                # 304 响应可以不带校验信息，此时沿用上次的
+                validators = (response.headers.get('ETag', entry and entry[1]),
+                              response.headers.get('Last-Modified', entry and entry[2]))
+            if response.status == 304:
+                frontier.record(news[1], None, *validators, None)
+                continue
+            body = result.result() if parser is not None else extract(result)
+            if body is None:
+                print("--2---%s-----"%(news[1]))
+                body = ''
+
+            if keyword not in body or len(body) <= min_body_len: # 过滤掉乱码新闻与过短的新闻
+                if frontier is not None:
+                    frontier.record(news[1], None, *validators, None)
+                continue
+
+            if frontier is not None:
+                h = content_hash(news[2], body)
+                if entry is not None and entry[0] is not None and entry[3] == h:
+                    frontier.record(news[1], None, *validators, None)
+                    continue
+                docid = entry[0] if entry is not None and entry[0] is not None else frontier.allocate()
+            else:
+                docid = i
+                i += 1
+
+            doc = ET.Element("doc")
+            ET.SubElement(doc, "id").text = "%d"%(docid)
+            ET.SubElement(doc, "url").text = news[1]
+            ET.SubElement(doc, "title").text = news[2]
+            ET.SubElement(doc, "datetime").text = news[0]
+            ET.SubElement(doc, "body").text = body
+            if sink is not None:
+                sink(docid, "%d.xml"%(docid), ET.tostring(doc, encoding = doc_encoding, xml_declaration = True))
+            else:
+                tree = ET.ElementTree(doc)
+                tree.write(doc_dir_path + "%d.xml"%(docid), encoding = doc_encoding, xml_declaration = True)
+            written += 1
+            if frontier is not None:
+                frontier.record(news[1], docid, *validators, h)
+                frontier.mark_changed(docid)
+                if written % 100 == 0:
+                    frontier.commit()
+    finally:
+        fetchers.shutdown(cancel_futures = True)
+        if parser is not None:
+            parser.shutdown(cancel_futures = True)
+        if frontier is not None:
+            frontier.commit()
+    return written
+
+def make_fetcher(config):
+    """按配置中的 crawl_* 项创建 Fetcher"""
+    return Fetcher(concurrency = config.getint('crawl_concurrency', 8),
+                   rate = config.getfloat('crawl_rate', 10),
+                   burst = config.getint('crawl_burst', 10))
+
 if __name__ == '__main__':
     config = configparser.ConfigParser()
     config.read('../config.ini', 'utf-8')
-    
+    fetcher = make_fetcher(config['DEFAULT'])
+    frontier = Frontier(config['DEFAULT']['frontier_path'], DirectoryCorpus(config['DEFAULT']['doc_dir_path']),
+                        config['DEFAULT'].getfloat('crawl_revisit_hours', REVISIT_HOURS))
+
     delta = timedelta(days=-5)
     end_date = date.today()
     start_date = end_date + delta
-    news_pool = get_news_pool(start_date, end_date)
+    news_pool = get_news_pool(start_date, end_date, fetcher)
     print('Starting to crawl %d news'%len(news_pool))
-    crawl_news(news_pool, 140, config['DEFAULT']['doc_dir_path'], config['DEFAULT']['doc_encoding'])
-    print('done!')
\ No newline at end of file
+    crawl_news(news_pool, 140, config['DEFAULT']['doc_dir_path'], config['DEFAULT']['doc_encoding'],
+               fetcher, config['DEFAULT'].getint('crawl_parse_workers', 0), frontier,
+               extract = EXTRACTORS[config['DEFAULT'].get('crawl_extractor', 'lxml')])
+    print('%d news changed since last indexing'%len(frontier.changed_docids()))
+    frontier.close()
+    fetcher.close()
+    print('done!')
@@ -6,10 +6,14 @@ Created on Sat Dec 19 11:57:01 2015
 """
 
 from bs4 import BeautifulSoup
+import urllib.error
 import urllib.request
 import xml.etree.ElementTree as ET
 import configparser
 
+from frontier import REVISIT_HOURS, Frontier, content_hash
+from doc_store import DirectoryCorpus
+
 def get_news_pool(root, start, end):
     news_pool = []
     for i in range(start,end,-1):
@@ -37,40 +41,77 @@ def get_news_pool(root, start, end):
     return(news_pool)
 
 
-def crawl_news(news_pool, min_body_len, doc_dir_path, doc_encoding):
+def crawl_news(news_pool, min_body_len, doc_dir_path, doc_encoding, frontier = None, sink = None):
+    """frontier 为 Frontier 时按 url 使用固定的 docid，跳过已抓取或未变化的新闻；
+    给出 sink 时不写文件，而是调用 sink(docid, 文件名, XML 内容)（见 spider.chinanews.com.py）"""
     i = 1
+    written = 0
     for news in news_pool:
+        entry = frontier.lookup(news[1]) if frontier is not None else None
+        if frontier is not None and frontier.skip(entry):
+            continue
+        conditional = frontier.conditional_headers(entry) if entry is not None else None
         try:
-            response = urllib.request.urlopen(news[1])
+            response = urllib.request.urlopen(urllib.request.Request(news[1], headers = conditional or {}))
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                frontier.record(news[1], None, e.headers.get('ETag', entry[1]), e.headers.get('Last-Modified', entry[2]), None)
+                continue
+            print("-----%s: %s-----"%(type(e), news[1]))
+            continue
         except Exception as e:
             print("-----%s: %s-----"%(type(e), news[1]))
             continue
+        validators = (response.headers.get('ETag'), response.headers.get('Last-Modified'))
         html = response.read()
         soup = BeautifulSoup(html,"lxml") # http://www.crummy.com/software/BeautifulSoup/bs4/doc.zh/
         try:
             body = soup.find('div', class_ = "text clear").find('div').get_text()
         except Exception as e:
             print("-----%s: %s-----"%(type(e), news[1]))
+            body = None
+        if body is not None:
+            if '//' in body:
+                body = body[:body.index('//')]
+            body = body.replace(" ", "")
+        if body is None or len(body) <= min_body_len:
+            if frontier is not None:
+                frontier.record(news[1], None, *validators, None)
             continue
-        if '//' in body:
-            body = body[:body.index('//')]
-        body = body.replace(" ", "")
-        if len(body) <= min_body_len:
-            continue
+        if frontier is not None:
+            h = content_hash(news[2], body)
+            if entry is not None and entry[0] is not None and entry[3] == h:
+                frontier.record(news[1], None, *validators, None)
+                continue
+            docid = entry[0] if entry is not None and entry[0] is not None else frontier.allocate()
+        else:
+            docid = i
+            i += 1
         doc = ET.Element("doc")
-        ET.SubElement(doc, "id").text = "%d"%(i)
+        ET.SubElement(doc, "id").text = "%d"%(docid)
         ET.SubElement(doc, "url").text = news[1]
         ET.SubElement(doc, "title").text = news[2]
         ET.SubElement(doc, "datetime").text = news[0]
         ET.SubElement(doc, "body").text = body
-        tree = ET.ElementTree(doc)
-        tree.write(doc_dir_path + "%d.xml"%(i), encoding = doc_encoding, xml_declaration = True)
-        i += 1
+        if sink is not None:
+            sink(docid, "%d.xml"%(docid), ET.tostring(doc, encoding = doc_encoding, xml_declaration = True))
+        else:
+            tree = ET.ElementTree(doc)
+            tree.write(doc_dir_path + "%d.xml"%(docid), encoding = doc_encoding, xml_declaration = True)
+        written += 1
+        if frontier is not None:
+            frontier.record(news[1], docid, *validators, h)
+            frontier.mark_changed(docid)
+            frontier.commit()
+    return written
     
 if __name__ == '__main__':
     config = configparser.ConfigParser()
     config.read('../config.ini', 'utf-8')
     root = 'http://news.sohu.com/1/0903/61/subject212846158'
     news_pool = get_news_pool(root, 854, 849)
-    crawl_news(news_pool, 140, config['DEFAULT']['doc_dir_path'], config['DEFAULT']['doc_encoding'])
+    frontier = Frontier(config['DEFAULT']['frontier_path'], DirectoryCorpus(config['DEFAULT']['doc_dir_path']),
+                        config['DEFAULT'].getfloat('crawl_revisit_hours', REVISIT_HOURS))
+    crawl_news(news_pool, 140, config['DEFAULT']['doc_dir_path'], config['DEFAULT']['doc_encoding'], frontier)
+    frontier.close()
     print('done!')
\ No newline at end of file
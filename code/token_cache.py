@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+共享的分词缓存
+
+建索引与推荐模块用的是同一种切分：jieba 精确模式切 title + '。' + body。
+每篇新闻只在第一次遇到时解析、分词一次，词序列存入缓存库，以 (docid, 内容 sha1) 为键：
+    tokens  (docid INTEGER PRIMARY KEY, hash TEXT, data BLOB)
+data 是各词以 '\\0' 分隔后 zlib 压缩的 utf-8（XML 文本中不会出现 '\\0'），约为原始词序列的一半。
+同一 docid 只保留最新内容的一份，sha1 不一致即视为未命中。
+
+建索引（全量、流式、增量）先查缓存，未命中才分词并写回；推荐模块按 doc_state 中的 (docid, sha1)
+直接读取词序列，不再解析 XML、也不再分词，关键词提取在词序列上完成（见 TokensTFIDF）。
+"""
+
+import sqlite3
+import time
+import zlib
+
+import jieba
+import jieba.analyse
+
+TOKENS_TABLE = '''CREATE TABLE IF NOT EXISTS tokens
+                     (docid INTEGER PRIMARY KEY, hash TEXT, data BLOB)'''
+FLUSH_EVERY = 500
+WAL_RETRIES = 200
+
+
+def tokenize(title, body):
+    return jieba.lcut(title + '。' + body, cut_all=False)
+
+
+def encode_tokens(tokens):
+    return zlib.compress('\0'.join(tokens).encode('utf-8'))
+
+
+def decode_tokens(data):
+    text = zlib.decompress(data).decode('utf-8')
+    return text.split('\0') if text else []
+
+
+class TokensTFIDF(jieba.analyse.TFIDF):
+    """extract_tags 接收已切好的词序列而不是原文的 jieba TF-IDF 关键词提取器。
+
+    过滤、计分与排序都沿用 jieba.analyse.TFIDF.extract_tags，只是切词一步原样返回词序列，
+    因此结果与对原文调用 jieba.analyse.extract_tags 逐项一致。
+    每个实例各自加载 idf 文件与停用词：jieba.analyse 的默认提取器对同一路径不会重新加载，
+    idf 文件在同一进程里被改写后仍用旧的 idf。
+    """
+
+    def __init__(self, idf_path, stop_words_path):
+        super().__init__(idf_path)
+        self.set_stop_words(stop_words_path)
+        self.tokenizer = self # extract_tags 通过 self.tokenizer.cut 切词
+
+    def cut(self, tokens):
+        return tokens
+
+
+class TokenCache:
+    """分词缓存库，写入先攒在内存里，每 FLUSH_EVERY 篇或 flush() 时提交一次；path 为空时不缓存"""
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.pending = []
+        self.hits = 0
+        self.misses = 0
+
+    def connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.path, timeout = 60)
+            # 进程池中的多个进程同时第一次打开新建的库时，切换到 WAL 的独占锁不经过 busy handler，拿不到就稍后重试
+            for attempt in range(WAL_RETRIES):
+                try:
+                    self.conn.execute('PRAGMA journal_mode=WAL')
+                    break
+                except sqlite3.OperationalError:
+                    if attempt == WAL_RETRIES - 1:
+                        raise
+                    time.sleep(0.05)
+            self.conn.execute(TOKENS_TABLE)
+        return self.conn
+
+    def get(self, docid, h):
+        """返回缓存的词序列，不存在或内容已变化时返回 None"""
+        if not self.path:
+            return None
+        r = self.connect().execute('SELECT hash, data FROM tokens WHERE docid = ?', (docid,)).fetchone()
+        if r is None or r[0] != h:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return decode_tokens(r[1])
+
+    def put(self, docid, h, tokens):
+        if not self.path:
+            return
+        self.pending.append((docid, h, encode_tokens(tokens)))
+        if len(self.pending) >= FLUSH_EVERY:
+            self.flush()
+
+    def tokens(self, docid, h, title, body):
+        """取缓存的词序列，未命中时分词并写回"""
+        tokens = self.get(docid, h)
+        if tokens is None:
+            tokens = tokenize(title, body)
+            self.put(docid, h, tokens)
+        return tokens
+
+    def delete(self, docids):
+        if not self.path:
+            return
+        self.flush()
+        self.connect().executemany('DELETE FROM tokens WHERE docid = ?', [(docid,) for docid in docids])
+        self.conn.commit()
+
+    def flush(self):
+        if self.pending:
+            self.connect().executemany('INSERT OR REPLACE INTO tokens VALUES (?, ?, ?)', self.pending)
+            self.conn.commit()
+            self.pending = []
+
+    def close(self):
+        self.flush()
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+测试公用的夹具
+
+code、web 两个目录里的模块按脚本方式互相导入，这里先把它们加入 sys.path。
+每个测试在临时目录中搭一套独立的环境（Workspace）：从 data/news 复制一小部分新闻，
+配置文件以仓库根目录的 config.ini 为模板，所有读写路径都改到临时目录，不会碰到 data 下的索引。
+"""
+
+import configparser
+import os
+import shutil
+import sqlite3
+import sys
+import xml.etree.ElementTree as ET
+from datetime import date
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[0:0] = [os.path.join(ROOT, 'code'), os.path.join(ROOT, 'web')]
+
+from index_module import IndexModule
+from postings_codec import decode_postings
+
+NEWS_DIR = os.path.join(ROOT, 'data', 'news')
+STOP_WORDS_PATH = os.path.join(ROOT, 'data', 'stop_words.txt')
+CORPUS_DOCS = range(1, 41)
+SITE_START = date(2019, 8, 1)
+
+
+class Workspace:
+    """临时目录中的一份配置文件与 XML 语料，config_path 可直接交给 IndexModule、SearchEngine 等"""
+
+    def __init__(self, root, docs = CORPUS_DOCS):
+        self.root = str(root)
+        self.news = os.path.join(self.root, 'news') + os.sep
+        self.config_path = os.path.join(self.root, 'config.ini')
+        os.makedirs(self.news)
+        for docid in docs:
+            self.copy(docid)
+        self.configure()
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def configure(self, **options):
+        """以仓库的 config.ini 为模板写出配置，options 覆盖 DEFAULT 中的同名项"""
+        config = configparser.ConfigParser()
+        config.read(os.path.join(ROOT, 'config.ini'), 'utf-8')
+        defaults = config['DEFAULT']
+        defaults.update({
+            'doc_dir_path': self.news,
+            'stop_words_path': STOP_WORDS_PATH,
+            'idf_path': self.path('idf.txt'),
+            'db_path': self.path('ir.db'),
+            'mmap_index_path': self.path('ir.idx'),
+            'token_cache_path': self.path('tokens.db'),
+            'frontier_path': self.path('frontier.db'),
+            'doc_store_path': '',
+            'index_workers': '1',
+            'index_memory_mb': '0',
+            'index_backend': 'sqlite',
+            'knearest_mode': 'exact',
+        })
+        for key, value in options.items():
+            defaults[key] = str(value)
+        with open(self.config_path, 'w', encoding = 'utf-8') as f:
+            config.write(f)
+
+    def config(self):
+        config = configparser.ConfigParser()
+        config.read(self.config_path, 'utf-8')
+        return config['DEFAULT']
+
+    def copy(self, docid, as_docid = None):
+        """从 data/news 复制一篇新闻，给出 as_docid 时换成这个 docid（内容不变的另一篇）"""
+        if as_docid is None:
+            shutil.copyfile(os.path.join(NEWS_DIR, '%d.xml' % docid), self.news + '%d.xml' % docid)
+            return
+        root = ET.parse(os.path.join(NEWS_DIR, '%d.xml' % docid)).getroot()
+        self.write(as_docid, root.find('title').text, root.find('body').text, root.find('datetime').text,
+                   root.find('url').text)
+
+    def write(self, docid, title, body, date_time = '2025-11-20 08:00:00', url = None):
+        """按爬虫的格式写一篇新闻"""
+        doc = ET.Element('doc')
+        ET.SubElement(doc, 'id').text = '%d' % docid
+        ET.SubElement(doc, 'url').text = url or 'http://www.chinanews.com/gn/test/%d.shtml' % docid
+        ET.SubElement(doc, 'title').text = title
+        ET.SubElement(doc, 'datetime').text = date_time
+        ET.SubElement(doc, 'body').text = body
+        ET.ElementTree(doc).write(self.news + '%d.xml' % docid, encoding = 'utf-8', xml_declaration = True)
+
+    def remove(self, docid):
+        os.remove(self.news + '%d.xml' % docid)
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    return Workspace(tmp_path / 'ws')
+
+
+@pytest.fixture
+def make_workspace(tmp_path):
+    """按需创建多个互不相干的 Workspace，如增量构建与全量重建的对照"""
+    count = [0]
+
+    def make(docs = CORPUS_DOCS):
+        count[0] += 1
+        return Workspace(tmp_path / ('ws%d' % count[0]), docs)
+    return make
+
+
+@pytest.fixture
+def site():
+    """bench_spider 的模拟站点：两天、每天 40 条新闻，含 503、404、无正文、过短与图片频道的新闻。
+    返回 (站点, 本地地址, {路径: (状态码, 内容)}, 第一次请求返回 503 的路径)"""
+    from bench_spider import build_site, serve
+    pages, flaky = build_site(SITE_START, 2, 40)
+    site, root = serve(pages, flaky, 0)
+    yield site, root, pages, flaky
+    site.shutdown()
+    site.server_close()
+
+
+def build_index(ws, **options):
+    """按 options 改写配置后全量构建索引，返回构建用的 IndexModule"""
+    if options:
+        ws.configure(**options)
+    im = IndexModule(ws.config_path, 'utf-8')
+    im.construct_postings_lists()
+    return im
+
+
+def index_terms(db_path):
+    """索引库中每个词项的 (df, idf, 存活 postings 按 docid 排序后的四列)，不论分成几个段、段如何编号"""
+    conn = sqlite3.connect(db_path)
+    dead = {}
+    for segment, docid in conn.execute('SELECT segment, docid FROM tombstones'):
+        dead.setdefault(segment, set()).add(docid)
+    postings = {}
+    for term, docs, segment in conn.execute('SELECT term, docs, segment FROM postings'):
+        cols = decode_postings(docs)
+        keep = np.array([d not in dead.get(segment, ()) for d in cols[0].tolist()], dtype=bool)
+        postings.setdefault(term, []).append([c[keep] for c in cols])
+    terms = {}
+    for term, df, idf in conn.execute('SELECT term, df, idf FROM terms'):
+        cols = [np.concatenate(c) for c in zip(*postings[term])]
+        order = np.argsort(cols[0], kind='stable')
+        terms[term] = (df, round(idf, 9), tuple(tuple(c[order].tolist()) for c in cols))
+    conn.close()
+    return terms
+
+
+def index_contents(db_path):
+    """索引库中与检索结果相关的全部内容：index_terms、(N, total_l) 与 doc_state、documents 两张表"""
+    conn = sqlite3.connect(db_path)
+    stats = dict(conn.execute('SELECT key, value FROM stats').fetchall())
+    state = sorted(conn.execute('SELECT docid, file, hash, ld, ts, terms FROM doc_state').fetchall())
+    documents = sorted(conn.execute('SELECT * FROM documents').fetchall())
+    conn.close()
+    return index_terms(db_path), (int(stats['N']), int(stats['total_l'])), state, documents
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+
+import numpy as np
+from sklearn.preprocessing import normalize
+
+from ann_index import ANNIndex
+from conftest import build_index
+from recommendation_module import RecommendationModule
+
+
+def exact_similarities(ws, k = 5):
+    """精确模式的关键词向量两两计算余弦相似度，返回 ({docid: 前 k 名的相似度（降序）}, {docid: 关键词})"""
+    rm = RecommendationModule(ws.config_path, 'utf-8')
+    rm.gen_idf_file()
+    files = rm.corpus.names()
+    docids, dt_matrix = rm.construct_dt_matrix(files, 25)
+    unit = normalize(dt_matrix).toarray()
+    sim = unit @ unit.T
+    np.fill_diagonal(sim, -np.inf)
+    return {docid: -np.sort(-sim[i])[:k] for i, docid in enumerate(docids)}, dict(rm.files_keywords(files, 25))
+
+
+def load_index(ws):
+    conn = sqlite3.connect(ws.config()['db_path'])
+    index = ANNIndex.load(conn, ws.config().getfloat('knearest_max_df'))
+    conn.close()
+    return index
+
+
+def rebuilt(index, k = 5):
+    """用同样的关键词向量一次插入全部文档重新查询，作为增量维护结果的对照"""
+    fresh = ANNIndex(index.max_df)
+    for docid, (h, terms, weights) in sorted(index.docs.items()):
+        fresh.add(docid, h, dict(zip(terms, weights)))
+    fresh.update(k)
+    return fresh
+
+
+def assert_same_neighbours(a, b):
+    assert sorted(a.neighbours) == sorted(b.neighbours)
+    for docid, (ids, sims) in a.neighbours.items():
+        assert np.allclose(sims, b.neighbours[docid][1])
+        assert ids.tolist() == b.neighbours[docid][0].tolist()
+
+
+def test_ann_recall_against_exact(workspace):
+    exact, keywords = exact_similarities(workspace)
+    comparisons = {}
+    for max_df in (1.0, 0.125): # 40 篇中 df 超过 5 的关键词跳过
+        index = ANNIndex(max_df)
+        for docid, cleaned_dict in keywords.items():
+            index.add(docid, '', cleaned_dict)
+        assert index.update(5) == 40
+        comparisons[max_df] = index.comparisons
+        sims = {docid: index.neighbours[docid][1] for docid in exact}
+        # 并列的新闻谁先谁后两边可以不同，按每个名次上的相似度比较
+        hits = sum(np.isclose(sims[docid], exact[docid]).sum() for docid in exact) / (5 * len(exact))
+        assert all((sims[docid] <= exact[docid] + 1e-12).all() for docid in exact)
+        if max_df == 1.0: # 不跳过任何关键词，即精确结果
+            assert hits == 1.0
+        else:
+            assert 0.95 <= hits < 1.0
+    assert comparisons[0.125] < comparisons[1.0] < 40 * 39 # 只和有共同关键词的新闻比较
+
+
+def test_incremental_updates_match_rebuild(workspace):
+    im = build_index(workspace, knearest_mode = 'ann', knearest_max_df = 1) # 不跳过关键词，与精确结果相同
+    rm = RecommendationModule(workspace.config_path, 'utf-8')
+    assert rm.update_ann_k_nearest(5, 25) == 40
+    exact, keywords = exact_similarities(workspace)
+    index = load_index(workspace)
+    assert all(np.allclose(index.neighbours[docid][1], exact[docid]) for docid in exact)
+
+    for docid in range(41, 46):
+        workspace.copy(docid)
+    workspace.copy(7, 46) # 与 7 内容相同，成为彼此的第一名
+    workspace.write(2, '改写的标题', '改写后的正文：二十国集团峰会在南非约翰内斯堡召开，李强出席并讲话。')
+    workspace.remove(3)
+    im.update_index()
+    assert RecommendationModule(workspace.config_path, 'utf-8').update_ann_k_nearest(5, 25) > 0
+    index = load_index(workspace)
+    assert sorted(index.docs) == sorted(set(range(1, 47)) - {3})
+    assert all(3 not in ids for ids, sims in index.neighbours.values())
+    assert index.neighbours[7][0][0] == 46 and index.neighbours[46][0][0] == 7
+    assert_same_neighbours(index, rebuilt(index))
+
+    conn = sqlite3.connect(workspace.config()['db_path'])
+    rows = {r[0]: list(r[1:]) for r in conn.execute('SELECT * FROM knearest')}
+    conn.close()
+    assert rows == {docid: ids.tolist() for docid, (ids, sims) in index.neighbours.items()}
+    assert RecommendationModule(workspace.config_path, 'utf-8').update_ann_k_nearest(5, 25) == 0 # 没有变化时不重新查询
+
+
+def test_idf_drift_rekeys_old_vectors(make_workspace):
+    """语料从 20 篇增加到 60 篇，idf 普遍变化：超过阈值的旧新闻重新提取关键词，推荐结果与精确模式一致；
+    阈值很大时旧新闻保留原先的权重，与新新闻的相似度偏离精确结果"""
+    drifted = {}
+    for drift in (0, 1000):
+        ws = make_workspace(docs = range(1, 21))
+        im = build_index(ws, knearest_mode = 'ann', knearest_max_df = 1, knearest_idf_drift = drift)
+        RecommendationModule(ws.config_path, 'utf-8').update_ann_k_nearest(5, 25)
+        for docid in range(21, 61):
+            ws.copy(docid)
+        im.update_index()
+        RecommendationModule(ws.config_path, 'utf-8').update_ann_k_nearest(5, 25)
+        exact, keywords = exact_similarities(ws)
+        index = load_index(ws)
+        drifted[drift] = [docid for docid in exact if not np.allclose(index.neighbours[docid][1], exact[docid])]
+        assert_same_neighbours(index, rebuilt(index))
+    assert drifted[0] == []
+    assert drifted[1000] != []
+
+
+def test_stale_compares_keyword_idf():
+    index = ANNIndex()
+    index.add(1, 'h', {'峰会': 1.0, '李强': 0.5}, {'峰会': 2.0, '李强': 4.0})
+    index.add(2, 'h', {'峰会': 1.0}, {'峰会': 2.0})
+    index.add(3, 'h', {'峰会': 1.0}) # 不知道提取时的 idf
+    assert index.stale({'峰会': 2.05, '李强': 4.1}, 0.05) == [3]
+    assert index.stale({'峰会': 2.05, '李强': 4.5}, 0.05) == [1, 3]
+    assert index.stale({'峰会': 2.0}, 0.05) == [1, 3] # “李强”已不在词表中
+    assert index.stale({'峰会': 2.2, '李强': 4.0}, 0.05) == [1, 2, 3]
+
+
+def test_ann_fewer_docs_than_k(make_workspace):
+    ws = make_workspace(docs = [1, 2, 3])
+    im = build_index(ws, knearest_mode = 'ann', knearest_max_df = 1)
+    RecommendationModule(ws.config_path, 'utf-8').update_ann_k_nearest(5, 25)
+    conn = sqlite3.connect(ws.config()['db_path'])
+    rows = conn.execute('SELECT * FROM knearest ORDER BY id').fetchall()
+    conn.close()
+    assert [r[0] for r in rows] == [1, 2, 3] and all(r[3:] == (None, None, None) for r in rows)
+
+    for docid in range(4, 11): # 新闻增加后，原先不满 5 篇的推荐列表也要补足
+        ws.copy(docid)
+    im.update_index()
+    RecommendationModule(ws.config_path, 'utf-8').update_ann_k_nearest(5, 25)
+    index = load_index(ws)
+    assert all(len(ids) == 5 for ids, sims in index.neighbours.values())
+    assert_same_neighbours(index, rebuilt(index))
+
+
+def test_single_doc():
+    index = ANNIndex()
+    index.add(1, 'h', {'峰会': 1.0})
+    assert index.update(5) == 1
+    assert index.k_nearest() == [[1, []]]
+    index.add(2, 'h', {'峰会': 0.5, '李强': 0.5})
+    index.update(5)
+    assert index.k_nearest() == [[1, [2]], [2, [1]]]
+    assert np.allclose(index.neighbours[1][1], [np.sqrt(0.5)])
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+import bench_extract
+from bench_extract import fallbacks, load_samples
+
+spider = bench_extract.spider
+SAMPLES = load_samples()
+
+
+@pytest.mark.parametrize('name, html', SAMPLES, ids = [name for name, html in SAMPLES])
+def test_lxml_matches_bs4(name, html):
+    assert spider.parse_news_page_lxml(html) == spider.parse_news_page(html)
+
+
+def test_fast_path_covers_regular_pages():
+    """只有 lxml 与 html.parser 结果可能不同的写法才改用 BeautifulSoup"""
+    used = fallbacks(SAMPLES)
+    assert used == ['06_inline.html', '08_broken.html', '12_odd_refs.html']
+    assert spider.parse_news_page_lxml(dict(SAMPLES)['09_no_body.html']) is None
+
+
+PAGE = '<html><head><meta charset="utf-8"></head><body><div class="left_zw">%s</div></body></html>'
+
+
+@pytest.mark.parametrize('markup, needs_bs', [
+    ('<p>第一段</p><p>第二段</p>', False),
+    ('<p>第一段<p>第二段</p>', True), # <p> 未闭合
+    ('<p>A&amp;B&nbsp;C&#20013;&#x6587;</p>', False),
+    ('<p>A&foo;B</p>', True), # 不认识的实体
+    ('<p>&#150;</p>', True), # windows-1252 替换
+    ('<p>正文<![CDATA[x]]></p>', True),
+    ('<p>正文</p></body><p>尾部</p>', True), # </body> 之后还有内容
+    ('<p>正文</p><!-- <p> 注释中的标签 --><script>var p = "<p>";</script>', False),
+])
+def test_needs_bs(markup, needs_bs):
+    data = (PAGE % markup).encode('utf-8')
+    assert spider._needs_bs(data) == needs_bs
+    assert spider.parse_news_page_lxml(data) == spider.parse_news_page(data)
+
+
+@pytest.mark.parametrize('markup', [
+    '<p>第一段</div><p>第二段</p>', # 多余的结束标签
+    '<p>第一\r\n段</p>',
+    '<p>段落<br></br>换行</p>',
+    '<p><style>p {}</style><template>模板</template>正文 文字</p>',
+])
+def test_parser_differences_fall_back(markup):
+    data = (PAGE % markup).encode('utf-8')
+    assert spider.parse_news_page_lxml(data) == spider.parse_news_page(data)
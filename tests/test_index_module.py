@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+import os
+import pickle
+import shutil
+import sqlite3
+
+import pytest
+
+from conftest import build_index, index_contents
+from index_module import IndexModule, PostingsList
+from postings_codec import datetime_to_epoch
+
+
+def raw_index(db_path):
+    """逐行读出 postings、terms、doc_state、documents 与 stats，用于逐字节比较"""
+    conn = sqlite3.connect(db_path)
+    tables = {}
+    for table, order in (('postings', 'term, segment'), ('terms', 'term'), ('doc_state', 'docid'),
+                         ('documents', 'id'), ('stats', 'key')):
+        tables[table] = conn.execute('SELECT * FROM %s ORDER BY %s' % (table, order)).fetchall()
+    conn.close()
+    for i, row in enumerate(tables['doc_state']): # 文件的 mtime 因复制时刻而异
+        tables['doc_state'][i] = row[:2] + row[3:]
+    return tables
+
+
+def test_parallel_build_matches_serial(make_workspace):
+    serial, parallel = make_workspace(), make_workspace()
+    build_index(serial, index_workers = 1)
+    build_index(parallel, index_workers = 3)
+    assert raw_index(parallel.config()['db_path']) == raw_index(serial.config()['db_path'])
+    assert parallel.config()['avg_l'] == serial.config()['avg_l']
+
+
+def rebuild_like(make_workspace, ws):
+    """用 ws 当前的全部新闻文件在另一个目录全量构建，返回这个 Workspace"""
+    full = make_workspace(docs = [])
+    for name in os.listdir(ws.news):
+        shutil.copyfile(ws.news + name, full.news + name)
+    build_index(full)
+    return full
+
+
+def contents(ws):
+    return index_contents(ws.config()['db_path'])
+
+
+def test_update_index_matches_rebuild(make_workspace):
+    ws = make_workspace(docs = range(1, 31))
+    im = build_index(ws)
+
+    for docid in range(31, 36):
+        ws.copy(docid)
+    ws.write(5, '修改后的标题', '修改后的正文，北京今天举行新闻发布会。')
+    ws.remove(7)
+    assert im.update_index() == (6, 1)
+    assert contents(ws) == contents(rebuild_like(make_workspace, ws))
+
+    # 只检查给出的文件：新增、修改、删除各一部分，未列出的文件不受影响
+    for docid in range(36, 41):
+        ws.copy(docid)
+    ws.write(31, '又一次修改', '正文再次修改，上海举行发布会。')
+    ws.remove(32)
+    changed = ['%d.xml' % docid for docid in (31, 32, 36, 37, 38, 39, 40)]
+    assert im.update_index(changed) == (6, 1)
+    assert contents(ws) == contents(rebuild_like(make_workspace, ws))
+
+    # 只改 mtime、内容不变的文件不算变化
+    os.utime(ws.news + '1.xml', (1, 1))
+    assert im.update_index() == (0, 0)
+    assert ws.config().getint('n') == 38
+
+
+@pytest.mark.parametrize('memory_mb', [0, 1])
+def test_first_update_builds_full_index(make_workspace, memory_mb):
+    """还没有索引时 update_index 退化为全量构建（index_memory_mb > 0 时走流式构建），返回建入的文档数"""
+    ws = make_workspace(docs = range(1, 6))
+    ws.configure(index_memory_mb = memory_mb)
+    im = IndexModule(ws.config_path, 'utf-8')
+    assert im.update_index() == (5, 0)
+    assert ws.config().getint('n') == 5
+
+
+def search_all(ws, queries):
+    from search_engine import SearchEngine
+    se = SearchEngine(ws.config_path, 'utf-8')
+    results = [(se.search(q, 0), se.search(q, 1)[0]) for q in queries]
+    se.close()
+    return results
+
+
+def test_segments_tombstones_and_merges_match_rebuild(make_workspace):
+    ws = make_workspace(docs = range(1, 11))
+    im = build_index(ws, merge_factor = 1000) # 先不合并，攒出多个段
+    db_path = ws.config()['db_path']
+    for start in range(11, 41, 6):
+        for docid in range(start, start + 6):
+            ws.copy(docid)
+        im.update_index()
+    for docid in (2, 13, 25):
+        ws.write(docid, '第 %d 篇改写' % docid, '改写后的正文：峰会在北京召开，各国领导人出席。')
+    for docid in (3, 4, 5, 6, 14):
+        ws.remove(docid)
+    im.update_index()
+
+    conn = sqlite3.connect(db_path)
+    assert conn.execute('SELECT count(*) FROM segments').fetchone()[0] == 7
+    dead = dict(conn.execute('SELECT segment, count(*) FROM tombstones GROUP BY segment').fetchall())
+    conn.close()
+    assert dead == {1: 5, 2: 2, 4: 1}
+    rebuilt = rebuild_like(make_workspace, ws)
+    assert contents(ws) == contents(rebuilt)
+    queries = ['峰会 北京', '二十国集团', '中国 经济 发展', '全会 精神']
+    assert search_all(ws, queries) == search_all(rebuilt, queries)
+
+    # 段 1 的墓碑超过 TOMBSTONE_RATIO，单独重写；其余段按 merge_factor = 2 分层合并
+    assert im.merge_segments(merge_factor = 2) > 0
+    conn = sqlite3.connect(db_path)
+    assert conn.execute('SELECT count(*) FROM tombstones').fetchone()[0] == 0
+    segments = conn.execute('SELECT id, docs FROM segments').fetchall()
+    assert sum(docs for sid, docs in segments) == 35
+    assert im.merge_policy(conn.cursor(), 2) == []
+    conn.close()
+    assert contents(ws) == contents(rebuilt)
+    assert search_all(ws, queries) == search_all(rebuilt, queries)
+
+
+def test_streaming_build_matches_in_memory(make_workspace):
+    memory, streaming = make_workspace(), make_workspace()
+    build_index(memory)
+    stats = IndexModule(streaming.config_path, 'utf-8').construct_postings_lists_streaming(0.02)
+    assert stats['runs'] > 3
+    # 每篇文档分完词才检查是否溢写，峰值至多超出一篇文档的词项（这里都不到 1000 个）
+    assert stats['peak_buffer_bytes'] < 0.02 * 1024 * 1024 + 1000 * (IndexModule.TERM_BYTES + IndexModule.POSTING_BYTES)
+    assert stats['docs'] == 40
+    assert raw_index(streaming.config()['db_path']) == raw_index(memory.config()['db_path'])
+    assert streaming.config()['avg_l'] == memory.config()['avg_l']
+
+    # 通过配置 index_memory_mb 走同一条路径
+    build_index(streaming, index_memory_mb = 0.05)
+    assert raw_index(streaming.config()['db_path'])['postings'] == raw_index(memory.config()['db_path'])['postings']
+
+
+def test_postings_list():
+    t1, t2 = datetime_to_epoch('2025-11-23 23:52:00'), datetime_to_epoch('2025-11-22 08:00:00')
+    p = PostingsList()
+    p.add(3, 2, 361, t1)
+    p.add(7, 1, 40, t2)
+    assert len(p) == 2
+    docids, tf, ld, ts = p.columns()
+    assert (docids.tolist(), tf.tolist(), ld.tolist(), ts.tolist()) == ([3, 7], [2, 1], [361, 40], [t1, t2])
+    assert str(p[0]) == '3\t2025-11-23 23:52:00\t2\t361'
+    assert p[-1].docid == 7 and p[-1].date_time == '2025-11-22 08:00:00'
+    assert [d.docid for d in p] == [3, 7]
+    with pytest.raises(IndexError):
+        p[2]
+    q = pickle.loads(pickle.dumps(p))
+    assert type(q) is PostingsList and q == p
+    del docids, tf, ld, ts # columns() 是零拷贝视图，视图还在时 array 不能扩容
+    p.extend(q)
+    assert len(p) == 4 and p.columns()[0].tolist() == [3, 7, 3, 7]
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+
+import numpy as np
+
+from conftest import build_index
+from index_module import IndexModule
+from mmap_index import MmapIndex, write_mmap_index
+from search_engine import SearchEngine
+
+QUERIES = ['李强 峰会', '二十国集团', '中国 经济 发展', '北京', '健康 科技', '宣言', '全会 精神', '不存在的词项组合xyz']
+
+
+def engines(ws):
+    """同一个索引库分别以 sqlite 与 mmap 方式打开的两个检索端"""
+    ws.configure(index_backend = 'sqlite')
+    sql = SearchEngine(ws.config_path, 'utf-8')
+    ws.configure(index_backend = 'mmap')
+    mm = SearchEngine(ws.config_path, 'utf-8')
+    return sql, mm
+
+
+def assert_same_results(sql, mm):
+    for q in QUERIES:
+        assert mm.search(q, 0) == sql.search(q, 0)
+        for sort_type in (1, 2):
+            a, b = mm.search(q, sort_type), sql.search(q, sort_type)
+            assert a[0] == b[0] and [d for d, s in a[1]] == [d for d, s in b[1]]
+
+
+def test_mmap_matches_sqlite(workspace):
+    im = build_index(workspace, index_backend = 'mmap', merge_factor = 1000)
+    for docid in range(41, 46):
+        workspace.copy(docid)
+    workspace.write(2, '改写的标题', '改写后的正文：二十国集团峰会在北京召开。')
+    workspace.remove(3)
+    im.update_index() # 多个段、带墓碑，导出时合并
+    db_path = workspace.config()['db_path']
+    conn = sqlite3.connect(db_path)
+    assert conn.execute('SELECT count(*) FROM tombstones').fetchone()[0] == 2
+    terms = conn.execute('SELECT term, df, idf FROM terms').fetchall()
+    conn.close()
+
+    sql, mm = engines(workspace)
+    assert mm.mmap_index is not None and sql.mmap_index is None
+    assert (mm.N, mm.AVG_L, mm.index_generation) == (sql.N, sql.AVG_L, sql.index_generation)
+    index = MmapIndex(workspace.config()['mmap_index_path'])
+    assert len(index.entries) == len(terms)
+    for term, df, idf in terms:
+        assert index.lookup(term)[:2] == (df, idf)
+        a, b = mm.decode_term(term), sql.decode_term(term)
+        for x, y in zip(a[:5], b[:5]): # docid、tf、ld、ts 与 idf
+            assert np.array_equal(x, y)
+        # 导出时上界按存活记录重新计算，不比 sqlite 端各段原记录的上界宽
+        assert a[5] == a[1].max() <= b[5]
+        assert a[6] == a[2].min() >= b[6]
+    assert index.lookup('不存在的词项') is None
+    assert_same_results(sql, mm)
+
+    # 增量更新后重新导出，检索端在下次查询时切换到新文件，旧文件的映射随即关闭
+    del a, b, x, y # 上面解码出的零拷贝视图会让旧映射保留到它们释放
+    old = mm.mmap_index
+    workspace.remove(41)
+    im.update_index()
+    assert mm.mmap_index.changed()
+    assert_same_results(sql, mm)
+    assert mm.mmap_index is not old and old.closed and old.mm.closed
+    current = mm.mmap_index
+    mm.reload()
+    assert current.mm.closed and not mm.mmap_index.mm.closed
+    assert mm.index_generation == sql.index_generation == 3
+    sql.close()
+    mm.close()
+
+
+def test_write_mmap_index_is_atomic(workspace, tmp_path):
+    build_index(workspace)
+    path = str(tmp_path / 'ir.idx')
+    n = write_mmap_index(workspace.config()['db_path'], path)
+    old = MmapIndex(path)
+    assert len(old.entries) == n
+    term = bytes(old.mm[old.term_off[0]:old.term_end[0]]).decode('utf-8')
+    write_mmap_index(workspace.config()['db_path'], path)
+    assert old.changed() and not MmapIndex(path).changed()
+    assert old.lookup(term) is not None # 已打开的旧映射不受替换影响
+
+
+def test_close_waits_for_readers(workspace, tmp_path):
+    build_index(workspace)
+    path = str(tmp_path / 'ir.idx')
+    write_mmap_index(workspace.config()['db_path'], path)
+    index = MmapIndex(path)
+    assert index.acquire()
+    index.close() # 还有线程在读取，推迟到 release
+    assert not index.mm.closed and index.lookup('北京') is not None
+    index.release()
+    assert index.closed and index.mm.closed
+    assert not index.acquire()
+
+    index = MmapIndex(path)
+    df, idf, [(docs, max_tf, min_ld, skips, segment)] = index.lookup('北京')
+    index.close() # 查到的 memoryview 仍被引用，映射保留到它释放
+    assert index.closed and not index.mm.closed
+    assert bytes(docs) == bytes(MmapIndex(path).lookup('北京')[2][0][0])
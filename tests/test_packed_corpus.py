@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+
+from doc_store import DirectoryCorpus
+from packed_corpus import BLOCK, ENTRY, INDEX_MAGIC, PACK_MAGIC, PackedCorpus, pack_corpus, unpack_corpus, zstandard
+
+
+def read_dir(path):
+    return {name: (open(os.path.join(path, name), 'rb').read(), os.path.getmtime(os.path.join(path, name)))
+            for name in os.listdir(path)}
+
+
+def docs(n, start = 1, tag = ''):
+    return [(docid, ('<doc><id>%d</id><body>%s%s</body></doc>' % (docid, tag, '正文' * (docid % 50 + 10))).encode('utf-8'))
+            for docid in range(start, start + n)]
+
+
+def write(corpus, items):
+    for docid, data in items:
+        corpus.put('%d.xml' % docid, docid, data)
+    return corpus.commit()
+
+
+@pytest.mark.parametrize('compression', ['none', 'zlib', 'zstd'])
+def test_pack_unpack_round_trip(workspace, tmp_path, compression):
+    if compression == 'zstd' and zstandard is None:
+        pytest.skip('没有安装 zstandard')
+    path = str(tmp_path / 'corpus.pack')
+    corpus = PackedCorpus(path, compression, block_kb = 4) # 块很小，40 篇分在多个块中
+    assert pack_corpus(DirectoryCorpus(workspace.news), corpus, batch = 7) == 40
+    corpus.close()
+
+    reader = PackedCorpus(path)
+    expected = read_dir(workspace.news)
+    assert reader.names() == sorted(expected, key = lambda name: int(name.split('.')[0]))
+    assert len({e[0] for e in reader.entries.values()}) > 5
+    for name, (data, mtime) in expected.items():
+        assert reader.read(name) == data and reader.mtime(name) == mtime
+    assert not reader.exists('41.xml') and not reader.exists('a.xml')
+    with pytest.raises(FileNotFoundError):
+        reader.read('41.xml')
+    out = str(tmp_path / 'unpacked')
+    assert unpack_corpus(reader, out) == 40
+    assert read_dir(out) == expected
+
+
+def test_rewrite_and_concurrent_reader(tmp_path):
+    path = str(tmp_path / 'corpus.pack')
+    writer = PackedCorpus(path, 'zlib', block_kb = 1)
+    write(writer, docs(20))
+    reader = PackedCorpus(path)
+    assert len(reader) == 20 and reader.get(21) is None
+    write(writer, docs(5, start = 3, tag = '新') + docs(5, start = 21))
+    assert reader.get(25) == dict(docs(5, start = 21))[25] # 读取进程查不到时读入新追加的索引项
+    assert reader.get(4) == dict(docs(5, start = 3, tag = '新'))[4]
+    scanned = list(PackedCorpus(path).scan())
+    assert [docid for docid, mtime, data in scanned] == [1, 2] + list(range(8, 21)) + list(range(3, 8)) + list(range(21, 26))
+    assert dict((docid, data) for docid, mtime, data in scanned) == dict(docs(25)) | dict(docs(5, start = 3, tag = '新'))
+
+
+def test_torn_tail_is_truncated(tmp_path):
+    path = str(tmp_path / 'corpus.pack')
+    corpus = PackedCorpus(path, block_kb = 1)
+    write(corpus, docs(10))
+    corpus.close()
+    size = os.path.getsize(path)
+    with open(path, 'ab') as f: # 写数据块时崩溃：块头完整，内容只写了一半
+        f.write(BLOCK.pack(0, 1000, 1000, 0) + b'x' * 300)
+
+    corpus = PackedCorpus(path, block_kb = 1)
+    assert len(corpus) == 10 and corpus.end == size
+    write(corpus, docs(3, start = 11))
+    assert os.path.getsize(path) > size
+    reopened = PackedCorpus(path)
+    assert reopened.names() == ['%d.xml' % i for i in range(1, 14)]
+    assert all(reopened.get(docid) == data for docid, data in docs(13))
+
+
+def crash_before_index(corpus, items):
+    """模拟 commit 中数据块已落盘、索引项还没写入时崩溃"""
+    index = open(corpus.index_path, 'rb').read()
+    write(corpus, items)
+    corpus.close()
+    with open(corpus.index_path, 'wb') as f:
+        f.write(index)
+
+
+def test_unindexed_blocks_are_recovered(tmp_path):
+    path = str(tmp_path / 'corpus.pack')
+    corpus = PackedCorpus(path, block_kb = 1)
+    write(corpus, docs(10))
+    crash_before_index(corpus, docs(5, start = 11))
+
+    corpus = PackedCorpus(path, block_kb = 1)
+    assert len(corpus) == 15 and len(corpus.unindexed) == 5
+    assert corpus.get(13) == dict(docs(15))[13]
+    write(corpus, docs(1, start = 16)) # 下次 commit 时补写索引项
+    with open(corpus.index_path, 'rb') as f:
+        index = f.read()
+    assert index.startswith(INDEX_MAGIC) and len(index) == len(INDEX_MAGIC) + 16 * ENTRY.size
+    reopened = PackedCorpus(path)
+    assert reopened.names() == ['%d.xml' % i for i in range(1, 17)] and reopened.unindexed == []
+
+
+def test_torn_index_entry_is_rewritten(tmp_path):
+    path = str(tmp_path / 'corpus.pack')
+    corpus = PackedCorpus(path, block_kb = 1)
+    write(corpus, docs(10))
+    corpus.close()
+    with open(corpus.index_path, 'r+b') as f: # 最后一项只写了一部分
+        f.truncate(os.path.getsize(corpus.index_path) - ENTRY.size // 2)
+
+    corpus = PackedCorpus(path, block_kb = 1)
+    assert len(corpus) == 10 and [e[0] for e in corpus.unindexed] == [10]
+    write(corpus, docs(1, start = 11))
+    assert os.path.getsize(corpus.index_path) == len(INDEX_MAGIC) + 11 * ENTRY.size
+    assert all(PackedCorpus(path).get(docid) == data for docid, data in docs(11))
+
+
+def test_crc_mismatch_drops_unindexed_block(tmp_path):
+    path = str(tmp_path / 'corpus.pack')
+    corpus = PackedCorpus(path, block_kb = 1)
+    write(corpus, docs(10))
+    end = os.path.getsize(path)
+    crash_before_index(corpus, docs(5, start = 11))
+    with open(path, 'r+b') as f: # 还没编入索引的块内容损坏
+        f.seek(end + BLOCK.size + 10)
+        byte = f.read(1)
+        f.seek(end + BLOCK.size + 10)
+        f.write(bytes([byte[0] ^ 0xff]))
+
+    corpus = PackedCorpus(path, block_kb = 1)
+    assert len(corpus) == 10 and corpus.get(11) is None and corpus.end == end
+    write(corpus, docs(2, start = 21, tag = '新'))
+    reopened = PackedCorpus(path)
+    assert reopened.names() == ['%d.xml' % i for i in list(range(1, 11)) + [21, 22]]
+    assert reopened.get(21) == dict(docs(2, start = 21, tag = '新'))[21]
+    assert all(reopened.get(docid) == data for docid, data in docs(10))
+
+
+def test_rejects_foreign_files(tmp_path):
+    path = str(tmp_path / 'corpus.pack')
+    with open(path, 'wb') as f:
+        f.write(b'not a pack')
+    with pytest.raises(ValueError):
+        PackedCorpus(path).names()
+    with open(path, 'wb') as f:
+        f.write(PACK_MAGIC)
+    with open(path + '.idx', 'wb') as f:
+        f.write(b'not an index')
+    with pytest.raises(ValueError):
+        PackedCorpus(path).names()
+    with pytest.raises(ValueError):
+        PackedCorpus(path, 'lz4')
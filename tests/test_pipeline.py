@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+from datetime import timedelta
+
+import pytest
+
+import bench_spider
+from conftest import SITE_START, build_index, index_terms
+from doc_store import open_corpus
+from frontier import Frontier
+from pipeline import CrawlPipeline
+
+
+class Crash(Exception):
+    pass
+
+
+def crawler(root, crash_after = None):
+    """流水线的 crawl(frontier, sink)：抓取模拟站点；给出 crash_after 时写出这么多篇后抛出 Crash"""
+    def crawl(frontier, sink):
+        count = [0]
+
+        def failing_sink(docid, name, data):
+            if count[0] == crash_after:
+                raise Crash()
+            count[0] += 1
+            sink(docid, name, data)
+        fetcher = bench_spider.spider.Fetcher(concurrency = 4, rate = 0, backoff = 0.01)
+        news_pool = bench_spider.spider.get_news_pool(SITE_START, SITE_START + timedelta(days = 1), fetcher, root)
+        bench_spider.spider.crawl_news(news_pool, 140, '', 'utf-8', fetcher, 1, frontier,
+                                       failing_sink if crash_after is not None else sink)
+        fetcher.close()
+    return crawl
+
+
+@pytest.fixture
+def pipeline_ws(make_workspace):
+    ws = make_workspace(docs = [])
+    ws.configure(doc_store_path = ws.path('docs.db'), pipeline_batch_size = 10)
+    return ws
+
+
+def assert_matches_rebuild(ws, make_workspace):
+    """文档库中的新闻与 frontier 一致，索引与用同样的新闻全量构建的相同，changed 表已清空"""
+    config = ws.config()
+    store = open_corpus(config)
+    frontier = Frontier(config['frontier_path'])
+    assert frontier.changed_docids() == []
+    assert sorted(int(name.split('.')[0]) for name in store.names()) == sorted(frontier.docids())
+    full = make_workspace(docs = [])
+    for name in store.names():
+        with open(full.news + name, 'wb') as f:
+            f.write(store.read(name))
+    build_index(full)
+    assert index_terms(config['db_path']) == index_terms(full.config()['db_path'])
+    frontier.close()
+    return len(store.names())
+
+
+def test_pipeline_matches_full_build(site, pipeline_ws, make_workspace):
+    site, root, pages, flaky = site
+    stats = CrawlPipeline(pipeline_ws.config_path, 'utf-8').run(crawler(root))
+    docs = assert_matches_rebuild(pipeline_ws, make_workspace)
+    assert stats['docs'] == stats['added'] == docs > 0
+    assert stats['batches'] == -(-docs // 10)
+    assert stats['recovered'] == stats['reset'] == 0
+
+
+def test_crawler_crash_keeps_queued_docs(site, pipeline_ws, make_workspace):
+    """爬虫线程出错时，已交给 sink 的新闻仍写进文档库并建索引，下次运行只抓取剩下的"""
+    site, root, pages, flaky = site
+    with pytest.raises(Crash):
+        CrawlPipeline(pipeline_ws.config_path, 'utf-8').run(crawler(root, crash_after = 25))
+    assert len(open_corpus(pipeline_ws.config()).names()) == 25
+    assert_matches_rebuild(pipeline_ws, make_workspace)
+
+    site.reset(set())
+    stats = CrawlPipeline(pipeline_ws.config_path, 'utf-8').run(crawler(root))
+    docs = assert_matches_rebuild(pipeline_ws, make_workspace)
+    assert stats['docs'] == docs - 25 and stats['recovered'] == stats['reset'] == 0
+
+
+def crash_on_second_call(monkeypatch, obj, name):
+    calls = [0]
+    original = getattr(obj, name)
+
+    def wrapper(*args):
+        calls[0] += 1
+        if calls[0] == 2:
+            raise Crash()
+        return original(*args)
+    monkeypatch.setattr(obj, name, wrapper)
+
+
+def test_recover_after_store_crash(site, pipeline_ws, make_workspace, monkeypatch):
+    """第二批写文档库时中断：已记入 frontier、还没写进文档库的 docid 下次重新抓取并沿用原 docid"""
+    site, root, pages, flaky = site
+    pipeline = CrawlPipeline(pipeline_ws.config_path, 'utf-8')
+    crash_on_second_call(monkeypatch, pipeline.store, 'commit')
+    with pytest.raises(Crash):
+        pipeline.run(crawler(root))
+    pipeline.store.pending = [] # 进程崩溃时没提交的写入随之丢失
+    config = pipeline_ws.config()
+    assert len(open_corpus(config).names()) == 10
+    frontier = Frontier(config['frontier_path'])
+    docids = frontier.docids()
+    lost = len(frontier.changed_docids()) - 10
+    frontier.close()
+    assert lost >= 10
+
+    site.reset(set())
+    stats = CrawlPipeline(pipeline_ws.config_path, 'utf-8').run(crawler(root))
+    docs = assert_matches_rebuild(pipeline_ws, make_workspace)
+    assert stats['reset'] == lost and stats['recovered'] == 10 # 第一批已建过索引，按 sha1 判定未变化
+    assert stats['docs'] == docs - 10
+    frontier = Frontier(config['frontier_path'])
+    assert docids <= frontier.docids() # 原先分配的 docid 不变，重新抓取的新闻写回原 docid
+    frontier.close()
+
+
+def test_recover_after_index_crash(site, pipeline_ws, make_workspace, monkeypatch):
+    """第二批写进文档库后、建索引前中断：下次启动时由 recover 补建索引，不必重新抓取"""
+    site, root, pages, flaky = site
+    pipeline = CrawlPipeline(pipeline_ws.config_path, 'utf-8')
+    crash_on_second_call(monkeypatch, pipeline.im, 'update_index')
+    with pytest.raises(Crash):
+        pipeline.run(crawler(root))
+    config = pipeline_ws.config()
+    assert len(open_corpus(config).names()) == 20
+
+    site.reset(set())
+    stats = CrawlPipeline(pipeline_ws.config_path, 'utf-8').run(crawler(root))
+    docs = assert_matches_rebuild(pipeline_ws, make_workspace)
+    assert stats['recovered'] == 20 and stats['reset'] > 0
+    assert stats['docs'] == docs - 20
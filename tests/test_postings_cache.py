@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from postings_cache import FrequencySketch, PostingsCache
+
+
+def postings(n):
+    """与 term_postings 的缓存值同样形状：四列数组加若干标量"""
+    a = np.zeros(n, dtype = np.int64)
+    return (a, a.copy(), a.copy(), a.copy(), 1.0, 1, 1, None)
+
+
+ENTRY = PostingsCache.ENTRY_BYTES + 4 * 8 * 100 # postings(100) 的字节数
+
+
+def test_sketch_counts_saturate_and_age():
+    sketch = FrequencySketch(1024)
+    for i in range(20):
+        sketch.increment('热')
+    sketch.increment('冷')
+    assert sketch.frequency('热') == 15
+    assert sketch.frequency('冷') >= 1
+    for i in range(sketch.sample_size):
+        sketch.increment('其他%d' % (i % 7))
+    assert sketch.frequency('热') == 7 # 采样满后全部减半
+
+
+def test_tinylfu_rejects_cold_term():
+    cache = PostingsCache(3 * ENTRY)
+    for term in ('中国', '北京', '经济'):
+        for i in range(5):
+            cache.get(term)
+        cache.put(term, postings(100))
+    assert cache.stats()['entries'] == 3 and cache.bytes == 3 * ENTRY
+
+    cache.get('长尾词') # 只被查询过一次
+    cache.put('长尾词', postings(100))
+    assert cache.get('长尾词') is None
+    assert all(cache.get(term) is not None for term in ('中国', '北京', '经济'))
+    stats = cache.stats()
+    assert stats['rejections'] == 1 and stats['evictions'] == 0
+
+
+def test_tinylfu_admits_frequent_term():
+    cache = PostingsCache(3 * ENTRY)
+    for term in ('甲', '乙', '丙'):
+        cache.get(term)
+        cache.put(term, postings(100))
+    cache.get('乙')
+    cache.get('丙') # LRU 尾部现在是“甲”
+    for i in range(6):
+        cache.get('热词')
+    cache.put('热词', postings(100))
+    assert cache.get('热词') is not None
+    assert cache.get('甲') is None
+    assert cache.stats()['evictions'] == 1
+    assert cache.bytes == 3 * ENTRY
+
+
+def test_tinylfu_must_beat_every_victim():
+    """需要挤掉多个条目时，新词项必须比其中每一个都更常被查询；被拒绝时不淘汰任何条目"""
+    cache = PostingsCache(3 * ENTRY)
+    for term, freq in (('甲', 1), ('乙', 10), ('丙', 1)):
+        for i in range(freq):
+            cache.get(term)
+        cache.put(term, postings(100))
+    for i in range(3):
+        cache.get('大词')
+    cache.put('大词', postings(200)) # 要挤掉“甲”“乙”两个，比“甲”常用，但不如“乙”
+    assert cache.get('大词') is None
+    assert cache.get('甲') is not None and cache.get('乙') is not None
+    assert cache.stats()['rejections'] == 1 and cache.stats()['evictions'] == 0
+
+
+def test_oversized_and_disabled():
+    assert PostingsCache(0).put('x', postings(1)) is None
+    cache = PostingsCache(ENTRY)
+    cache.put('x', postings(1000))
+    assert cache.stats()['entries'] == 0 and cache.stats()['rejections'] == 0
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+import time
+
+import numpy as np
+import pytest
+
+from conftest import build_index, index_terms
+from postings_codec import (BLOCK_SIZE, DATETIME_FORMAT, datetime_to_epoch, decode_postings, decode_skips,
+                            encode_postings, migrate_db, postings_row)
+
+
+def random_columns(rng, n, max_docid = 10 ** 6):
+    docids = rng.choice(max_docid, size = n, replace = False)
+    tf = rng.integers(1, 300, size = n)
+    ld = rng.integers(1, 70000, size = n)
+    ts = rng.integers(1.5e9, 1.8e9, size = n)
+    return docids, tf, ld, ts
+
+
+@pytest.mark.parametrize('n', [0, 1, BLOCK_SIZE, 1000])
+def test_round_trip_sorts_by_docid(n):
+    docids, tf, ld, ts = random_columns(np.random.default_rng(n), n)
+    blob, columns = encode_postings(docids, tf, ld, ts)
+    decoded = decode_postings(blob)
+    order = np.argsort(docids)
+    for expected, sorted_column, decoded_column in zip((docids, tf, ld, ts), columns, decoded):
+        assert sorted_column.tolist() == expected[order].tolist()
+        assert decoded_column.tolist() == expected[order].tolist()
+
+
+def test_wide_columns():
+    docids = np.array([2 ** 40, 3, 70000])
+    blob, columns = encode_postings(docids, [1, 2 ** 33, 5], [300, 2, 1], [0, 2 ** 40, 10])
+    assert [c.tolist() for c in decode_postings(blob)] == [[3, 70000, 2 ** 40], [2 ** 33, 5, 1], [2, 1, 300],
+                                                           [2 ** 40, 10, 0]]
+
+
+def test_postings_row_bounds_and_skips():
+    docids, tf, ld, ts = random_columns(np.random.default_rng(7), 3 * BLOCK_SIZE + 5)
+    term, df, docs, max_tf, min_ld, skips = postings_row('词', docids, tf, ld, ts)
+    d, t, l, s = decode_postings(docs)
+    assert (term, df, max_tf, min_ld) == ('词', len(docids), tf.max(), ld.min())
+    skips = decode_skips(skips)
+    assert len(skips) == 4
+    for b, skip in enumerate(skips):
+        block = slice(b * BLOCK_SIZE, (b + 1) * BLOCK_SIZE)
+        assert skip['last'] == d[block][-1]
+        assert skip['max_tf'] == t[block].max()
+        assert skip['min_ld'] == l[block].min()
+
+
+def text_postings(columns):
+    """旧版 TEXT 格式：'docid\\tdatetime\\ttf\\tld' 按行拼接"""
+    return '\n'.join('%d\t%s\t%d\t%d' % (docid, time.strftime(DATETIME_FORMAT, time.gmtime(ts)), tf, ld)
+                     for docid, tf, ld, ts in zip(*[c.tolist() for c in columns]))
+
+
+def test_decode_legacy_text():
+    text = '12\t2025-11-23 23:52:00\t3\t361\n5\t2025-11-22 08:00:00\t1\t40\n9\t2025-11-23 00:00:00\t2\t77'
+    docids, tf, ld, ts = decode_postings(text)
+    assert docids.tolist() == [5, 9, 12]
+    assert tf.tolist() == [1, 2, 3]
+    assert ld.tolist() == [40, 77, 361]
+    assert ts.tolist() == [datetime_to_epoch('2025-11-22 08:00:00'), datetime_to_epoch('2025-11-23 00:00:00'),
+                           datetime_to_epoch('2025-11-23 23:52:00')]
+
+
+def test_migrate_db(workspace):
+    """把新建的索引改写成旧版的单表 TEXT 格式，迁移后的 postings、df 与 idf 与原索引相同"""
+    build_index(workspace)
+    db_path = workspace.config()['db_path']
+    expected = index_terms(db_path)
+    conn = sqlite3.connect(db_path)
+    rows = [(term, df, text_postings(decode_postings(docs)))
+            for term, df, docs in conn.execute('SELECT term, df, docs FROM postings')]
+    for table in ('postings', 'terms', 'segments', 'tombstones'):
+        conn.execute('DROP TABLE %s' % table)
+    conn.execute('CREATE TABLE postings (term TEXT PRIMARY KEY, df INTEGER, docs TEXT)')
+    conn.executemany('INSERT INTO postings VALUES (?, ?, ?)', rows)
+    conn.commit()
+    conn.close()
+
+    assert migrate_db(db_path) == len(rows)
+    conn = sqlite3.connect(db_path)
+    assert conn.execute("SELECT count(*) FROM postings WHERE typeof(docs) != 'blob'").fetchone()[0] == 0
+    assert conn.execute('SELECT * FROM segments').fetchall() == [(1, 40, sum(t[0] for t in expected.values()))]
+    conn.execute('CREATE TABLE tombstones (segment INTEGER, docid INTEGER)')
+    conn.commit()
+    conn.close()
+    assert index_terms(db_path) == expected
+    assert migrate_db(db_path) == 0
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from conftest import build_index
+import query_cache
+from query_cache import QueryCache
+
+
+def test_prefix_and_complete_entries():
+    cache = QueryCache(8)
+    cache.put('a', 100, [(1, 1.0), (2, 0.5)], False)
+    assert cache.get('a', 2) == (100, [(1, 1.0), (2, 0.5)])
+    assert cache.get('a', 3) is None # 缓存的前缀不够长
+    assert cache.get('a', None) is None
+    cache.put('b', 2, [(1, 1.0), (2, 0.5)], True)
+    assert cache.get('b', 50) == (2, [(1, 1.0), (2, 0.5)])
+    assert cache.get('b', None) == (2, [(1, 1.0), (2, 0.5)])
+    assert cache.stats()['hits'] == 3 and cache.stats()['misses'] == 2
+
+
+def test_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(query_cache.time, 'monotonic', lambda: now[0])
+    cache = QueryCache(8)
+    cache.put('t', 1, [(1, 3.0)], True, ttl = 60)
+    cache.put('bm25', 1, [(1, 3.0)], True)
+    now[0] += 59
+    assert cache.get('t', 1) is not None
+    now[0] += 2
+    assert cache.get('t', 1) is None
+    assert cache.get('bm25', 1) is not None
+    assert cache.stats()['entries'] == 1
+
+
+def test_lru_eviction_by_entries_and_bytes():
+    cache = QueryCache(3)
+    for key in 'abc':
+        cache.put(key, 1, [(1, 1.0)], True)
+    cache.get('a', 1)
+    cache.put('d', 1, [(1, 1.0)], True)
+    assert cache.get('b', 1) is None and cache.get('a', 1) is not None
+    small = QueryCache(100, QueryCache.ENTRY_BYTES * 2 + QueryCache.RESULT_BYTES * 10)
+    small.put('x', 5, [(i, 1.0) for i in range(5)], True)
+    small.put('y', 5, [(i, 1.0) for i in range(5)], True)
+    small.put('z', 1, [(1, 1.0)], True)
+    assert small.get('x', None) is None and small.stats()['evictions'] == 1
+    assert small.bytes <= small.max_bytes
+    small.put('huge', 1000, [(i, 1.0) for i in range(1000)], True) # 超过上限的结果不缓存
+    assert small.get('huge', None) is None
+
+
+def test_index_generation_invalidates(workspace):
+    from search_engine import SearchEngine
+    im = build_index(workspace)
+    se = SearchEngine(workspace.config_path, 'utf-8')
+    se.search('李强 峰会', 0, 10)
+    reordered = se.search('峰会 李强', 0, 10) # 词序不同时平分文档的先后可能不同，不共用条目
+    assert se.cache_stats()['hits'] == 0 and se.cache_stats()['entries'] == 2
+    assert se.search('峰会 李强', 0, 10) == reordered and se.cache_stats()['hits'] == 1
+    fresh = SearchEngine(workspace.config_path, 'utf-8')
+    assert fresh.search('峰会 李强', 0, 10) == reordered # 与先查询过哪种词序无关
+    fresh.close()
+    total, results = se.search('二十国集团 斑头雁', 0, 10)
+    generation = se.index_generation
+
+    workspace.write(50, '斑头雁迁徙', '二十国集团 斑头雁 斑头雁 斑头雁 在青海湖栖息。')
+    im.update_index()
+    total2, results2 = se.search('二十国集团 斑头雁', 0, 10)
+    assert se.index_generation == generation + 1
+    assert total2 == total + 1 and results2[0][0] == 50
+    assert se.cache_stats()['entries'] == 1 # 旧代数的条目已整体清空
+    se.close()
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import xml.etree.ElementTree as ET
+
+import jieba
+import jieba.analyse
+import numpy as np
+import pytest
+from sklearn.metrics import pairwise_distances
+
+from conftest import STOP_WORDS_PATH, build_index
+from recommendation_module import SIMILARITY_DECIMALS, RecommendationModule
+
+
+def is_number(s):
+    try:
+        float(s)
+        return True
+    except ValueError:
+        return False
+
+
+def read_news(ws, name):
+    root = ET.parse(ws.news + name).getroot()
+    return int(root.find('id').text), root.find('title').text, root.find('body').text
+
+
+def baseline_idf(ws, files):
+    """原先的 gen_idf_file：逐篇分词，先去停用词再转小写，返回 {词: idf 文件中的取值}"""
+    import math
+    stop_words = set(open(STOP_WORDS_PATH, encoding = 'utf-8').read().split('\n'))
+    idf = {}
+    for name in files:
+        docid, title, body = read_news(ws, name)
+        for word in set(jieba.lcut(title + '。' + body, cut_all = False)) - stop_words:
+            word = word.strip().lower()
+            if word == '' or is_number(word):
+                continue
+            idf[word] = idf.get(word, 0) + 1
+    return {word: '%.9f' % math.log(len(files) / df) for word, df in idf.items()}
+
+
+def read_idf(path):
+    return dict(line.rsplit(' ', 1) for line in open(path, encoding = 'utf-8').read().splitlines())
+
+
+def baseline_keywords(ws, files, idf_path, topK):
+    """原先 construct_dt_matrix 中的关键词提取：对原文调用 jieba.analyse.extract_tags。
+    用新建的 jieba.analyse.TFIDF 而不是默认提取器，它对同一路径不会重新加载 idf 文件"""
+    extractor = jieba.analyse.TFIDF(idf_path)
+    extractor.set_stop_words(STOP_WORDS_PATH)
+    keywords = []
+    for name in files:
+        docid, title, body = read_news(ws, name)
+        cleaned = {}
+        for word, tfidf in extractor.extract_tags(title + '。' + body, topK = topK, withWeight = True):
+            word = word.strip().lower()
+            if word == '' or is_number(word):
+                continue
+            cleaned[word] = tfidf
+        keywords.append((docid, cleaned))
+    return keywords
+
+
+@pytest.fixture
+def case_variants(workspace):
+    """停用词表只收了大写的“A”“Ⅲ”；同一篇里还有大小写不同的“AI”“ai”"""
+    workspace.write(41, 'A 股与 AI 观察', 'Ⅲ 期项目启动，A 股市场关注 AI 与 ai 芯片，人工智能 AI 产业链受关注。')
+    build_index(workspace)
+    return workspace
+
+
+def test_idf_file_keeps_corpus_vocabulary(case_variants):
+    rm = RecommendationModule(case_variants.config_path, 'utf-8')
+    files = rm.corpus.names()
+    rm.gen_idf_file()
+    idf = read_idf(rm.idf_path)
+    assert idf == baseline_idf(case_variants, files)
+    assert 'a' not in idf and 'ⅲ' not in idf # terms 表里有这两个小写词项，idf 文件里不应出现
+
+
+def test_keywords_match_baseline(case_variants, tmp_path):
+    rm = RecommendationModule(case_variants.config_path, 'utf-8')
+    files = rm.corpus.names()
+    rm.gen_idf_file()
+    expected_idf = str(tmp_path / 'baseline_idf.txt')
+    with open(expected_idf, 'w', encoding = 'utf-8') as f:
+        f.writelines('%s %s\n' % item for item in baseline_idf(case_variants, files).items())
+    assert rm.files_keywords(files, 25) == baseline_keywords(case_variants, files, expected_idf, 25)
+
+
+def test_keywords_follow_rewritten_idf(workspace):
+    """同一进程里 idf 文件被改写（同一路径）后，关键词按新的 idf 计算"""
+    im = build_index(workspace)
+    rm = RecommendationModule(workspace.config_path, 'utf-8')
+    rm.gen_idf_file()
+    before = rm.files_keywords(rm.corpus.names(), 25)
+    for docid in range(41, 61):
+        workspace.copy(docid)
+    im.update_index()
+    rm = RecommendationModule(workspace.config_path, 'utf-8')
+    files = rm.corpus.names()
+    rm.gen_idf_file()
+    keywords = rm.files_keywords(files, 25)
+    assert keywords == baseline_keywords(workspace, files, rm.idf_path, 25)
+    assert dict(keywords)[1] != dict(before)[1]
+
+def knearest_rows(db_path):
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute('SELECT * FROM knearest ORDER BY id').fetchall()
+    conn.close()
+    return rows
+
+
+def reference_k_nearest(docids, dt_matrix, k):
+    """原先的做法：稠密的 1 - pairwise_distances，逐行按相似度降序、列序升序取 k 篇（不含自身）"""
+    sim = np.round(1 - pairwise_distances(dt_matrix.toarray(), metric = 'cosine'), SIMILARITY_DECIMALS)
+    nearest = []
+    for i, docid in enumerate(docids):
+        order = [j for j in np.lexsort((np.arange(len(docids)), -sim[i])).tolist() if j != i]
+        nearest.append([docid, [docids[j] for j in order[:k]]])
+    return nearest
+
+
+def test_k_nearest_ties_follow_column_order(workspace):
+    # 41、42 与 3 内容相同，43 与 19 相同：与它们的相似度完全并列
+    workspace.copy(3, 41)
+    workspace.copy(3, 42)
+    workspace.copy(19, 43)
+    build_index(workspace)
+    rm = RecommendationModule(workspace.config_path, 'utf-8')
+    rm.gen_idf_file()
+    files = rm.corpus.names()
+    docids, dt_matrix = rm.construct_dt_matrix(files, 25)
+    rm.construct_k_nearest_matrix(docids, dt_matrix, 5, block_mb = 0.001) # 每块只有几行
+    assert rm.k_nearest == reference_k_nearest(docids, dt_matrix, 5)
+    nearest = dict(rm.k_nearest)
+    column = {docid: i for i, docid in enumerate(docids)}
+    assert nearest[3][:2] == sorted([41, 42], key = column.get)
+    assert nearest[19][0] == 43 and nearest[43][0] == 19
+
+
+def test_k_nearest_fewer_docs_than_k(make_workspace):
+    ws = make_workspace(docs = [1, 2, 3])
+    build_index(ws)
+    rm = RecommendationModule(ws.config_path, 'utf-8')
+    rm.find_k_nearest(5, 25)
+    rows = knearest_rows(ws.config()['db_path'])
+    assert [r[0] for r in rows] == [1, 2, 3]
+    assert all(sorted(r[1:3]) == sorted({1, 2, 3} - {r[0]}) and r[3:] == (None, None, None) for r in rows)
+
+    from search_engine import SearchEngine
+    se = SearchEngine(ws.config_path, 'utf-8')
+    assert sorted(se.fetch_k_nearest(1)) == [2, 3]
+    se.close()
+
+    ws.remove(2)
+    ws.remove(3)
+    RecommendationModule(ws.config_path, 'utf-8').find_k_nearest(5, 25)
+    assert knearest_rows(ws.config()['db_path']) == [(1, None, None, None, None, None)]
+
+
+def test_k_nearest_is_per_instance(workspace):
+    build_index(workspace)
+    RecommendationModule(workspace.config_path, 'utf-8').find_k_nearest(5, 25)
+    rows = knearest_rows(workspace.config()['db_path'])
+    rm = RecommendationModule(workspace.config_path, 'utf-8')
+    rm.find_k_nearest(5, 25) # 同一进程里再算一次，不带上一个实例的结果
+    assert len(rm.k_nearest) == 40
+    assert knearest_rows(workspace.config()['db_path']) == rows
+
+
+@pytest.mark.parametrize('indexed', [False, True])
+def test_parallel_keywords_and_df_match_serial(workspace, indexed):
+    if indexed: # 分词缓存已由建索引写好；否则各进程自己分词并写入同一个缓存库
+        build_index(workspace)
+    results = []
+    for workers in (1, 3):
+        if not indexed:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(workspace.path('tokens.db' + suffix)):
+                    os.remove(workspace.path('tokens.db' + suffix))
+        workspace.configure(index_workers = workers)
+        rm = RecommendationModule(workspace.config_path, 'utf-8')
+        rm.gen_idf_file()
+        with open(rm.idf_path, encoding = 'utf-8') as f:
+            idf = f.read()
+        results.append((idf, rm.files_keywords(rm.corpus.names(), 25)))
+    assert results[0][0] == results[1][0] # 词的先后次序也相同
+    assert results[0][1] == results[1][1]
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from conftest import Workspace, build_index
+
+QUERIES = ['李强 峰会', '二十国集团', '中国 经济 发展', '北京', '健康 科技', '宣言', '全会 精神', '乌克兰 和平']
+
+
+@pytest.fixture(scope = 'module')
+def ws(tmp_path_factory):
+    """前 40 篇新闻，另有两篇与 3、19 内容完全相同的副本（41、42），用来制造同分"""
+    ws = Workspace(tmp_path_factory.mktemp('search'))
+    ws.copy(3, 41)
+    ws.copy(19, 42)
+    build_index(ws)
+    return ws
+
+
+@pytest.fixture
+def engine(ws):
+    from search_engine import SearchEngine
+    se = SearchEngine(ws.config_path, 'utf-8')
+    yield se
+    se.close()
+
+
+def ids(results):
+    return [docid for docid, score in results]
+
+
+def test_concurrent_search_matches_serial(engine):
+    jobs = [(q, sort_type) for q in QUERIES for sort_type in (0, 1, 2)] * 4
+    serial = [engine.search(q, sort_type) for q, sort_type in jobs]
+    engine.cache.clear()
+    engine.postings_cache.clear()
+    with ThreadPoolExecutor(max_workers = 8) as executor:
+        concurrent = list(executor.map(lambda job: engine.search(*job), jobs))
+    assert any(total > 0 for total, results in serial)
+    for (q, sort_type), a, b in zip(jobs, serial, concurrent):
+        assert a[0] == b[0]
+        assert ids(a[1]) == ids(b[1])
+        if sort_type == 0:
+            assert a[1] == b[1]
+
+
+def first_terms(engine, terms):
+    """每篇文档第一次出现在第几个查询词项的 postings 中"""
+    first = {}
+    for t, p in enumerate(engine.term_postings(terms)):
+        for docid in p[0].tolist():
+            first.setdefault(docid, t)
+    return first
+
+
+def test_tie_order(engine):
+    """同分时 BM25 排序按 (首个包含它的词项, docid) 倒序，时间排序按 docid 升序。
+
+    postings 按 docid 存放以来平分次序取决于 docid，不再取决于建索引时 listdir 的文件顺序。
+    """
+    bm25, time_ties = 0, 0
+    for q in QUERIES + ['李强 会见 默茨']:
+        terms = engine.query_terms(q)
+        first = first_terms(engine, terms)
+        total, results = engine.BM25_ranking(terms)
+        for (a, sa), (b, sb) in zip(results, results[1:]):
+            assert sa >= sb
+            if sa == sb:
+                bm25 += 1
+                assert (first[a], a) > (first[b], b)
+        total, results = engine.time_ranking(terms)
+        for (a, sa), (b, sb) in zip(results, results[1:]):
+            assert sa <= sb
+            if sa == sb:
+                time_ties += 1
+                assert a < b
+    assert bm25 > 0 and time_ties > 0
+    assert ids(engine.BM25_ranking(engine.query_terms('李强 会见 默茨'))[1])[:2] == [41, 3]
+    order = ids(engine.time_ranking(engine.query_terms('二十国集团 宣言'))[1])
+    assert order.index(42) == order.index(19) + 1
+
+
+def reference_ranking(engine, terms, now):
+    """原先逐条记录累加的实现：BM25、热度按词项顺序累加到 dict 后 sorted + reverse，时间取文档第一次出现时的得分"""
+    bm25, hot, hours = {}, {}, {}
+    for docids, tfs, lds, tss, w, *bounds in engine.term_postings(terms):
+        for docid, tf, ld, ts in zip(docids.tolist(), tfs.tolist(), lds.tolist(), tss.tolist()):
+            s = (engine.K1 * tf * w) / (tf + engine.K1 * (1 - engine.B + engine.B * ld / engine.AVG_L))
+            td = (now - ts) / 3600
+            bm25[docid] = bm25.get(docid, 0) + s
+            hot[docid] = hot.get(docid, 0) + engine.HOT_K1 * engine.sigmoid(s) + engine.HOT_K2 / td
+            hours.setdefault(docid, td)
+    bm25 = sorted(bm25.items(), key = lambda r: r[1])
+    hot = sorted(hot.items(), key = lambda r: r[1])
+    bm25.reverse()
+    hot.reverse()
+    return bm25, sorted(hours.items(), key = lambda r: (r[1], r[0])), hot
+
+
+def test_vectorized_scores_match_reference(engine, monkeypatch):
+    import search_engine
+    now = search_engine.now_epoch()
+    monkeypatch.setattr(search_engine, 'now_epoch', lambda: now)
+    recency = engine.recency
+    for q in QUERIES:
+        terms = engine.query_terms(q)
+        bm25, by_time, hot = reference_ranking(engine, terms, now)
+        assert engine.BM25_ranking(terms) == (len(bm25), bm25)
+        assert engine.time_ranking(terms) == (len(by_time), by_time)
+        total, results = engine.hot_ranking(terms)
+        assert total == len(hot)
+        assert ids(results) == ids(hot)
+        assert [s for d, s in results] == pytest.approx([s for d, s in hot], rel = 1e-12)
+
+
+def reference_rank(docids, keys, descending):
+    """原先在 dict 上的做法：按首次插入顺序稳定排序，降序时整体 reverse"""
+    scores = {}
+    for docid in docids:
+        scores.setdefault(docid, keys[docid])
+    ranked = sorted(scores.items(), key = lambda r: r[1])
+    if descending:
+        ranked.reverse()
+    return ranked
+
+
+def test_rank_repeated_docids(engine):
+    docids = np.array([5, 2, 5, 7, 2, 9, 7, 5])
+    keys = np.ones(10)
+    assert engine.rank(docids, keys, True) == (4, [(9, 1.0), (7, 1.0), (2, 1.0), (5, 1.0)])
+    assert engine.rank(docids, keys, False) == (4, [(5, 1.0), (2, 1.0), (7, 1.0), (9, 1.0)])
+
+    rng = np.random.default_rng(4)
+    for trial in range(20):
+        docids = rng.integers(0, 300, size = 2000)
+        keys = rng.integers(0, 8, size = 300).astype(np.float64) # 大量同分
+        for descending in (True, False):
+            expected = reference_rank(docids.tolist(), keys.tolist(), descending)
+            assert engine.rank(docids, keys, descending) == (len(expected), expected)
+            for offset, k in ((0, 10), (7, 25), (280, 50)):
+                assert engine.rank(docids, keys, descending, k, offset) == (len(expected), expected[offset:offset + k])
+
+
+def synthetic_lists(engine, rng, n_terms = 4, n_docs = 3000):
+    """取值很少的 tf、ld 与 idf 造出大量同分，记录数跨多个跳表块；其中一个词项 idf 为负"""
+    from postings_codec import decode_skips, encode_skips
+    lists = []
+    for t in range(n_terms):
+        docids = np.sort(rng.choice(n_docs, size = int(rng.integers(100, n_docs // 2)), replace = False))
+        tfs = rng.integers(1, 3, size = len(docids))
+        lds = rng.choice([100, 300], size = len(docids))
+        tss = np.zeros(len(docids), dtype = np.int64)
+        w = -0.5 if t == n_terms - 1 else float(rng.integers(1, 4))
+        lists.append((docids, tfs, lds, tss, w, int(tfs.max()), int(lds.min()),
+                      decode_skips(encode_skips(docids, tfs, lds))))
+    return lists
+
+
+def test_maxscore_matches_exhaustive(engine, monkeypatch):
+    monkeypatch.setattr(engine, 'MAXSCORE_WINDOW', 4)
+    rng = np.random.default_rng(5)
+    cases = [engine.term_postings(engine.query_terms(q)) for q in QUERIES + ['李强 会见 默茨', '二十国集团 宣言']]
+    cases += [synthetic_lists(engine, rng) for trial in range(10)]
+    ties = 0
+    for lists in cases:
+        for k, offset in ((1, 0), (5, 0), (10, 3), (50, 0), (50, 20)):
+            expected = engine.exhaustive(lists, k, offset)
+            assert engine.maxscore(lists, k, offset) == expected
+            scores = [s for d, s in expected[1]]
+            ties += len(scores) - len(set(scores))
+    assert ties > 0
+
+
+def test_bm25_strategy_follows_measured_cost(engine, monkeypatch):
+    monkeypatch.setattr(engine, 'MAXSCORE_MIN_POSTINGS', 0)
+    monkeypatch.setattr(engine, 'strategy_cost', {})
+    monkeypatch.setattr(engine, 'strategy_queries', {})
+    terms = engine.query_terms('中国 经济 发展')
+    lists = engine.term_postings(terms)
+    expected = engine.exhaustive(lists, 10)
+    for i in range(2 * engine.MAXSCORE_EXPLORE + 2):
+        assert engine.BM25_ranking(terms, 10) == expected
+    bucket = (sum(len(p[0]) for p in lists).bit_length(), (10).bit_length())
+    assert {(bucket, 'exhaustive'), (bucket, 'maxscore')} <= set(engine.strategy_cost)
+
+    engine.strategy_cost[(bucket, 'maxscore')] = 0.0
+    engine.strategy_cost[(bucket, 'exhaustive')] = 1.0
+    engine.strategy_queries[bucket] = 1
+    chosen = [engine.choose_strategy(bucket) for i in range(engine.MAXSCORE_EXPLORE)]
+    assert chosen.count('maxscore') == engine.MAXSCORE_EXPLORE - 1
+    assert chosen[-1] == 'exhaustive'
+    assert engine.BM25_ranking(terms) == engine.exhaustive(lists) # 不分页时总是穷举
+
+
+def test_recency_order(engine, ws, monkeypatch):
+    import sqlite3
+    import search_engine
+    conn = sqlite3.connect(ws.config()['db_path'])
+    rows = conn.execute('SELECT docid, ts FROM doc_state').fetchall()
+    conn.close()
+    assert engine.recency.tolist() == [docid for docid, ts in sorted(rows, key = lambda r: (-r[1], r[0]))]
+    assert all(engine.doc_ts[docid] == ts for docid, ts in rows)
+
+    now = search_engine.now_epoch()
+    monkeypatch.setattr(search_engine, 'now_epoch', lambda: now)
+    recency = engine.recency
+    for q in QUERIES:
+        terms = engine.query_terms(q)
+        total, full = engine.time_ranking(terms)
+        for offset, k in ((0, 10), (5, 3), (total - 2, 10)):
+            assert engine.time_ranking(terms, k, offset) == (total, full[offset:offset + k])
+        # 旧版索引没有 doc_state 时按 postings 中的时间排序，同一时间的文档可能次序不同，得分与文档集合相同
+        engine.recency = None
+        legacy = engine.time_ranking(terms)
+        engine.recency = recency
+        assert legacy[0] == total
+        assert sorted(legacy[1], key = lambda r: (r[1], r[0])) == full
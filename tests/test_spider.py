@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import os
+
+import pytest
+
+import bench_spider
+from bench_spider import crawl
+from conftest import SITE_START as START
+from doc_store import DirectoryCorpus
+from frontier import BloomFilter, Frontier
+
+
+def read_dir(path):
+    return {f: open(os.path.join(path, f), 'rb').read() for f in os.listdir(path)}
+
+
+def test_concurrent_crawl_matches_serial(site, tmp_path):
+    site, root, pages, flaky = site
+    outputs = []
+    for name, concurrency, workers in (('serial', 1, 1), ('concurrent', 8, 2)):
+        out_dir = str(tmp_path / name) + os.sep
+        os.makedirs(out_dir)
+        news_pool, written, elapsed, fetcher = crawl(site, root, START, 2, out_dir, concurrency, workers, flaky)
+        paths = [url[len(root):] for date_time, url, title in news_pool]
+        assert len(paths) == 76 # 图片频道的 4 条不在列表中
+        assert fetcher.retried == len(flaky & set(paths)) # 每个 503 重试一次即成功
+        assert fetcher.failures == len([p for p in paths if pages[p][0] == 404])
+        outputs.append((written, read_dir(out_dir)))
+    assert outputs[0] == outputs[1]
+    written, files = outputs[0]
+    assert 0 < written < 76 # 404、无正文、过短与不含“编辑”的被过滤
+    assert sorted(files) == sorted('%d.xml' % i for i in range(1, written + 1))
+
+
+def test_token_bucket_limits_rate(monkeypatch):
+    now = [0.0]
+    sleeps = []
+    monkeypatch.setattr(bench_spider.spider.time, 'monotonic', lambda: now[0])
+
+    def sleep(seconds):
+        sleeps.append(seconds)
+        now[0] += seconds
+    monkeypatch.setattr(bench_spider.spider.time, 'sleep', sleep)
+    bucket = bench_spider.spider.TokenBucket(rate = 10, burst = 3)
+    for i in range(5):
+        bucket.acquire()
+    assert sleeps == pytest.approx([0.1, 0.1]) # 突发 3 次后每 0.1 秒一个令牌
+
+
+class NoValidatorsHandler(bench_spider.Handler):
+    """不发 ETag 的站点：爬虫无法发条件请求"""
+
+    def send_header(self, keyword, value):
+        if keyword != 'ETag':
+            super().send_header(keyword, value)
+
+
+def crawl_rounds(site, root, pages, frontier, out_dir, rounds):
+    """用同一个抓取边界连续抓取，返回每轮的 (新闻页请求数, 304 次数, 写出篇数, changed 表中的 docid, 404 次数)"""
+    results = []
+    for modify in rounds:
+        if modify: # 改动第一篇能通过过滤的新闻
+            path = min(p for p in pages if p.startswith('/gn/') and b'\xe7\xac\xac 0 \xe6\xae\xb5' in pages[p][1])
+            pages[path] = (200, pages[path][1].replace('第 0 段'.encode(), '第〇段'.encode()))
+        news_pool, written, elapsed, fetcher = crawl(site, root, START, 2, out_dir, 4, 1, set(), frontier)
+        changed = frontier.changed_docids()
+        frontier.clear_changed(changed)
+        results.append((site.requests - 2, site.not_modified, written, changed, fetcher.failures))
+    return results
+
+
+def test_frontier_conditional_gets(site, tmp_path):
+    site, root, pages, flaky = site
+    out_dir = str(tmp_path / 'news') + os.sep
+    os.makedirs(out_dir)
+    frontier = Frontier(str(tmp_path / 'frontier.db'), DirectoryCorpus(out_dir))
+    first, = crawl_rounds(site, root, pages, frontier, out_dir, (False,))
+    fetched, not_modified, written, changed, missing = first
+    assert not_modified == 0 and changed == list(range(1, written + 1))
+    files = read_dir(out_dir)
+    second, = crawl_rounds(site, root, pages, frontier, out_dir, (True,))
+    # 第二轮抓过的新闻都带 If-None-Match（404 的没有记录，照常请求），只有改动的那篇返回 200 并重写，docid 不变
+    assert second[0] == fetched and second[4] == missing > 0
+    assert second[1] == fetched - missing - 1
+    assert second[2] == 1 and len(second[3]) == 1
+    after = read_dir(out_dir)
+    assert [f for f in files if files[f] != after[f]] == ['%d.xml' % second[3][0]]
+    frontier.close()
+
+
+def test_frontier_revisits_pages_without_validators(site, tmp_path):
+    site, root, pages, flaky = site
+    site.RequestHandlerClass = NoValidatorsHandler
+    out_dir = str(tmp_path / 'news') + os.sep
+    os.makedirs(out_dir)
+    frontier = Frontier(str(tmp_path / 'frontier.db'), DirectoryCorpus(out_dir), revisit_hours = 24)
+    first, second = crawl_rounds(site, root, pages, frontier, out_dir, (False, True))
+    assert first[0] > 0 and first[2] > 0
+    assert second[0] == second[4] == first[4] and second[2] == 0 # 不到 24 小时，只有没记录的 404 重新请求
+    frontier.revisit_hours = 1e-9 # 模拟时间已过去 revisit_hours
+    third, = crawl_rounds(site, root, pages, frontier, out_dir, (False,))
+    assert third[0] == first[0] and third[1] == 0 # 全部无条件重新下载
+    assert third[2] == 1 and len(third[3]) == 1 # 只有内容变化的那篇重写
+    frontier.close()
+
+
+def test_frontier_skip_policy(tmp_path):
+    frontier = Frontier(str(tmp_path / 'frontier.db'))
+    frontier.record('http://a/1', 1, None, None, 'h1')
+    frontier.record('http://a/2', 2, '"e2"', None, 'h2')
+    frontier.record('http://a/3', None, None, 'Mon, 01 Jan 2024 00:00:00 GMT', None)
+    frontier.record('http://a/4', 4, None, None, 'h4')
+    frontier.reset([4])
+    plain, etag, modified, reset = (frontier.lookup('http://a/%d' % i) for i in range(1, 5))
+    assert frontier.lookup('http://a/5') is None and not frontier.skip(None)
+    assert frontier.conditional_headers(etag) == {'If-None-Match': '"e2"'}
+    assert frontier.conditional_headers(modified) == {'If-Modified-Since': 'Mon, 01 Jan 2024 00:00:00 GMT'}
+    assert not frontier.skip(etag) and not frontier.skip(modified) and not frontier.skip(reset)
+    assert frontier.skip(plain)
+    assert frontier.skip(plain, now = plain[4] + 23.9 * 3600)
+    assert not frontier.skip(plain, now = plain[4] + 24 * 3600)
+    frontier.revisit_hours = 0 # 不重新抓取
+    assert frontier.skip(plain, now = plain[4] + 1e6)
+    frontier.close()
+
+
+def test_bloom_filter(tmp_path):
+    bloom = BloomFilter(5000, error_rate = 0.01)
+    for i in range(5000):
+        bloom.add('http://a/%d' % i)
+    assert all('http://a/%d' % i in bloom for i in range(5000))
+    false_positives = sum('http://b/%d' % i in bloom for i in range(20000))
+    assert false_positives < 20000 * 0.02
+
+    # 超过容量时翻倍重建；库中的 url 一个都不会被判定为新 url
+    frontier = Frontier(str(tmp_path / 'frontier.db'))
+    capacity = frontier.bloom.capacity
+    for i in range(capacity + 10):
+        frontier.record('http://a/%d' % i, i + 1, None, None, 'h')
+    frontier.commit()
+    assert frontier.bloom.capacity == 2 * capacity
+    assert all(frontier.lookup('http://a/%d' % i) is not None for i in range(capacity + 10))
+    assert frontier.bloom_negatives == 0
+    for i in range(1000):
+        assert frontier.lookup('http://b/%d' % i) is None
+    assert frontier.bloom_negatives > 950 # 新 url 绝大多数不查数据库
+    frontier.close()
+    assert Frontier(str(tmp_path / 'frontier.db')).bloom.capacity == 2 * (capacity + 10) # 打开时按库中 url 数重建
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from conftest import build_index
+
+
+@pytest.fixture
+def web(workspace, monkeypatch):
+    """web/main.py 指向临时目录中的配置、索引与推荐结果"""
+    from recommendation_module import RecommendationModule
+    from search_engine import SearchEngine
+    import main
+    build_index(workspace)
+    RecommendationModule(workspace.config_path, 'utf-8').find_k_nearest(5, 25)
+    se = SearchEngine(workspace.config_path, 'utf-8')
+    monkeypatch.setattr(main, 'config_path', workspace.config_path)
+    monkeypatch.setattr(main, 'search_engine', se)
+    monkeypatch.setattr(main, 'corpus', None)
+    monkeypatch.setattr(main, 'db_path', '')
+    yield main
+    se.close()
+
+
+def test_documents_table_matches_xml(web):
+    ids = ['1', '19', '40', '7', '23']
+    docs = web.find(ids)
+    assert [doc['id'] for doc in docs] == ids
+    assert docs == web.find_xml(ids)
+    assert docs[0]['snippet'].endswith('……') and len(docs[0]['snippet']) == 122
+    docs = web.find(ids, extra = True)
+    assert docs == web.find_xml(ids, extra = True)
+    assert all(len(doc['extra']) == 5 for doc in docs)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+检索性能基准：对比穷举 BM25 打分与 MaxScore 动态剪枝
+
+查询集为固定的常见关键词加上语料中部分新闻的标题（多词长查询），
+逐条检查两种方式返回的前 k 名完全一致，并统计剪枝率（未被打分的 postings 占比）与耗时。
+
+用法（在 web 目录下）：
+    python bench_search.py [k] [标题抽样间隔]
+"""
+
+import os
+import sys
+import time
+import configparser
+import xml.etree.ElementTree as ET
+
+from search_engine import SearchEngine
+
+QUERIES = ['北京雾霾', '中国经济', '峰会', '新华社 记者', '人工智能 发展', '美国 关税 贸易',
+           '教育 学生', '医疗 医院', '交通 事故', '科技 创新', '环境 保护', '中国', '记者 报道 表示']
+
+
+def load_titles(config_path, step):
+    config = configparser.ConfigParser()
+    config.read(config_path, 'utf-8')
+    doc_dir_path = config['DEFAULT']['doc_dir_path']
+    files = sorted(os.listdir(doc_dir_path))[::step]
+    return [ET.parse(os.path.join(doc_dir_path, f)).getroot().find('title').text for f in files]
+
+
+if __name__ == '__main__':
+    k = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    step = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    config_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.ini')
+    se = SearchEngine(config_path, 'utf-8')
+    queries = QUERIES + load_titles(config_path, step)
+
+    postings = scored = 0
+    t_full = t_pruned = 0.0
+    mismatches = 0
+    for q in queries:
+        t0 = time.perf_counter()
+        total, full = se.result_by_BM25(q)
+        t1 = time.perf_counter()
+        stats = {}
+        total2, pruned = se.result_by_BM25_maxscore(q, k, 0, stats)
+        t2 = time.perf_counter()
+        t_full += t1 - t0
+        t_pruned += t2 - t1
+        if total != total2 or full[:k] != pruned:
+            mismatches += 1
+            print('结果不一致: %s' % q)
+        if stats:
+            postings += stats['postings']
+            scored += stats['scored']
+
+    print('查询数: %d, top-%d, 结果不一致: %d' % (len(queries), k, mismatches))
+    print('postings 总数: %d, 实际打分: %d, 剪枝率: %.1f%%'
+          % (postings, scored, 100.0 * (postings - scored) / max(postings, 1)))
+    print('穷举: %.3f ms/查询, MaxScore: %.3f ms/查询'
+          % (t_full * 1000 / len(queries), t_pruned * 1000 / len(queries)))
@@ -46,14 +46,19 @@ import sqlite3
 import configparser
 import time
 import jieba
+from doc_store import open_corpus
 
 app = Flask(__name__)
 
 doc_dir_path = ''
+corpus = None # 新闻语料（XML 目录、文档库或打包的语料，见 code/doc_store.py）
 db_path = ''
 page = []
 keys = ''
-doc_id = [] # 初始化为空列表
+doc_id = [] # 当前页的docid列表
+page_no = 0 # doc_id 对应的页码（从0开始）
+query = ('', 0) # 最近一次检索的 (关键词, 排序方式)，翻页时据此只取所需的一页
+PAGE_SIZE = 10
 checked = ['', '', ''] # 初始化checked列表
 
 # 【修复2】建议使用绝对路径读取配置，防止路径错误
@@ -69,11 +74,18 @@ if AISummaryGenerator:
 else:
     ai_summary_generator = None
 
+# 检索引擎在进程启动时创建一次，所有请求线程共享（配置、停用词、jieba 词典只加载一次）
+try:
+    search_engine = SearchEngine(config_path, 'utf-8')
+except Exception as e:
+    print(f"初始化检索引擎失败: {e}")
+    search_engine = None
+
 def init():
-    global dir_path, db_path
+    global corpus, db_path
     config = configparser.ConfigParser()
     config.read(config_path, 'utf-8')
-    dir_path = config['DEFAULT']['doc_dir_path']
+    corpus = open_corpus(config['DEFAULT'])
     db_path = config['DEFAULT']['db_path']
 
 
@@ -140,47 +152,77 @@ def search():
 def searchidlist(key, selected=0):
     global page
     global doc_id
-    # 这里也要用绝对路径的 config_path
-    se = SearchEngine(config_path, 'utf-8')
-    flag, id_scores = se.search(key, selected)
-    # 返回docid列表
+    global page_no
+    global query
+    query = (key, selected)
+    # 只取第一页，命中总数用于生成分页
+    total, id_scores = search_engine.search(key, selected, PAGE_SIZE, 0)
     doc_id = [i for i, s in id_scores]
+    page_no = 0
     page = []
     # 修复分页逻辑防止报错
-    if len(doc_id) > 0:
-        for i in range(1, (len(doc_id) // 10 + 2)):
+    if total > 0:
+        for i in range(1, (total // PAGE_SIZE + 2)):
             page.append(i)
     else:
         page = [1]
-    return flag, page
+    return total, page
 
 
 def cut_page(page, no):
+    global doc_id
+    global page_no
+    # 当前页已在内存中时直接使用，否则按偏移量只检索这一页
+    if no != page_no:
+        key, selected = query
+        if not key:
+            return []
+        total, id_scores = search_engine.search(key, selected, PAGE_SIZE, no * PAGE_SIZE)
+        doc_id = [i for i, s in id_scores]
+        page_no = no
     # 增加安全性检查
     if not doc_id:
         return []
-    # 简单的分页切片
-    start_idx = no * 10
-    end_idx = start_idx + 10
-    # 确保不越界（虽然切片会自动处理，但为了逻辑清晰）
-    target_ids = doc_id[start_idx:end_idx]
-    docs = find(target_ids)
+    docs = find(doc_id)
     return docs
 
 
 # 将需要的数据以字典形式打包传递给search函数
 def find(docid, extra=False):
-    docs = []
-    global dir_path, db_path
+    global corpus, db_path
     
     # 确保 init 被调用过
-    if not dir_path or not db_path:
+    if corpus is None or not db_path:
         init()
 
+    # 一页结果只做一次文档库批量查询；旧版索引没有文档库时退回从语料逐篇解析 XML
+    try:
+        store = search_engine.fetch_documents(docid)
+    except sqlite3.OperationalError:
+        return find_xml(docid, extra)
+
+    docs = []
+    for id in docid:
+        row = store.get(int(id))
+        if row is None:
+            print(f"文档库中没有文档 {id}")
+            continue
+        url, title, datetime_val, snippet, body = row
+        docs.append({'url': url, 'title': title, 'snippet': snippet, 'datetime': datetime_val,
+                     'time': datetime_val.split(' ')[0], 'body': body, 'id': id, 'extra': []})
+    if extra:
+        nearest = [search_engine.fetch_k_nearest(doc['id']) for doc in docs]
+        titles = search_engine.fetch_documents([i for ids in nearest for i in ids], ('title',))
+        for doc, ids in zip(docs, nearest):
+            doc['extra'] = [{'id': i, 'title': titles[i][0]} for i in ids if i in titles]
+    return docs
+
+
+def find_xml(docid, extra=False):
+    docs = []
     for id in docid:
         try:
-            xml_path = os.path.join(dir_path, '%s.xml' % id)
-            root = ET.parse(xml_path).getroot()
+            root = ET.fromstring(corpus.read('%s.xml' % id))
             url = root.find('url').text
             title = root.find('title').text
             body = root.find('body').text
@@ -194,7 +236,7 @@ def find(docid, extra=False):
                 if temp_doc:
                     for i in temp_doc:
                         try:
-                            root = ET.parse(os.path.join(dir_path, '%s.xml' % i)).getroot()
+                            root = ET.fromstring(corpus.read('%s.xml' % i))
                             title = root.find('title').text
                             doc['extra'].append({'id': i, 'title': title})
                         except:
@@ -281,7 +323,7 @@ def get_k_nearest(db_path, docid, k=5):
         docs = c.fetchone()
         conn.close()
         if docs:
-            return docs[1: 1 + (k if k < 5 else 5)]  # max = 5
+            return [i for i in docs[1: 1 + (k if k < 5 else 5)] if i is not None]  # max = 5，新闻不足 6 篇时有空位
         else:
             return []
     except Exception as e:
@@ -290,6 +332,5 @@ def get_k_nearest(db_path, docid, k=5):
 
 
 if __name__ == '__main__':
-    jieba.initialize()
     # 开启 Debug 模式，这样网页上也能看到报错
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""
+解码后的 postings 缓存
+
+按词项缓存 term_postings 解码、过滤墓碑并跨段归并之后的 NumPy 列，限制总字节数。
+淘汰顺序是 LRU；准入用 TinyLFU：用 count-min sketch 近似统计每个词项最近被查询的次数，
+缓存已满时，新词项只有比它要挤掉的每个词项都更常被查询才会放入，
+所以偶尔出现一次的长尾词不会把高频词（如“中国”“北京”）挤出缓存。
+sketch 的计数在累计采样数达到上限后整体减半，使频率反映的是近期热度。
+"""
+
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class FrequencySketch:
+    """4 行 count-min sketch，计数饱和于 15，采样达到 sample_size 次后全部减半"""
+    DEPTH = 4
+    SEEDS = (0x9E3779B1, 0x85EBCA77, 0xC2B2AE3D, 0x27D4EB2F)
+
+    def __init__(self, width):
+        self.width = 1 << max(4, (int(width) - 1).bit_length())
+        self.table = np.zeros((self.DEPTH, self.width), dtype=np.uint8)
+        self.sample_size = 10 * self.width
+        self.samples = 0
+
+    def _indexes(self, key):
+        h = hash(key)
+        return [hash((seed, h)) & (self.width - 1) for seed in self.SEEDS]
+
+    def increment(self, key):
+        rows = range(self.DEPTH)
+        cols = self._indexes(key)
+        counts = self.table[rows, cols]
+        self.table[rows, cols] = np.minimum(counts + 1, 15)
+        self.samples += 1
+        if self.samples >= self.sample_size:
+            self.table >>= 1
+            self.samples //= 2
+
+    def frequency(self, key):
+        return int(self.table[range(self.DEPTH), self._indexes(key)].min())
+
+
+class PostingsCache:
+    ENTRY_BYTES = 300 # 每个条目的固定开销估计值（键、字典项、元组与数组对象头）
+
+    def __init__(self, max_bytes, expected_entries = 10000):
+        self.max_bytes = max_bytes
+        self.sketch = FrequencySketch(expected_entries)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # 词项 -> (postings, 字节数)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.rejections = 0
+        self.evictions = 0
+
+    def get(self, term):
+        with self._lock:
+            self.sketch.increment(term)
+            entry = self._entries.get(term)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(term)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, term, postings):
+        """postings 为 term_postings 中一个词项的缓存值，其中的 NumPy 数组计入字节数"""
+        if self.max_bytes <= 0:
+            return
+        size = self.ENTRY_BYTES + sum(a.nbytes for a in postings if isinstance(a, np.ndarray))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if term in self._entries:
+                return
+            # 先找出为腾出空间需要淘汰的 LRU 尾部条目，新词项的频率不高于其中任何一个就拒绝放入
+            need = self.bytes + size - self.max_bytes
+            victims = []
+            if need > 0:
+                freq = self.sketch.frequency(term)
+                for key, (value, victim_size) in self._entries.items():
+                    if need <= 0:
+                        break
+                    if self.sketch.frequency(key) >= freq:
+                        self.rejections += 1
+                        return
+                    victims.append(key)
+                    need -= victim_size
+            for key in victims:
+                self.bytes -= self._entries.pop(key)[1]
+                self.evictions += 1
+            self._entries[term] = (postings, size)
+            self.bytes += size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """命中、未命中、拒绝准入、淘汰次数与当前条目数、字节数"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'rejections': self.rejections,
+                    'evictions': self.evictions, 'entries': len(self._entries), 'bytes': self.bytes}
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+检索结果缓存
+
+以 (清洗后的查询词项序列, 排序方式) 为键缓存排好序的结果前缀，按 LRU 淘汰，
+同时限制条目数与估计占用的字节数。时间、热度排序的得分随当前时间变化，这类条目带 TTL；
+相关度排序只取决于索引，条目一直有效，直到索引代数变化时整体清空。
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class QueryCache:
+    ENTRY_BYTES = 200 # 每个条目的固定开销估计值（键、字典项、结果列表对象）
+    RESULT_BYTES = 120 # 每条 (docid, score) 结果的估计值
+
+    def __init__(self, max_entries = 1024, max_bytes = 32 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict() # 键 -> (命中总数, 结果前缀, 是否为全部结果, 过期时刻, 字节数)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, end):
+        """取出前 end 名结果（end 为 None 表示全部），返回 (命中总数, 结果前缀)，不满足时返回 None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                total, results, complete, expires, size = entry
+                if expires is not None and expires <= time.monotonic():
+                    self._remove(key)
+                elif complete or (end is not None and end <= len(results)):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return total, results
+            self.misses += 1
+            return None
+
+    def put(self, key, total, results, complete, ttl = None):
+        if self.max_entries <= 0:
+            return
+        size = self.ENTRY_BYTES + self.RESULT_BYTES * len(results)
+        if size > self.max_bytes:
+            return
+        expires = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (total, results, complete, expires, size)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        self.bytes -= self._entries.pop(key)[4]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """命中、未命中、淘汰次数与当前条目数、字节数"""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self._entries), 'bytes': self.bytes}
@@ -7,16 +7,33 @@ Created on Tue Dec 22 16:30:40 2015
 
 import jieba
 import math
-import operator
+import os
+import sys
 import sqlite3
+import threading
+import urllib.request
 import configparser
+import numpy as np
 from datetime import *
+from time import perf_counter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'code'))
+from postings_codec import BLOCK_SIZE, bm25_idf, decode_postings, decode_skips, encode_skips, now_epoch
+from mmap_index import MmapIndex
+from query_cache import QueryCache
+from postings_cache import PostingsCache
 
 class SearchEngine:
+    """进程级共享的检索服务。
+
+    配置、停用词和 jieba 词典只在启动（或 reload）时加载一次；
+    SQLite 连接按线程各自持有，均以只读方式打开，可被 Flask 多线程并发使用。
+    """
     stop_words = set()
     
     config_path = ''
     config_encoding = ''
+    db_path = ''
     
     K1 = 0
     B = 0
@@ -26,27 +43,154 @@ class SearchEngine:
     HOT_K1 = 0
     HOT_K2 = 0
     
-    conn = None
+    generation = 0
+    index_generation = 0
+    tombstones = {} # 段 -> 该段中已失效的 docid
+    mmap_index = None # index_backend = mmap 时从内存映射索引文件读取 postings，其余数据仍来自 db_path
+    mmap_index_path = ''
+    doc_ts = None # 按 docid 下标的发布时间（epoch 秒）
+    recency = None # 全部文档按发布时间从新到旧排列的 docid（同一时间按 docid 升序），时间排序直接按它筛选
+    
+    QUERY_CACHE_PREFETCH = 50 # 缓存未命中时至少计算的结果数（前 5 页）
+    QUERY_CACHE_TTL = 60 # 时间、热度排序结果的缓存有效期（秒）
+    
+    MAXSCORE_WINDOW = 128 # MaxScore 每轮处理的 docid 区间的最小宽度
+    MAXSCORE_MIN_POSTINGS = 1024 # postings 总数少于此值的查询总是向量化穷举，不参与两种方式的实测比较
+    MAXSCORE_EXPLORE = 32 # 同一规模档位中，实测较慢的方式每隔这么多次查询再试一次，使耗时估计跟上索引与负载的变化
+    MAXSCORE_DECAY = 0.2 # 耗时估计的指数滑动平均系数
     
     def __init__(self, config_path, config_encoding):
         self.config_path = config_path
         self.config_encoding = config_encoding
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.cache = QueryCache(0)
+        self.postings_cache = PostingsCache(0)
+        self.strategy_cost = {} # (规模档位, 'exhaustive' 或 'maxscore') -> 实测耗时的滑动平均（秒）
+        self.strategy_queries = {} # 规模档位 -> 查询次数
+        jieba.initialize()
+        self.reload()
+
+    def reload(self):
+        """重新读取配置与停用词，用于索引重建之后。
+
+        各线程的旧连接在下次取用时会被关闭并按新的 db_path 重新打开，旧的内存映射索引随即关闭。
+        """
         config = configparser.ConfigParser()
-        config.read(config_path, config_encoding)
+        config.read(self.config_path, self.config_encoding)
         f = open(config['DEFAULT']['stop_words_path'], encoding = config['DEFAULT']['stop_words_encoding'])
         words = f.read()
-        self.stop_words = set(words.split('\n'))
-        self.conn = sqlite3.connect(config['DEFAULT']['db_path'])
-        self.K1 = float(config['DEFAULT']['k1'])
-        self.B = float(config['DEFAULT']['b'])
-        self.N = int(config['DEFAULT']['n'])
-        self.AVG_L = float(config['DEFAULT']['avg_l'])
-        self.HOT_K1 = float(config['DEFAULT']['hot_k1'])
-        self.HOT_K2 = float(config['DEFAULT']['hot_k2'])
-        
-
-    def __del__(self):
-        self.conn.close()
+        f.close()
+        with self._lock:
+            self.stop_words = set(words.split('\n'))
+            self.db_path = config['DEFAULT']['db_path']
+            self.K1 = float(config['DEFAULT']['k1'])
+            self.B = float(config['DEFAULT']['b'])
+            self.N = int(config['DEFAULT']['n'])
+            self.AVG_L = float(config['DEFAULT']['avg_l'])
+            self.HOT_K1 = float(config['DEFAULT']['hot_k1'])
+            self.HOT_K2 = float(config['DEFAULT']['hot_k2'])
+            if config['DEFAULT'].get('index_backend', 'sqlite') == 'mmap':
+                self.mmap_index_path = config['DEFAULT']['mmap_index_path']
+            else:
+                self.mmap_index_path = ''
+            old, self.mmap_index = self.mmap_index, None
+            self.cache = QueryCache(config['DEFAULT'].getint('query_cache_entries', 1024),
+                                    int(config['DEFAULT'].getfloat('query_cache_mb', 32) * 1024 * 1024))
+            self.QUERY_CACHE_TTL = config['DEFAULT'].getfloat('query_cache_ttl', self.QUERY_CACHE_TTL)
+            self.postings_cache = PostingsCache(int(config['DEFAULT'].getfloat('postings_cache_mb', 64) * 1024 * 1024))
+            self.generation += 1
+        if old is not None:
+            old.close()
+        self.load_index_stats()
+
+    def load_index_stats(self):
+        """从索引库读取 N、avg_l、索引代数与各段的墓碑文档。
+
+        增量更新只改索引库，不一定同步到进程内，所以以库中的 stats 表为准；
+        旧版索引没有 stats 表时沿用配置文件中的 N 与 avg_l。
+        使用内存映射索引时统计量取自索引文件头部，文件中已不含墓碑记录；换上新文件后关闭旧文件的映射，
+        仍在读取旧文件的线程结束后才真正关闭。
+        每篇文档的发布时间与按时间排好的 docid 顺序也在这里一次性载入。
+        """
+        if self.mmap_index_path:
+            index = MmapIndex(self.mmap_index_path)
+            doc_ts, recency = self.load_doc_times()
+            with self._lock:
+                old, self.mmap_index = self.mmap_index, index
+                self.doc_ts, self.recency = doc_ts, recency
+                self.N = index.N
+                self.AVG_L = index.avg_l
+                self.index_generation = index.generation
+                self.tombstones = {}
+            self.cache.clear()
+            self.postings_cache.clear() # 缓存的 postings 是旧映射上的视图，清空后旧映射才能关闭
+            if old is not None:
+                old.close()
+            return
+        try:
+            c = self.get_conn().cursor()
+            stats = dict(c.execute('SELECT key, value FROM stats').fetchall())
+            tombstones = {}
+            for segment, docid in c.execute('SELECT segment, docid FROM tombstones ORDER BY segment, docid'):
+                tombstones.setdefault(segment, []).append(docid)
+        except sqlite3.Error:
+            return
+        doc_ts, recency = self.load_doc_times()
+        with self._lock:
+            self.doc_ts, self.recency = doc_ts, recency
+            self.N = int(stats['N'])
+            self.AVG_L = stats['avg_l']
+            self.index_generation = int(stats['generation'])
+            self.tombstones = {k: np.array(v, dtype=np.int64) for k, v in tombstones.items()}
+        self.cache.clear()
+        self.postings_cache.clear()
+
+    def load_doc_times(self):
+        """从 doc_state 读取每篇存活文档的发布时间，返回 (doc_ts, recency)，旧版索引没有该表时返回 (None, None)"""
+        try:
+            rows = self.get_conn().execute('SELECT docid, ts FROM doc_state').fetchall()
+        except sqlite3.Error:
+            return None, None
+        if len(rows) == 0:
+            return None, None
+        docids, ts = np.array(rows, dtype=np.int64).T
+        doc_ts = np.zeros(docids.max() + 1, dtype=np.int64)
+        doc_ts[docids] = ts
+        return doc_ts, docids[np.lexsort((docids, -ts))]
+
+    def sync(self):
+        """索引代数变化（重建或增量更新）后重新读取统计量与墓碑"""
+        if self.mmap_index_path:
+            if self.mmap_index is None or self.mmap_index.changed():
+                self.load_index_stats()
+            return
+        try:
+            r = self.get_conn().execute("SELECT value FROM stats WHERE key = 'generation'").fetchone()
+        except sqlite3.Error:
+            return
+        if r is not None and int(r[0]) != self.index_generation:
+            self.load_index_stats()
+
+    def get_conn(self):
+        """返回当前线程的只读连接，reload 之后自动重连。"""
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is not None and local.generation == self.generation:
+            return conn
+        if conn is not None:
+            conn.close()
+        uri = 'file:%s?mode=ro' % urllib.request.pathname2url(os.path.abspath(self.db_path))
+        local.conn = sqlite3.connect(uri, uri = True)
+        local.generation = self.generation
+        return local.conn
+
+    def close(self):
+        """关闭当前线程持有的连接。"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
     
     def is_number(self, s):
         try:
@@ -56,7 +200,7 @@ class SearchEngine:
             return False
             
     def sigmoid(self, x):
-        return 1 / (1 + math.exp(-x))
+        return 1 / (1 + np.exp(-x))
 
     def clean_list(self, seg_list):
         cleaned_dict = {}
@@ -72,106 +216,425 @@ class SearchEngine:
         return n, cleaned_dict
 
     def fetch_from_db(self, term):
-        c = self.conn.cursor()
-        c.execute('SELECT * FROM postings WHERE term=?', (term,))
-        return(c.fetchone())
+        """返回 (全局 df, idf, [(docs, max_tf, min_ld, skips, segment)])，词项不存在时返回 None。
+
+        分段索引中一个词项在每个段里各有一行，df 与建索引时算好的 idf 取自 terms 表；
+        旧版索引没有 idf 时为 None，单表索引只有一行，缺少的列以 None 代替。
+        内存映射索引中 docs、skips 是零拷贝的 memoryview。
+        """
+        index = self.mmap_index
+        while index is not None and not index.acquire(): # 读到的是刚被替换并关闭的旧索引
+            index = self.mmap_index
+        if index is not None:
+            try:
+                return index.lookup(term)
+            finally:
+                index.release()
+        c = self.get_conn().cursor()
+        try:
+            r = c.execute('SELECT * FROM terms WHERE term=?', (term,)).fetchone()
+        except sqlite3.OperationalError:
+            r = c.execute('SELECT * FROM postings WHERE term=?', (term,)).fetchone()
+            if r is None:
+                return None
+            return r[1], None, [tuple(r[2:6]) + (None,) * (6 - len(r)) + (None,)]
+        if r is None:
+            return None
+        rows = c.execute('SELECT docs, max_tf, min_ld, skips, segment FROM postings WHERE term=? ORDER BY segment',
+                         (term,)).fetchall()
+        return r[1], r[2] if len(r) > 2 else None, rows
     
-    def result_by_BM25(self, sentence):
+    def fetch_documents(self, docids, columns = ('url', 'title', 'datetime', 'snippet', 'body')):
+        """按 docid 批量读取文档库，一条 WHERE id IN (...) 查询，返回 {docid: (列值, ...)}。
+
+        索引库中没有 documents 表（旧版索引）时抛出 sqlite3.OperationalError。
+        """
+        docids = [int(i) for i in docids]
+        if len(docids) == 0:
+            return {}
+        c = self.get_conn().cursor()
+        c.execute('SELECT id, %s FROM documents WHERE id IN (%s)' % (', '.join(columns), ','.join('?' * len(docids))),
+                  docids)
+        return {r[0]: r[1:] for r in c.fetchall()}
+
+    def fetch_k_nearest(self, docid, k = 5):
+        """读取推荐模块写入的 knearest 表，返回最相似的至多 k 篇文档的 docid"""
+        try:
+            r = self.get_conn().execute('SELECT * FROM knearest WHERE id=?', (int(docid),)).fetchone()
+        except sqlite3.Error:
+            return []
+        return [i for i in r[1: 1 + min(k, 5)] if i is not None] if r else [] # 新闻不足 6 篇时有空位
+
+    def term_postings(self, terms):
+        """逐个取出查询词项的 postings，返回 [(docid, tf, ld, ts, w, max_tf, min_ld, skips)]，顺序同查询词。
+
+        w 是词项的 idf 权重，max_tf / min_ld / skips 是 MaxScore 用到的上界统计量与跳表。
+        每个段的记录先按该段的墓碑过滤，多个段的结果再按 docid 归并，此时跳表按归并后的数组重新生成；
+        max_tf / min_ld 取各段原记录的最大、最小值，作为上界依然成立。
+        解码结果经过 PostingsCache，BM25、时间、热度三种排序与 MaxScore 共用。
+        """
+        lists = []
+        generation = self.index_generation
+        for term in terms:
+            p = self.postings_cache.get(term)
+            if p is None:
+                p = self.decode_term(term)
+                if p is None:
+                    continue
+                if generation == self.index_generation: # 解码期间索引没有更新才放入缓存
+                    self.postings_cache.put(term, p)
+            lists.append(p)
+        return lists
+
+    def decode_term(self, term):
+        """读取并解码一个词项，返回 (docid, tf, ld, ts, w, max_tf, min_ld, skips)，没有存活记录时返回 None"""
+        r = self.fetch_from_db(term)
+        if r is None:
+            return None
+        df, w, rows = r
+        if w is None:
+            w = bm25_idf(self.N, df)
+        parts = []
+        for docs, max_tf, min_ld, skips, segment in rows:
+            docids, tfs, lds, tss = decode_postings(docs)
+            if max_tf is None: # 未迁移的旧版 postings 表没有上界统计量，现场计算
+                max_tf, min_ld, skips = int(tfs.max()), int(lds.min()), None
+            dead = self.tombstones.get(segment)
+            if dead is not None:
+                live = ~np.isin(docids, dead)
+                if not live.all():
+                    docids, tfs, lds, tss = docids[live], tfs[live], lds[live], tss[live]
+                    skips = None
+            if len(docids) > 0:
+                parts.append((docids, tfs, lds, tss, max_tf, min_ld, skips))
+        if len(parts) == 0:
+            return None
+        if len(parts) == 1:
+            docids, tfs, lds, tss, max_tf, min_ld, skips = parts[0]
+        else:
+            docids, tfs, lds, tss = [np.concatenate(c) for c in list(zip(*parts))[:4]]
+            order = np.argsort(docids, kind='stable')
+            docids, tfs, lds, tss = docids[order], tfs[order], lds[order], tss[order]
+            max_tf, min_ld, skips = max(p[4] for p in parts), min(p[5] for p in parts), None
+        if skips is None:
+            skips = encode_skips(docids, tfs, lds)
+        return docids, tfs, lds, tss, w, max_tf, min_ld, decode_skips(skips)
+
+    def fetch_postings(self, terms, lists = None):
+        """取出查询词项的 postings，拼接成列数组 (docid, tf, ld, ts, w)。
+
+        w 是每条记录所属词项的 idf 权重；词项按查询中出现的顺序拼接，
+        所以 docid 列中每篇文档第一次出现的位置就是原先逐条累加时的插入顺序。
+        已经用 term_postings 取出时可直接传入 lists。
+        """
+        if lists is None:
+            lists = self.term_postings(terms)
+        if len(lists) == 0:
+            return None
+        columns = [(p[0], p[1], p[2], p[3], np.full(len(p[0]), p[4])) for p in lists]
+        return [np.concatenate(c) for c in zip(*columns)]
+
+    def BM25(self, tf, ld, w):
+        return (self.K1 * tf * w) / (tf + self.K1 * (1 - self.B + self.B * ld / self.AVG_L))
+
+    def upper_bound(self, max_tf, min_ld, w):
+        """BM25 单项得分的上界；w <= 0 时单项得分不为正，上界取 0。
+
+        乘上 1 + 1e-9 的余量，避免与实际得分的浮点舍入误差造成误剪枝。
+        """
+        max_tf = np.asarray(max_tf, dtype=np.float64)
+        if w <= 0:
+            return np.zeros_like(max_tf)
+        return self.BM25(max_tf, np.asarray(min_ld, dtype=np.float64), w) * (1 + 1e-9)
+
+    def rank(self, docids, keys, descending, k = None, offset = 0):
+        """按 keys 排序去重后的文档，返回 (命中总数, 第 offset 起的 k 条 [(docid, score)])。
+
+        平分时与原先 sorted + reverse 的次序一致：原实现在 dict 上稳定排序
+        （平分按首次插入顺序），降序时再整体 reverse，这里用首次出现位置 first
+        作为第二关键字复现同样的次序。
+        keys 是按 docid 下标的稠密数组，去重和首次位置都在其上线性完成：首次位置用
+        np.minimum.at 按 docid 取最小下标（重复下标的花式赋值哪一次生效没有保证，不能依赖）；
+        只需要一页时先用 np.partition 找出第 offset + k 名的分数，只对不差于它的
+        候选（含平分者）做完整排序，避免对全部命中文档排序。
+        """
+        first = np.full(len(keys), len(docids), dtype=np.int64)
+        np.minimum.at(first, docids, np.arange(len(docids)))
+        uniq = np.flatnonzero(first < len(docids))
+        first = first[uniq]
+        keys = keys[uniq]
+        if descending:
+            primary, secondary = -keys, -first
+        else:
+            primary, secondary = keys, first
+        total = len(uniq)
+        end = total if k is None else min(offset + k, total)
+        if end <= offset:
+            return total, []
+        if end < total:
+            kth = np.partition(primary, end - 1)[end - 1]
+            candidates = np.flatnonzero(primary <= kth)
+        else:
+            candidates = np.arange(total)
+        order = candidates[np.lexsort((secondary[candidates], primary[candidates]))][offset:end]
+        return total, list(zip(uniq[order].tolist(), keys[order].tolist()))
+
+    def query_terms(self, sentence):
+        """查询分词并清洗，返回词项列表（去重，保持出现顺序）"""
         seg_list = jieba.lcut(sentence, cut_all=False)
         n, cleaned_dict = self.clean_list(seg_list)
-        BM25_scores = {}
-        for term in cleaned_dict.keys():
-            r = self.fetch_from_db(term)
-            if r is None:
-                continue
-            df = r[1]
-            w = math.log2((self.N - df + 0.5) / (df + 0.5))
-            docs = r[2].split('\n')
-            for doc in docs:
-                docid, date_time, tf, ld = doc.split('\t')
-                docid = int(docid)
-                tf = int(tf)
-                ld = int(ld)
-                s = (self.K1 * tf * w) / (tf + self.K1 * (1 - self.B + self.B * ld / self.AVG_L))
-                if docid in BM25_scores:
-                    BM25_scores[docid] = BM25_scores[docid] + s
-                else:
-                    BM25_scores[docid] = s
-        BM25_scores = sorted(BM25_scores.items(), key = operator.itemgetter(1))
-        BM25_scores.reverse()
-        if len(BM25_scores) == 0:
+        return list(cleaned_dict.keys())
+
+    def result_by_BM25(self, sentence, k = None, offset = 0):
+        return self.BM25_ranking(self.query_terms(sentence), k, offset)
+
+    def BM25_ranking(self, terms, k = None, offset = 0):
+        """BM25 排序。只要一页时按实测耗时在向量化穷举与 MaxScore 之间逐个查询选择，两者结果完全相同。
+
+        MaxScore 每轮都有固定的 Python 开销，只有 postings 多到剪枝省下的打分超过这部分开销时才更快，
+        交叉点取决于语料与机器（本仓库的 891 篇新闻上任何查询都是穷举更快），所以不写死阈值：
+        查询按 (postings 总数, offset + k) 的二进制位数分档，每档分别记录两种方式的耗时，
+        新的档位先各试一次，之后用较快的一种，较慢的一种每 MAXSCORE_EXPLORE 次查询再试一次。
+        """
+        lists = self.term_postings(terms)
+        if len(lists) == 0:
             return 0, []
+        postings = sum(len(p[0]) for p in lists)
+        if k is None or postings < self.MAXSCORE_MIN_POSTINGS:
+            return self.exhaustive(lists, k, offset)
+        bucket = (postings.bit_length(), (offset + k).bit_length())
+        strategy = self.choose_strategy(bucket)
+        t0 = perf_counter()
+        if strategy == 'maxscore':
+            result = self.maxscore(lists, k, offset)
         else:
-            return 1, BM25_scores
-    
-    def result_by_time(self, sentence):
+            result = self.exhaustive(lists, k, offset)
+        self.record_cost(bucket, strategy, perf_counter() - t0)
+        return result
+
+    def exhaustive(self, lists, k = None, offset = 0):
+        """对全部 postings 向量化打分后排序"""
+        docids, tfs, lds, tss, w = self.fetch_postings(None, lists)
+        BM25_scores = np.bincount(docids, weights = self.BM25(tfs, lds, w))
+        return self.rank(docids, BM25_scores, True, k, offset)
+
+    def choose_strategy(self, bucket):
+        """返回这一档查询这次该用的方式：'exhaustive' 或 'maxscore'"""
+        with self._lock:
+            n = self.strategy_queries.get(bucket, 0)
+            self.strategy_queries[bucket] = n + 1
+            exhaustive = self.strategy_cost.get((bucket, 'exhaustive'))
+            maxscore = self.strategy_cost.get((bucket, 'maxscore'))
+        if exhaustive is None:
+            return 'exhaustive'
+        if maxscore is None:
+            return 'maxscore'
+        faster, slower = ('maxscore', 'exhaustive') if maxscore < exhaustive else ('exhaustive', 'maxscore')
+        return slower if n % self.MAXSCORE_EXPLORE == 0 else faster
+
+    def record_cost(self, bucket, strategy, seconds):
+        with self._lock:
+            cost = self.strategy_cost.get((bucket, strategy))
+            if cost is not None:
+                seconds = cost + self.MAXSCORE_DECAY * (seconds - cost)
+            self.strategy_cost[(bucket, strategy)] = seconds
+
+    def result_by_BM25_maxscore(self, sentence, k, offset = 0, stats = None):
+        """不论 postings 多少都走 MaxScore，供基准测试对比"""
         seg_list = jieba.lcut(sentence, cut_all=False)
         n, cleaned_dict = self.clean_list(seg_list)
-        time_scores = {}
-        for term in cleaned_dict.keys():
-            r = self.fetch_from_db(term)
-            if r is None:
-                continue
-            docs = r[2].split('\n')
-            for doc in docs:
-                docid, date_time, tf, ld = doc.split('\t')
-                if docid in time_scores:
-                    continue
-                news_datetime = datetime.strptime(date_time, "%Y-%m-%d %H:%M:%S")
-                now_datetime = datetime.now()
-                td = now_datetime - news_datetime
-                docid = int(docid)
-                td = (timedelta.total_seconds(td) / 3600) # hour
-                time_scores[docid] = td
-        time_scores = sorted(time_scores.items(), key = operator.itemgetter(1))
-        if len(time_scores) == 0:
+        lists = self.term_postings(cleaned_dict.keys())
+        if len(lists) == 0:
             return 0, []
-        else:
-            return 1, time_scores
+        return self.maxscore(lists, k, offset, stats)
+
+    def maxscore(self, lists, k, offset = 0, stats = None):
+        """用 block-max MaxScore 动态剪枝求 BM25 前 offset + k 名，结果与穷举打分完全一致。
+
+        词项按上界升序排列，上界前缀和小于当前第 offset + k 名得分 theta 的词项为
+        non-essential：只出现在这些词项里的文档不可能进入前列，不必作为候选。
+        按 docid 区间逐段处理，候选只来自 essential 词项；再按块级上界（跳表中的
+        max_tf / min_ld）从大到小逐个补查 non-essential 词项，上界不足 theta 的候选随即剪掉。
+        存活文档按查询词顺序累加得分，与穷举时 np.bincount 的累加顺序相同，分数逐位一致；
+        平分按 (首个包含它的词项, docid) 倒序，与穷举时的首次出现位置倒序等价。
+        stats 不为 None 时写入 postings 总数与实际打分的记录数。
+        """
+        m = offset + k
+        T = len(lists)
+        docids = [p[0] for p in lists]
+        total = np.count_nonzero(np.bincount(np.concatenate(docids)))
+        skips = [p[7] for p in lists]
+        ub = np.array([float(self.upper_bound(p[5], p[6], p[4])) for p in lists])
+        block_ub = [self.upper_bound(sk['max_tf'], sk['min_ld'], p[4]) for sk, p in zip(skips, lists)]
+        by_ub = np.argsort(ub, kind='stable')
+        prefix = np.cumsum(ub[by_ub])
+
+        top_ids = np.empty(0, dtype=np.int64)
+        top_first = np.empty(0, dtype=np.int64)
+        top_scores = np.empty(0)
+        theta = -np.inf
+        scored = 0
+        lo = min(d[0] for d in docids)
+        window = max(self.MAXSCORE_WINDOW, (max(d[-1] for d in docids) - lo) // 32)
+        while True:
+            n_non = np.searchsorted(prefix, theta, 'left')
+            non_essential = by_ub[:n_non][::-1] # 上界从大到小
+            essential = by_ub[n_non:]
+            if len(essential) == 0:
+                break
+            # 跳到 essential 词项中下一个 >= lo 的 docid
+            starts = [self.seek(docids[t], skips[t], lo) for t in essential]
+            heads = [docids[t][i] for t, i in zip(essential, starts) if i < len(docids[t])]
+            if len(heads) == 0:
+                break
+            lo = min(heads)
+            hi = lo + window
+
+            parts = []
+            for t, i in zip(essential, starts):
+                parts.append((t, i, self.seek(docids[t], skips[t], hi)))
+            cands = np.unique(np.concatenate([docids[t][i:j] for t, i, j in parts]))
+            contrib = np.zeros((T, len(cands)))
+            present = np.zeros((T, len(cands)), dtype=bool)
+            for t, i, j in parts:
+                idx = np.searchsorted(cands, docids[t][i:j])
+                contrib[t, idx] = self.BM25(lists[t][1][i:j], lists[t][2][i:j], lists[t][4])
+                present[t, idx] = True
+                scored += j - i
+            # non-essential 词项的块级上界，候选所在块的上界（docid 超出最后一块时为 0）
+            bound = np.zeros((T, len(cands)))
+            for t in non_essential:
+                b = np.searchsorted(skips[t]['last'], cands)
+                inside = b < len(skips[t])
+                bound[t, inside] = block_ub[t][b[inside]]
+            # 剪枝时给 theta 留出余量：这里的部分和与最终得分累加顺序不同，可能差一个舍入误差
+            cut = theta - 1e-9 * abs(theta) if np.isfinite(theta) else theta
+            partial = contrib.sum(axis=0)
+            alive = partial + bound.sum(axis=0) >= cut
+            for r, t in enumerate(non_essential):
+                ids = np.flatnonzero(alive)
+                if len(ids) == 0:
+                    break
+                d = docids[t]
+                j = np.minimum(np.searchsorted(d, cands[ids]), len(d) - 1)
+                hit = d[j] == cands[ids]
+                ids, j = ids[hit], j[hit]
+                contrib[t, ids] = self.BM25(lists[t][1][j], lists[t][2][j], lists[t][4])
+                present[t, ids] = True
+                scored += len(ids)
+                partial = contrib.sum(axis=0)
+                alive &= partial + bound[non_essential[r + 1:]].sum(axis=0) >= cut
+
+            survivors = np.flatnonzero(alive)
+            scores = np.zeros(len(survivors))
+            for t in range(T):
+                scores = scores + contrib[t, survivors]
+            top_ids = np.concatenate((top_ids, cands[survivors]))
+            top_first = np.concatenate((top_first, present[:, survivors].argmax(axis=0)))
+            top_scores = np.concatenate((top_scores, scores))
+            if len(top_ids) >= m:
+                keep = np.lexsort((-top_ids, -top_first, -top_scores))[:m]
+                top_ids, top_first, top_scores = top_ids[keep], top_first[keep], top_scores[keep]
+                theta = top_scores.min()
+            lo = hi
+
+        if stats is not None:
+            stats['postings'] = sum(len(d) for d in docids)
+            stats['scored'] = scored
+        order = np.lexsort((-top_ids, -top_first, -top_scores))[offset:m]
+        return total, list(zip(top_ids[order].tolist(), top_scores[order].tolist()))
+
+    def seek(self, docids, skips, target):
+        """借助跳表定位第一个 docid >= target 的下标：先在块尾 docid 上二分定位块，再在块内二分"""
+        b = np.searchsorted(skips['last'], target)
+        if b >= len(skips):
+            return len(docids)
+        start = b * BLOCK_SIZE
+        return start + int(np.searchsorted(docids[start:start + BLOCK_SIZE], target))
     
-    def result_by_hot(self, sentence):
-        seg_list = jieba.lcut(sentence, cut_all=False)
-        n, cleaned_dict = self.clean_list(seg_list)
-        hot_scores = {}
-        for term in cleaned_dict.keys():
-            r = self.fetch_from_db(term)
-            if r is None:
-                continue
-            df = r[1]
-            w = math.log2((self.N - df + 0.5) / (df + 0.5))
-            docs = r[2].split('\n')
-            for doc in docs:
-                docid, date_time, tf, ld = doc.split('\t')
-                docid = int(docid)
-                tf = int(tf)
-                ld = int(ld)
-                news_datetime = datetime.strptime(date_time, "%Y-%m-%d %H:%M:%S")
-                now_datetime = datetime.now()
-                td = now_datetime - news_datetime
-                BM25_score = (self.K1 * tf * w) / (tf + self.K1 * (1 - self.B + self.B * ld / self.AVG_L))
-                td = (timedelta.total_seconds(td) / 3600) # hour
-#                hot_score = math.log(BM25_score) + 1 / td
-                hot_score = self.HOT_K1 * self.sigmoid(BM25_score) + self.HOT_K2 / td
-                if docid in hot_scores:
-                    hot_scores[docid] = hot_scores[docid] + hot_score
-                else:
-                    hot_scores[docid] = hot_score
-        hot_scores = sorted(hot_scores.items(), key = operator.itemgetter(1))
-        hot_scores.reverse()
-        if len(hot_scores) == 0:
+    def result_by_time(self, sentence, k = None, offset = 0):
+        return self.time_ranking(self.query_terms(sentence), k, offset)
+
+    def time_ranking(self, terms, k = None, offset = 0):
+        """按发布时间从新到旧排序，得分为距今小时数，同一时间的文档按 docid 升序。
+
+        命中文档在全局 recency 顺序上打标记后按顺序取出，不对命中文档排序；
+        当前时间每次查询只取一次，只为返回的这一页计算得分。
+        """
+        lists = self.term_postings(terms)
+        if len(lists) == 0:
             return 0, []
-        else:
-            return 1, hot_scores
+        docids = np.concatenate([p[0] for p in lists])
+        now = now_epoch()
+        doc_ts, recency = self.doc_ts, self.recency
+        if recency is None or docids.max() >= len(doc_ts): # 旧版索引没有 doc_state，按 postings 中的时间排序
+            tss = np.concatenate([p[3] for p in lists])
+            time_scores = np.zeros(docids.max() + 1)
+            time_scores[docids] = (now - tss) / 3600 # hour
+            return self.rank(docids, time_scores, False, k, offset)
+        matched = np.zeros(len(doc_ts), dtype=bool)
+        matched[docids] = True
+        order = recency[matched[recency]]
+        end = len(order) if k is None else offset + k
+        page = order[offset:end]
+        return len(order), list(zip(page.tolist(), ((now - doc_ts[page]) / 3600).tolist()))
     
-    def search(self, sentence, sort_type = 0):
-        if sort_type == 0:
-            return self.result_by_BM25(sentence)
-        elif sort_type == 1:
-            return self.result_by_time(sentence)
-        elif sort_type == 2:
-            return self.result_by_hot(sentence)
+    def result_by_hot(self, sentence, k = None, offset = 0):
+        return self.hot_ranking(self.query_terms(sentence), k, offset)
+
+    def hot_ranking(self, terms, k = None, offset = 0):
+        p = self.fetch_postings(terms)
+        if p is None:
+            return 0, []
+        docids, tfs, lds, tss, w = p
+        BM25_score = self.BM25(tfs, lds, w)
+        td = (now_epoch() - tss) / 3600 # hour
+#        hot_score = math.log(BM25_score) + 1 / td
+        with np.errstate(divide = 'ignore'):
+            hot_score = self.HOT_K1 * self.sigmoid(BM25_score) + self.HOT_K2 / td
+        hot_scores = np.bincount(docids, weights = hot_score)
+        return self.rank(docids, hot_scores, True, k, offset)
+    
+    def search(self, sentence, sort_type = 0, k = None, offset = 0):
+        """检索入口，返回 (命中总数, [(docid, score)])。
+
+        sort_type: 0 相关度，1 时间，2 热度；k 为 None 时返回全部结果，
+        否则只返回排在第 offset 名之后的 k 条，命中总数仍是全部文档数，供分页使用。
+
+        结果经过 QueryCache：键是清洗后的词项序列、排序方式与索引代数。词序不同的同一组词不共用结果：
+        rank 平分时按在各词项 postings 拼接后的首次出现位置排序，这与词序有关。
+        未命中时至少算出前 QUERY_CACHE_PREFETCH 名，随后几页的翻页直接从缓存切片。
+        """
+        self.sync()
+        terms = self.query_terms(sentence)
+        key = (tuple(terms), sort_type, self.index_generation)
+        end = None if k is None else offset + k
+        cached = self.cache.get(key, end)
+        if cached is None:
+            fetch = None if end is None else max(end, self.QUERY_CACHE_PREFETCH)
+            if sort_type == 0:
+                total, results = self.BM25_ranking(terms, fetch)
+            elif sort_type == 1:
+                total, results = self.time_ranking(terms, fetch)
+            elif sort_type == 2:
+                total, results = self.hot_ranking(terms, fetch)
+            else:
+                return None
+            self.cache.put(key, total, results, fetch is None or len(results) >= total,
+                           None if sort_type == 0 else self.QUERY_CACHE_TTL)
+        else:
+            total, results = cached
+        return total, results[offset:end]
+
+    def cache_stats(self):
+        """检索结果缓存的命中、未命中、淘汰次数与当前占用"""
+        return self.cache.stats()
+
+    def postings_cache_stats(self):
+        """postings 缓存的命中、未命中、拒绝准入、淘汰次数与当前占用"""
+        return self.postings_cache.stats()
 
 if __name__ == "__main__":
     se = SearchEngine('../config.ini', 'utf-8')
-    flag, rs = se.search('北京雾霾', 0)
-    print(rs[:10])
\ No newline at end of file
+    total, rs = se.search('北京雾霾', 0, 10)
+    print(total, rs)
\ No newline at end of file